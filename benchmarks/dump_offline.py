@@ -0,0 +1,293 @@
+"""End-to-end benchmark of ``dump`` against local fake servers.
+
+Runs the real ``dump`` command, with ``AndroidAPI``'s base URLs pointed at
+the servers from ``fake_servers``, on synthetic threads, and reports
+throughput, peak memory and how many requests each server got. No
+Facebook account or network access is needed.
+
+The fake servers run in a child process, so that generating responses
+doesn't count towards the dumper's CPU time or memory.
+
+    python benchmarks/dump_offline.py --messages 20000 --threads 2
+    python benchmarks/dump_offline.py --graphql-latency 0.2 --graphql-rate-limit 50 \\
+        --webhook-latency 0.1 --json results.json
+    python benchmarks/dump_offline.py --accounts 4 --store none --quiet-gap 48 \\
+        -- --max-requests-per-minute 300 --initial-requests-per-minute 300
+
+Options after ``--`` are passed on to ``dump`` as is, e.g.
+``-- --adaptive-page-size --concurrency 4``.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yarl import URL  # noqa: E402
+
+from dumper import current_rss  # noqa: E402
+from fake_servers import FakeConfig, FakeServers, ServerProfile, ThreadSpec  # noqa: E402
+from maufbapi import AndroidAPI, AndroidState  # noqa: E402
+import commands.dump  # noqa: E402
+import aiosqlite  # noqa: E402
+
+
+def _serve(config_json: str, ports: multiprocessing.Queue) -> None:
+    async def serve() -> None:
+        servers = FakeServers(FakeConfig.from_json(config_json))
+        await servers.start()
+        ports.put(servers.port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await servers.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def _get_json(url: str) -> dict:
+    with urllib.request.urlopen(url) as resp:
+        return json.load(resp)
+
+
+def write_credentials(path: str, uid: int = 1) -> None:
+    state = AndroidState()
+    state.generate(f"benchmark-{uid}".encode("utf-8"))
+    state.session.access_token = f"benchmark-token-{uid}"
+    state.session.uid = uid
+    with open(path, "w") as f:
+        f.write(state.json())
+
+
+class PeakRSS:
+    """Samples the resident set size in the background."""
+
+    def __init__(self, interval: float = 0.05) -> None:
+        self.interval = interval
+        self.peak = current_rss() or 0
+        self._task: asyncio.Task | None = None
+
+    async def _sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, current_rss() or 0)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.peak = max(self.peak, current_rss() or 0)
+
+
+async def run_dump(dump_argv: list[str], database: str) -> tuple[float, int]:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database")
+    subparsers = parser.add_subparsers()
+    subparsers_dump = commands.dump.add_command(subparsers)
+    subparsers_dump.set_defaults(func=commands.dump.execute)
+    args = parser.parse_args(["-d", database, "dump", *dump_argv])
+
+    rss = PeakRSS()
+    rss.start()
+    started_at = time.monotonic()
+    try:
+        await args.func(args)
+    finally:
+        elapsed = time.monotonic() - started_at
+        await rss.stop()
+    return elapsed, rss.peak
+
+
+async def count_rows(database: str) -> dict[str, int]:
+    async with aiosqlite.connect(database) as conn:
+        counts = {}
+        for table in ("messages", "attachments", "reactions", "users", "stickers"):
+            cursor = await conn.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = (await cursor.fetchone())[0]
+        return counts
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    dump_argv = []
+    if "--" in argv:
+        index = argv.index("--")
+        argv, dump_argv = argv[:index], argv[index + 1:]
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=1, help="Number of synthetic threads")
+    parser.add_argument("--messages", type=int, default=10000, help="Messages per thread")
+    parser.add_argument("--members", type=int, default=20, help="Members per thread")
+    parser.add_argument("--attachment-ratio", type=float, default=0.1)
+    parser.add_argument("--sticker-ratio", type=float, default=0.05)
+    parser.add_argument("--reaction-ratio", type=float, default=0.2)
+    parser.add_argument("--mention-ratio", type=float, default=0.05)
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="Bytes per file")
+    parser.add_argument(
+        "--message-interval",
+        type=float,
+        default=60,
+        help="Seconds between messages, starting from 2015-01-01",
+    )
+    parser.add_argument(
+        "--quiet-gap",
+        type=float,
+        default=0,
+        help=(
+            "Average hours between conversations, for bursts of messages like "
+            "in real threads (0 to spread messages evenly)"
+        ),
+    )
+    parser.add_argument(
+        "--conversation-messages",
+        type=int,
+        default=40,
+        help="Average messages per conversation, with --quiet-gap",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--accounts",
+        type=int,
+        default=1,
+        help="Number of accounts to dump with, all of them members of every thread",
+    )
+    for server, defaults in (
+        ("graphql", ServerProfile()),
+        ("cdn", ServerProfile()),
+        ("webhook", ServerProfile(rate_limit=5, window=2.0)),
+    ):
+        parser.add_argument(f"--{server}-latency", type=float, default=defaults.latency)
+        parser.add_argument(f"--{server}-jitter", type=float, default=defaults.jitter)
+        parser.add_argument(
+            f"--{server}-rate-limit",
+            type=int,
+            default=defaults.rate_limit,
+            help=f"Requests per --{server}-window seconds (0 for no limit)",
+        )
+        parser.add_argument(f"--{server}-window", type=float, default=defaults.window)
+        parser.add_argument(f"--{server}-error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument(
+        "--store",
+        choices=("webhook", "local", "none"),
+        default="webhook",
+        help="Where attachments go",
+    )
+    parser.add_argument("--webhooks", type=int, default=4, help="Number of fake webhooks")
+    parser.add_argument("--json", type=str, help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    config = FakeConfig(
+        threads=[
+            ThreadSpec(
+                id=1000 + index,
+                messages=args.messages,
+                members=args.members,
+                attachment_ratio=args.attachment_ratio,
+                sticker_ratio=args.sticker_ratio,
+                reaction_ratio=args.reaction_ratio,
+                mention_ratio=args.mention_ratio,
+                attachment_size=args.attachment_size,
+                message_interval_ms=int(args.message_interval * 1000),
+                quiet_gap_ms=int(args.quiet_gap * 3600 * 1000),
+                conversation_messages=args.conversation_messages,
+                seed=args.seed,
+            )
+            for index in range(args.threads)
+        ],
+        **{
+            server: ServerProfile(
+                latency=getattr(args, f"{server}_latency"),
+                jitter=getattr(args, f"{server}_jitter"),
+                rate_limit=getattr(args, f"{server}_rate_limit"),
+                window=getattr(args, f"{server}_window"),
+                error_rate=getattr(args, f"{server}_error_rate"),
+            )
+            for server in ("graphql", "cdn", "webhook")
+        },
+    )
+
+    ports = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=_serve, args=(config.to_json(), ports), daemon=True
+    )
+    server_process.start()
+    try:
+        port = ports.get(timeout=30)
+        base_url = f"http://127.0.0.1:{port}"
+        for name in ("a_url", "b_url", "graph_url", "b_graph_url", "rupload_url"):
+            setattr(AndroidAPI, name, URL(base_url))
+
+        with tempfile.TemporaryDirectory(prefix="dump-benchmark-") as workdir:
+            database = os.path.join(workdir, "database.sqlite3")
+            credentials = []
+            for index in range(max(args.accounts, 1)):
+                credentials.append(os.path.join(workdir, f"credentials-{index}.json"))
+                # Synthetic members have IDs from 100000 up.
+                write_credentials(credentials[-1], 100000 + index)
+
+            run_argv = [
+                "--id", *(str(thread.id) for thread in config.threads),
+                "--credentials", *credentials,
+            ]
+            if args.store == "webhook":
+                run_argv += [
+                    "--webhook",
+                    *(f"{base_url}/api/webhooks/{i}/benchmark" for i in range(args.webhooks)),
+                ]
+            elif args.store == "local":
+                run_argv += ["--store-dir", os.path.join(workdir, "store")]
+            run_argv += dump_argv
+
+            elapsed, peak_rss = asyncio.run(run_dump(run_argv, database))
+            rows = asyncio.run(count_rows(database))
+        requests = _get_json(f"{base_url}/_stats")
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+    # ru_maxrss is in KiB on Linux.
+    max_rss = max(peak_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    results = {
+        "messages": rows["messages"],
+        "expected_messages": args.messages * args.threads,
+        "seconds": elapsed,
+        "messages_per_second": rows["messages"] / elapsed if elapsed else 0.0,
+        "peak_rss_bytes": max_rss,
+        "rows": rows,
+        "requests": requests,
+        "dump_args": run_argv,
+    }
+
+    print()
+    print(
+        f"{results['messages']}/{results['expected_messages']} messages in "
+        f"{elapsed:.2f} s: {results['messages_per_second']:.0f} messages/s, "
+        f"peak RSS {max_rss / 2**20:.1f} MiB"
+    )
+    print("rows: " + ", ".join(f"{table} {count}" for table, count in rows.items()))
+    for name, count in sorted(requests.items()):
+        print(f"  {name:40} {count:>12}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
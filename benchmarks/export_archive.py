@@ -0,0 +1,340 @@
+"""Benchmark ``export`` on a synthetic database.
+
+Fills a database with messages, reactions, attachments and replies spread
+over a number of threads and members, then runs ``export`` on it in a child
+process and reports the time taken and the child's peak memory. With
+``--legacy`` the implementation that built the whole archive in memory,
+kept here, is run too, and both outputs are checked to contain
+the same data. Looking up the index of each message's sender in
+``userindex``, which grows with the number of members, is also timed on
+its own:
+
+    python benchmarks/export_archive.py --messages 200000 --legacy
+    python benchmarks/export_archive.py --messages 1000000 --threads 1 --members 500
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import aiosqlite  # noqa: E402
+from multidict import MultiDict  # noqa: E402
+from tqdm import tqdm  # noqa: E402
+
+import commands.export  # noqa: E402
+from commands.export import get_meta, media_url_resolver  # noqa: E402
+
+_REACTIONS = ("😆", "😍", "😮", "😢", "😠", "👍", "❤")
+_WORDS = "lorem ipsum dolor sit amet *bold* _under_ `code` https://example.com/a_b".split()
+
+
+async def legacy_get_all_attachments(connection, resolve_url) -> MultiDict:
+    attachments = MultiDict()
+    async with connection.execute(
+        "SELECT message_id, name, type, url, width, height FROM attachments"
+    ) as cursor:
+        async for attachment in cursor:
+            message_id, name, attachment_type, url, width, height = attachment
+            if not url or not name:
+                continue
+            dumped_attachment = {
+                "url": resolve_url(url),
+                "name": name,
+            }
+            if width:
+                dumped_attachment["width"] = width
+            if height:
+                dumped_attachment["height"] = height
+            attachments.add(message_id, dumped_attachment)
+    return attachments
+
+
+async def legacy_get_all_reactions(connection) -> MultiDict:
+    reactions = MultiDict()
+    async with connection.execute(
+        "SELECT message_id, emoji, count FROM reactions"
+    ) as cursor:
+        async for reaction in cursor:
+            message_id, emoji, count = reaction
+            if not emoji or not count:
+                continue
+            reactions.add(message_id, {"n": emoji, "c": count})
+    return reactions
+
+
+async def legacy_execute(args):
+    async with aiosqlite.connect(args.database) as conn:
+        dump = {
+            "meta": {
+                "users": {},
+                "userindex": [],
+                "servers": [{
+                    "name": "\u200B",
+                    "type": "server"
+                }],
+                "channels": {},
+            },
+            "data": {},
+        }
+
+        resolve_url = media_url_resolver(args)
+        all_attachments = await legacy_get_all_attachments(conn, resolve_url)
+        all_reactions = await legacy_get_all_reactions(conn)
+
+        for thread_id in args.id:
+            str_thread_id = str(thread_id)
+
+            async with conn.execute("SELECT name FROM channels WHERE id = ?", (thread_id,)) as cursor:
+                name = (await cursor.fetchone())[0]
+
+            dump["meta"]["channels"][str_thread_id] = {
+                "server": 0,
+                "name": name,
+                "nsfw": False,
+            }
+
+            async with conn.execute(
+                (
+                    "SELECT DISTINCT sender_id, name, avatar_url "
+                    "FROM messages "
+                    "LEFT JOIN users ON messages.sender_id = users.id "
+                    "WHERE channel_id = ?"
+                ),
+                (thread_id,),
+            ) as cursor:
+                async for user in cursor:
+                    id, name, avatar_url = user
+                    str_id = str(id)
+                    dump["meta"]["userindex"].append(str_id)
+                    dump["meta"]["users"][str_id] = {
+                        "name": name,
+                        "avatar": resolve_url(avatar_url),
+                        "tag": "0",
+                    }
+
+            dump["data"][str_thread_id] = {}
+            async with conn.execute(
+                (
+                    "SELECT messages.id, sender_id, text, timestamp, unsent_timestamp, replied_to_id "
+                    "FROM messages "
+                    "LEFT JOIN replied_to ON replied_to.message_id = messages.id "
+                    "WHERE channel_id = ?"
+                ),
+                (thread_id,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                for message in tqdm(rows):
+                    message_id, sender_id, text, timestamp, unsent_timestamp, replied_to_id = message
+
+                    dumped_message = dump["data"][str_thread_id][message_id] = {
+                        "u": dump["meta"]["userindex"].index(str(sender_id)),
+                        "t": timestamp,
+                    }
+                    if text:
+                        dumped_message["m"] = text
+                    if unsent_timestamp:
+                        dumped_message["tu"] = unsent_timestamp
+                    if replied_to_id:
+                        dumped_message["r"] = replied_to_id
+                    if (reactions := all_reactions.getall(message_id, None)):
+                        dumped_message["re"] = reactions
+                    if (attachments := all_attachments.getall(message_id, None)):
+                        dumped_message["a"] = attachments
+
+    output_filename = f"archive-{int(time.time())}"
+
+    with open(f"{output_filename}.json", "w") as f:
+        json.dump(dump, f, indent=4, ensure_ascii=False)
+
+    with open("template.html") as f:
+        template = f.read()
+
+    compressed_data = gzip.compress(json.dumps(dump, ensure_ascii=False).encode("utf-8"))
+
+    template = template.replace(
+        '"/*[ARCHIVE]*/"',
+        f'"data:application/gzip;base64,{base64.b64encode(compressed_data).decode("utf-8")}"',
+    )
+
+    with open(f"{output_filename}.html", "w") as f:
+        f.write(template)
+
+
+def make_database(path: str, args) -> list[int]:
+    rng = random.Random(args.seed)
+    with open(os.path.join(_ROOT, "database", "schema.sql")) as f:
+        schema = f.read()
+    thread_ids = [1000 + i for i in range(args.threads)]
+    with sqlite3.connect(path) as conn:
+        conn.executescript(schema)
+        conn.executemany(
+            "INSERT INTO channels (id, name) VALUES (?, ?)",
+            [(thread_id, f"Thread {thread_id}") for thread_id in thread_ids],
+        )
+        conn.executemany(
+            "INSERT INTO users (id, name, avatar_url) VALUES (?, ?, ?)",
+            [
+                (100000 + i, f"Member {i}", f"profile_picture-{100000 + i}.jpg")
+                for i in range(args.members)
+            ],
+        )
+        messages, reactions, attachments, replies = [], [], [], []
+        for i in range(args.messages):
+            message_id = f"mid.$export{i:09d}"
+            text = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 20)))
+            messages.append((
+                message_id,
+                100000 + rng.randrange(args.members),
+                thread_ids[i % len(thread_ids)],
+                text,
+                1420070400000 + i * 60000,
+                None,
+            ))
+            if rng.random() < 0.2:
+                reactions.extend(
+                    (message_id, emoji, rng.randint(1, 5))
+                    for emoji in rng.sample(_REACTIONS, rng.randint(1, 3))
+                )
+            if rng.random() < 0.1:
+                attachments.append((
+                    f"{i:09d}", message_id, f"image-{i}.jpg", "image",
+                    f"media/{i:064x}/image-{i}.jpg", 1280, 960,
+                ))
+            if i and rng.random() < 0.05:
+                replies.append((message_id, f"mid.$export{rng.randrange(i):09d}"))
+        conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", messages)
+        conn.executemany("INSERT INTO reactions VALUES (?, ?, ?)", reactions)
+        conn.executemany(
+            "INSERT INTO attachments (id, message_id, name, type, url, width, height) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            attachments,
+        )
+        conn.executemany("INSERT INTO replied_to VALUES (?, ?)", replies)
+    return thread_ids
+
+
+async def sender_lookups(database: str, thread_ids: list[int]) -> None:
+    async with aiosqlite.connect(database) as conn:
+        meta, user_indices = await get_meta(conn, thread_ids, lambda url: url)
+        async with conn.execute("SELECT sender_id FROM messages") as cursor:
+            senders = [sender_id for (sender_id,) in await cursor.fetchall()]
+    userindex = meta["userindex"]
+
+    results = {}
+    for name, lookup in (
+        ("userindex.index", lambda: [userindex.index(str(sender_id)) for sender_id in senders]),
+        ("dict", lambda: [user_indices[sender_id] for sender_id in senders]),
+    ):
+        started_at = time.perf_counter()
+        results[name] = (lookup(), time.perf_counter() - started_at)
+    if results["userindex.index"][0] != results["dict"][0]:
+        sys.exit("Sender indices differ")
+    print(f"  sender lookups over {len(userindex)} users, identical:")
+    for name, (_, seconds) in results.items():
+        print(f"    {name:16} {seconds:7.3f} s {seconds / len(senders) * 1e9:8.0f} ns/message")
+
+
+def _run_export(name: str, workdir: str, export_args: dict, results: multiprocessing.Queue) -> None:
+    os.chdir(workdir)
+    args = argparse.Namespace(**export_args)
+    func = legacy_execute if name == "legacy" else commands.export.execute
+    started_at = time.perf_counter()
+    asyncio.run(func(args))
+    seconds = time.perf_counter() - started_at
+    # ru_maxrss is in KiB on Linux.
+    results.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+
+def run(name: str, workdir: str, export_args: dict) -> tuple[float, int, str]:
+    outdir = os.path.join(workdir, name)
+    os.makedirs(outdir)
+    shutil.copy(os.path.join(_ROOT, "template.html"), outdir)
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_run_export, args=(name, outdir, export_args, results)
+    )
+    process.start()
+    seconds, peak_rss = results.get()
+    process.join()
+    (output,) = [
+        os.path.join(outdir, filename)
+        for filename in os.listdir(outdir)
+        if filename.startswith("archive-") and filename.endswith(".json")
+    ]
+    return seconds, peak_rss, output
+
+
+def embedded_data(html_path: str) -> bytes:
+    with open(html_path) as f:
+        match = re.search(r'"data:application/gzip;base64,([^"]*)"', f.read())
+    return gzip.decompress(base64.b64decode(match.group(1)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=2000, help="export --batch-size")
+    parser.add_argument("--legacy", action="store_true", help="Also run the old export")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="export-benchmark-") as workdir:
+        database = os.path.join(workdir, "database.sqlite3")
+        started_at = time.perf_counter()
+        thread_ids = make_database(database, args)
+        print(
+            f"{args.messages} messages in {args.threads} threads from {args.members} members, "
+            f"database built in {time.perf_counter() - started_at:.1f} s "
+            f"({os.path.getsize(database) / 2**20:.0f} MiB)"
+        )
+        asyncio.run(sender_lookups(database, thread_ids))
+        export_args = {
+            "database": database,
+            "id": thread_ids,
+            "store_dir": None,
+            "media_url": "https://example.com",
+            "batch_size": args.batch_size,
+        }
+
+        outputs = {}
+        for name in ("legacy", "export") if args.legacy else ("export",):
+            seconds, peak_rss, output = run(name, workdir, export_args)
+            outputs[name] = output
+            print(
+                f"  {name:8} {seconds:8.2f} s {args.messages / seconds:9.0f} messages/s "
+                f"peak RSS {peak_rss / 2**20:8.1f} MiB"
+            )
+        if args.legacy:
+            json_outputs = []
+            for output in outputs.values():
+                with open(output, "rb") as f:
+                    json_outputs.append(f.read())
+            html_outputs = [
+                embedded_data(output.removesuffix(".json") + ".html")
+                for output in outputs.values()
+            ]
+            if len(set(json_outputs)) != 1 or len(set(html_outputs)) != 1:
+                sys.exit("The outputs differ")
+            print("  outputs identical")
+
+
+if __name__ == "__main__":
+    main()
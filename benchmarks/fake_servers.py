@@ -0,0 +1,550 @@
+"""Local stand-ins for Messenger's GraphQL API, its CDN and Discord webhooks.
+
+The servers speak just enough of each protocol for ``dump`` to run against
+them: ``ThreadQuery``, ``MoreMessagesQuery``, ``FetchStickersWithPreviewsQuery``
+and ``FileAttachmentUrlQuery`` on ``/graphql``, ``messaging_get_attachment``
+redirects, file downloads, and webhook uploads with Discord's rate limit
+headers. Threads are synthetic and generated on the fly from a seed, so a
+thread with millions of messages costs no memory.
+
+Every server can add latency, enforce a rate limit and fail a fraction of
+requests, and counts the requests it served, which ``GET /_stats`` returns.
+Single CDN files can also be made to go missing, like expired URLs do.
+Like Messenger's, the GraphQL rate limit applies to each access token
+separately.
+"""
+from __future__ import annotations
+
+from array import array
+from dataclasses import asdict, dataclass, field
+from typing import Any, Sequence
+import asyncio
+import bisect
+import collections
+import json
+import math
+import random
+import time
+
+from aiohttp import web
+
+# Timestamp of the oldest synthetic message (2015-01-01).
+EPOCH_MS = 1420070400000
+# Synthetic messages are this far apart by default.
+MESSAGE_INTERVAL_MS = 60_000
+
+_REACTIONS = ("😆", "😍", "😮", "😢", "😠", "👍", "❤")
+_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua *bold* _under_ ~strike~ "
+    "`code` > quote https://example.com/page?a=1&b=2"
+).split()
+
+
+@dataclass
+class ServerProfile:
+    """How a fake server behaves: latency, rate limit and failures."""
+
+    # Seconds added to every response, plus up to ``jitter`` more.
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Requests allowed per ``window`` seconds (0 for no limit).
+    rate_limit: int = 0
+    window: float = 1.0
+    # Fraction of requests that fail.
+    error_rate: float = 0.0
+
+    async def delay(self, rng: random.Random) -> None:
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + rng.random() * self.jitter)
+
+
+@dataclass
+class ThreadSpec:
+    """Shape of a synthetic thread."""
+
+    id: int
+    messages: int
+    members: int = 10
+    # Fractions of messages with each of these.
+    attachment_ratio: float = 0.1
+    sticker_ratio: float = 0.05
+    reaction_ratio: float = 0.2
+    mention_ratio: float = 0.05
+    # Fraction of attachments that are files, which need a URL lookup.
+    file_ratio: float = 0.2
+    # Fraction of images that are larger than their full screen version,
+    # which also needs a URL lookup.
+    large_image_ratio: float = 0.1
+    # Distinct stickers used in the thread.
+    sticker_variety: int = 50
+    attachment_size: int = 64 * 1024
+    # Time between messages; a longer one spreads them over more shards.
+    message_interval_ms: int = MESSAGE_INTERVAL_MS
+    # Average quiet time between conversations, which average
+    # ``conversation_messages`` messages. With no quiet time all messages are
+    # ``message_interval_ms`` apart.
+    quiet_gap_ms: int = 0
+    conversation_messages: int = 40
+    seed: int = 0
+
+
+@dataclass
+class FakeConfig:
+    threads: list[ThreadSpec]
+    graphql: ServerProfile = field(default_factory=ServerProfile)
+    cdn: ServerProfile = field(default_factory=ServerProfile)
+    webhook: ServerProfile = field(default_factory=lambda: ServerProfile(rate_limit=5, window=2.0))
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> FakeConfig:
+        raw = json.loads(data)
+        return cls(
+            threads=[ThreadSpec(**thread) for thread in raw["threads"]],
+            graphql=ServerProfile(**raw["graphql"]),
+            cdn=ServerProfile(**raw["cdn"]),
+            webhook=ServerProfile(**raw["webhook"]),
+        )
+
+
+class _Window:
+    """Fixed window request counter."""
+
+    def __init__(self, limit: int, window: float) -> None:
+        self.limit = limit
+        self.window = window
+        self.started_at = 0.0
+        self.count = 0
+
+    def take(self) -> tuple[bool, int, float]:
+        """Count a request; returns whether it's allowed, the remaining
+        requests and the seconds until the window resets."""
+        now = time.monotonic()
+        if now - self.started_at >= self.window:
+            self.started_at = now
+            self.count = 0
+        reset_after = self.window - (now - self.started_at)
+        if self.limit and self.count >= self.limit:
+            return False, 0, reset_after
+        self.count += 1
+        return True, max(self.limit - self.count, 0), reset_after
+
+
+class SyntheticThread:
+    """Deterministic messages of a synthetic thread, built on demand."""
+
+    def __init__(self, spec: ThreadSpec, cdn_url: str) -> None:
+        self.spec = spec
+        self.cdn_url = cdn_url
+        self.timestamps: Sequence[int] = range(
+            EPOCH_MS,
+            EPOCH_MS + spec.messages * spec.message_interval_ms,
+            spec.message_interval_ms,
+        )
+        if spec.quiet_gap_ms:
+            self.timestamps = self._conversation_timestamps()
+
+    def member_id(self, index: int) -> str:
+        return str(100000 + index)
+
+    def picture(self, name: str, width: int = 960, height: int = 960) -> dict[str, Any]:
+        return {"uri": f"{self.cdn_url}/{name}", "width": width, "height": height}
+
+    def participant(self, index: int) -> dict[str, Any]:
+        member_id = self.member_id(index)
+        return {
+            "id": member_id,
+            "messaging_actor": {
+                "id": member_id,
+                "__typename": "User",
+                "name": f"Member {index}",
+                "structured_name": {"parts": [], "text": f"Member {index}"},
+                "profile_pic_large": self.picture(f"profile/{member_id}.jpg", 880, 880),
+            },
+        }
+
+    def thread(self) -> dict[str, Any]:
+        spec = self.spec
+        return {
+            "id": str(spec.id),
+            "folder": "INBOX",
+            "name": f"Benchmark thread {spec.id}",
+            "thread_key": {"thread_fbid": str(spec.id)},
+            "image": None,
+            "messages_count": spec.messages,
+            "unread_count": 0,
+            "unsend_limit": 600000,
+            "mute_until": None,
+            "privacy_mode": 0,
+            "thread_pin_timestamp": 0,
+            "thread_queue_enabled": False,
+            "thread_unsendability_status": "can_unsend",
+            "updated_time_precise": str(self.timestamps[-1] if spec.messages else EPOCH_MS),
+            "last_message": {"nodes": []},
+            "messages": {"nodes": []},
+            "read_receipts": {"nodes": []},
+            "all_participants": {
+                "nodes": [self.participant(index) for index in range(spec.members)],
+            },
+            "customization_info": {},
+            "thread_admins": [],
+            "is_admin_supported": True,
+            "is_business_page_active": False,
+            "is_disappearing_mode": False,
+            "is_fuss_red_page": False,
+            "is_group_thread": True,
+            "is_ignored_by_viewer": False,
+            "is_pinned": False,
+            "is_viewer_allowed_to_add_members": True,
+            "is_viewer_subscribed": True,
+            "can_viewer_reply": True,
+            "can_participants_claim_admin": False,
+        }
+
+    def _rng(self, index: int) -> random.Random:
+        return random.Random(self.spec.seed * 1_000_003 + self.spec.id * 7919 + index)
+
+    def _conversation_timestamps(self) -> array:
+        # Like real threads: bursts of messages with long quiet gaps, of
+        # very different lengths, in between.
+        spec = self.spec
+        rng = self._rng(-1)
+        # Lognormal with a mean of quiet_gap_ms: mostly hours, sometimes months.
+        sigma = 2.0
+        mu = math.log(spec.quiet_gap_ms) - sigma**2 / 2
+        timestamps = array("q")
+        timestamp = EPOCH_MS
+        for _ in range(spec.messages):
+            timestamps.append(timestamp)
+            timestamp += spec.message_interval_ms
+            if rng.random() < 1 / spec.conversation_messages:
+                timestamp += int(rng.lognormvariate(mu, sigma))
+        return timestamps
+
+    def message_id(self, index: int) -> str:
+        return f"mid.$bench{self.spec.id}x{index}"
+
+    def attachment(self, index: int, rng: random.Random) -> dict[str, Any]:
+        spec = self.spec
+        attachment_id = f"{spec.id}{index:09d}"
+        if rng.random() < spec.file_ratio:
+            return {
+                "__typename": "MessageFile",
+                "id": attachment_id,
+                "attachment_fbid": attachment_id,
+                "filename": f"document-{index}.pdf",
+                "mimetype": "application/pdf",
+                "filesize": spec.attachment_size,
+            }
+        full_screen = self.picture(f"attachment/{attachment_id}.jpg", 1280, 960)
+        large = rng.random() < spec.large_image_ratio
+        return {
+            "__typename": "MessageImage",
+            "id": attachment_id,
+            "attachment_fbid": attachment_id,
+            "filename": f"image-{index}.jpg",
+            "mimetype": "image/jpeg",
+            "image_type": "FILE_ATTACHMENT",
+            "original_dimensions": {"x": 4096 if large else 1280, "y": 3072 if large else 960},
+            "image_full_screen": full_screen,
+        }
+
+    def message(self, index: int) -> dict[str, Any]:
+        spec = self.spec
+        rng = self._rng(index)
+        sender = rng.randrange(spec.members)
+        text = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 30)))
+        ranges = []
+        if rng.random() < spec.mention_ratio:
+            mentioned = rng.randrange(spec.members)
+            mention = f"@Member {mentioned}"
+            ranges.append({
+                "offset": len(text) + 1,
+                "length": len(mention),
+                "entity": {"id": self.member_id(mentioned)},
+            })
+            text = f"{text} {mention}"
+        message: dict[str, Any] = {
+            "message_id": self.message_id(index),
+            "message_sender": {
+                "id": self.member_id(sender),
+                "messaging_actor": {"id": self.member_id(sender), "name": f"Member {sender}"},
+            },
+            "message": {"text": text, "ranges": ranges},
+            "snippet": text[:50],
+            "timestamp_precise": str(self.timestamps[index]),
+            "message_reactions": [],
+            "blob_attachments": [],
+        }
+        if rng.random() < spec.reaction_ratio:
+            message["message_reactions"] = [
+                {
+                    "reaction": rng.choice(_REACTIONS),
+                    "reaction_timestamp": self.timestamps[index] // 1000 + 60,
+                    "user": {"id": self.member_id(rng.randrange(spec.members))},
+                }
+                for _ in range(rng.randint(1, 3))
+            ]
+        if rng.random() < spec.sticker_ratio:
+            message["sticker"] = {"id": str(369239263222822 + rng.randrange(spec.sticker_variety))}
+            message["message"] = None
+        elif rng.random() < spec.attachment_ratio:
+            message["blob_attachments"] = [self.attachment(index, rng)]
+        if index > 0 and rng.random() < 0.05:
+            message["replied_to_message"] = {
+                "message": {
+                    "message_id": self.message_id(rng.randrange(index)),
+                    "message_sender": message["message_sender"],
+                },
+                "status": "VALID",
+            }
+        return message
+
+    def page(self, before_time_ms: int, count: int) -> list[dict[str, Any]]:
+        end = bisect.bisect_right(self.timestamps, before_time_ms)
+        return [self.message(index) for index in range(max(end - count, 0), end)]
+
+    def file_url(self, message_id: str) -> dict[str, Any]:
+        index = int(message_id.rpartition("x")[2])
+        attachments = self.message(index)["blob_attachments"]
+        return {
+            "id": message_id,
+            "blob_attachments": [
+                {
+                    "__typename": attachment["__typename"],
+                    "attachment_fbid": attachment["attachment_fbid"],
+                    "id": attachment["id"],
+                    "url": f"{self.cdn_url}/file/{attachment['id']}.pdf",
+                }
+                for attachment in attachments
+            ],
+        }
+
+
+def sticker(sticker_id: str, cdn_url: str) -> dict[str, Any]:
+    picture = {"uri": f"{cdn_url}/sticker/{sticker_id}.png", "width": 240, "height": 240}
+    return {
+        "id": sticker_id,
+        "pack": {
+            "id": "1",
+            "is_comments_capable": True,
+            "is_composer_capable": True,
+            "is_messenger_capable": True,
+            "is_messenger_kids_capable": False,
+            "is_montage_capable": False,
+            "is_posts_capable": True,
+            "is_sms_capable": False,
+        },
+        "animated_image": None,
+        "preview_image": picture,
+        "thread_image": picture,
+        "sticker_type": "REGULAR",
+        "label": f"Sticker {sticker_id}",
+    }
+
+
+class FakeServers:
+    """The fake Messenger API, CDN and Discord webhooks on one aiohttp app.
+
+    Everything is served from a single port: GraphQL and the Graph API
+    under ``/graphql`` and ``/messaging_get_attachment``, the CDN under
+    ``/cdn`` and webhooks under ``/api/webhooks``.
+    """
+
+    def __init__(self, config: FakeConfig, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.config = config
+        self.host = host
+        self.port = port
+        self.rng = random.Random(0)
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.threads: dict[str, SyntheticThread] = {}
+        self._graphql_windows: dict[str, _Window] = {}
+        self._cdn_window = _Window(config.cdn.rate_limit, config.cdn.window)
+        self._webhook_windows: dict[str, _Window] = {}
+        # CDN paths (after /cdn/) that are answered with 404.
+        self.missing_files: set[str] = set()
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def webhook_urls(self, count: int) -> list[str]:
+        return [f"{self.url}/api/webhooks/{index}/benchmark" for index in range(count)]
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=64 * 2**20)
+        app.router.add_post("/graphql", self.graphql)
+        app.router.add_get("/messaging_get_attachment", self.get_attachment)
+        app.router.add_get("/cdn/{path:.+}", self.cdn)
+        app.router.add_post("/api/webhooks/{id}/{token}", self.webhook)
+        app.router.add_get("/_stats", self.stats)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        cdn_url = f"{self.url}/cdn"
+        self.threads = {
+            str(spec.id): SyntheticThread(spec, cdn_url) for spec in self.config.threads
+        }
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _thread(self, thread_id: str) -> SyntheticThread:
+        try:
+            return self.threads[thread_id]
+        except KeyError:
+            raise web.HTTPNotFound(text=f"Unknown thread {thread_id}")
+
+    async def graphql(self, request: web.Request) -> web.Response:
+        name = request.headers.get("x-fb-friendly-name", "unknown")
+        self.requests[f"graphql {name}"] += 1
+        profile = self.config.graphql
+        await profile.delay(self.rng)
+        token = request.headers.get("authorization", "")
+        allowed, _, _ = self._graphql_windows.setdefault(
+            token, _Window(profile.rate_limit, profile.window)
+        ).take()
+        if not allowed:
+            self.requests["graphql rate limited"] += 1
+            return web.json_response({
+                "error": {
+                    "code": 3252001,
+                    "message": "Rate limit exceeded",
+                    "type": "OAuthException",
+                },
+            })
+        if self.rng.random() < profile.error_rate:
+            self.requests["graphql errors"] += 1
+            return web.json_response(
+                {
+                    "error": {
+                        "code": 1,
+                        "message": "An unknown error occurred",
+                        "type": "OAuthException",
+                        "is_transient": True,
+                    },
+                },
+                status=500,
+            )
+
+        form = await request.post()
+        variables = json.loads(form["variables"])
+        if name == "ThreadQuery":
+            data = {
+                "message_threads": [
+                    self._thread(thread_id).thread() for thread_id in variables["thread_ids"]
+                ],
+            }
+        elif name == "MoreMessagesQuery":
+            thread = self._thread(variables["thread_id"])
+            nodes = thread.page(int(variables["before_time_ms"]), int(variables["msg_count"]))
+            data = {"message_thread": {"messages": {"nodes": nodes}}}
+        elif name == "FetchStickersWithPreviewsQuery":
+            cdn_url = f"{self.url}/cdn"
+            data = {"nodes": [sticker(id, cdn_url) for id in variables["sticker_ids"]]}
+        elif name == "FileAttachmentUrlQuery":
+            msg_id = variables["thread_msg_id"]
+            data = {"message": self._thread(msg_id["thread_id"]).file_url(msg_id["message_id"])}
+        else:
+            raise web.HTTPNotFound(text=f"Unsupported query {name}")
+        return web.json_response({"data": data})
+
+    async def get_attachment(self, request: web.Request) -> web.Response:
+        self.requests["graph messaging_get_attachment"] += 1
+        await self.config.graphql.delay(self.rng)
+        attachment_id = request.query["aid"]
+        raise web.HTTPFound(f"{self.url}/cdn/attachment/{attachment_id}-original.jpg")
+
+    async def cdn(self, request: web.Request) -> web.StreamResponse:
+        self.requests["cdn"] += 1
+        profile = self.config.cdn
+        await profile.delay(self.rng)
+        allowed, _, _ = self._cdn_window.take()
+        if not allowed:
+            self.requests["cdn rate limited"] += 1
+            raise web.HTTPTooManyRequests()
+
+        path = request.match_info["path"]
+        if path in self.missing_files:
+            self.requests["cdn missing"] += 1
+            raise web.HTTPNotFound()
+        size = 64 * 1024
+        if path.startswith(("attachment/", "file/")) and self.threads:
+            size = next(iter(self.threads.values())).spec.attachment_size
+        # Distinct content per path, so files aren't deduplicated by digest.
+        body = (path.encode() * (size // len(path) + 1))[:size]
+
+        resp = web.StreamResponse(headers={"Content-Type": "application/octet-stream"})
+        resp.content_length = size
+        await resp.prepare(request)
+        if self.rng.random() < profile.error_rate:
+            # Drop the connection halfway through the body.
+            self.requests["cdn errors"] += 1
+            await resp.write(body[: size // 2])
+            request.transport.close()
+            return resp
+        self.requests["cdn bytes"] += size
+        await resp.write(body)
+        await resp.write_eof()
+        return resp
+
+    async def webhook(self, request: web.Request) -> web.Response:
+        webhook_id = request.match_info["id"]
+        self.requests["webhook"] += 1
+        profile = self.config.webhook
+        await profile.delay(self.rng)
+        window = self._webhook_windows.setdefault(
+            webhook_id, _Window(profile.rate_limit, profile.window)
+        )
+        allowed, remaining, reset_after = window.take()
+        headers = {
+            "X-RateLimit-Bucket": f"bucket-{webhook_id}",
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+        }
+        if profile.rate_limit:
+            headers["X-RateLimit-Limit"] = str(profile.rate_limit)
+        if not allowed:
+            self.requests["webhook rate limited"] += 1
+            return web.json_response(
+                {"message": "You are being rate limited.", "retry_after": reset_after, "global": False},
+                status=429,
+                headers=headers,
+            )
+        if self.rng.random() < profile.error_rate:
+            self.requests["webhook errors"] += 1
+            return web.Response(status=502, text="<html>Bad Gateway</html>", content_type="text/html")
+
+        filename = "file"
+        size = 0
+        reader = await request.multipart()
+        while part := await reader.next():
+            if part.name == "payload_json":
+                payload = json.loads(await part.text())
+                filename = payload["attachments"][0]["filename"]
+            else:
+                while chunk := await part.read_chunk():
+                    size += len(chunk)
+        self.requests["webhook bytes"] += size
+        attachment_id = self.requests["webhook"]
+        return web.json_response(
+            {
+                "attachments": [{
+                    "id": str(attachment_id),
+                    "filename": filename,
+                    "size": size,
+                    "url": f"{self.url}/cdn/discord/{attachment_id}/{filename}",
+                }],
+            },
+            headers=headers,
+        )
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.requests))
@@ -0,0 +1,76 @@
+"""Benchmark response decoding, deserialization and ``convert_message``.
+
+Reads the ``MoreMessagesQuery`` responses of a cassette written by
+``dump --record-http`` and runs them through the same steps as a dump,
+without the network or database:
+
+    python benchmarks/replay_parse.py cassette.jsonl --repeat 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dumper import convert_message  # noqa: E402
+from maufbapi.http.cassette import Cassette  # noqa: E402
+from maufbapi.types.graphql import MessageList  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("cassette", help="File written by dump --record-http")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the responses")
+    args = parser.parse_args()
+
+    with open(args.cassette) as f:
+        entries = [
+            entry
+            for entry in Cassette.load(f)
+            if entry["friendly_name"] == "MoreMessagesQuery" and entry["status"] == 200
+        ]
+    if not entries:
+        sys.exit("The cassette has no MoreMessagesQuery responses")
+
+    timings = {"decode": 0.0, "deserialize": 0.0, "convert_message": 0.0}
+    messages = 0
+    size = 0
+    for _ in range(args.repeat):
+        for entry in entries:
+            thread_id = int(entry["variables"]["thread_id"])
+
+            started_at = time.perf_counter()
+            body = Cassette.decode_body(entry)
+            data = json.loads(body)["data"]["message_thread"]["messages"]
+            decoded_at = time.perf_counter()
+            message_list = MessageList.deserialize(data)
+            deserialized_at = time.perf_counter()
+            for message in message_list.nodes:
+                convert_message(message, thread_id=thread_id)
+            converted_at = time.perf_counter()
+
+            timings["decode"] += decoded_at - started_at
+            timings["deserialize"] += deserialized_at - decoded_at
+            timings["convert_message"] += converted_at - deserialized_at
+            messages += len(message_list.nodes)
+            size += len(body)
+
+    total = sum(timings.values())
+    print(
+        f"{len(entries)} pages, {messages // args.repeat} messages and "
+        f"{size / args.repeat / 2**20:.1f} MiB of JSON per pass, {args.repeat} passes"
+    )
+    for name, seconds in timings.items():
+        print(
+            f"  {name:16} {seconds:8.3f} s {seconds / total:6.1%} "
+            f"{seconds / messages * 1e6:8.1f} µs/message"
+        )
+    print(f"  {'total':16} {total:8.3f} s        {messages / total:8.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
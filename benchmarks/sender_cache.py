@@ -0,0 +1,117 @@
+"""Benchmark database writes with and without ``SenderCache``.
+
+Writes the rows ``convert_message`` produces for a synthetic thread with a
+handful of senders through ``flush_db_batch`` into a fresh database, once
+queueing a users row with every message as dumps used to and once with
+``SenderCache`` filtering them, then checks both databases have the same
+users and messages:
+
+    python benchmarks/sender_cache.py --messages 200000 --senders 12
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dumper import SenderCache, flush_db_batch  # noqa: E402
+
+_SCHEMA_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database", "schema.sql"
+)
+_THREAD_ID = 1000
+
+
+def make_results(messages: int, senders: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    sender_ids = [str(100000000000000 + i) for i in range(senders)]
+    results = []
+    for i in range(messages):
+        sender_id = rng.choice(sender_ids)
+        results.append({
+            "users": [(sender_id, f"User {sender_id[-3:]}", "")],
+            "message": (
+                f"mid.$benchmark{i:09d}",
+                sender_id,
+                _THREAD_ID,
+                "hello there " * rng.randint(1, 8),
+                1600000000000 + i * 1000,
+                None,
+            ),
+        })
+    return results
+
+
+async def write(path: str, results: list[dict], batch_size: int, cached: bool) -> dict:
+    async with aiosqlite.connect(path) as conn:
+        with open(_SCHEMA_PATH) as f:
+            await conn.executescript(f.read())
+        await conn.execute("INSERT INTO channels (id, name) VALUES (?, ?)", (_THREAD_ID, "benchmark"))
+        await conn.commit()
+
+        started_at = time.perf_counter()
+        sender_cache = await SenderCache(conn).load() if cached else None
+        users_rows = 0
+        for i in range(0, len(results), batch_size):
+            batch = []
+            for result in results[i:i + batch_size]:
+                # flush_db_batch only reads the results, but the cache drops
+                # keys from them, so each run gets its own copies.
+                result = dict(result)
+                if sender_cache:
+                    result = sender_cache.filter(result)
+                users_rows += len(result.get("users", ()))
+                batch.append((None, result))
+            await flush_db_batch(conn, batch)
+        seconds = time.perf_counter() - started_at
+
+        async with conn.execute("SELECT id, name, avatar_url FROM users ORDER BY id") as cursor:
+            users = await cursor.fetchall()
+        async with conn.execute("SELECT COUNT(*) FROM messages") as cursor:
+            (messages,) = await cursor.fetchone()
+    return {"seconds": seconds, "users_rows": users_rows, "users": users, "messages": messages}
+
+
+async def run(args) -> None:
+    results = make_results(args.messages, args.senders, args.seed)
+    runs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, cached in (("every message", False), ("SenderCache", True)):
+            runs[name] = await write(
+                os.path.join(directory, f"{cached}.db"), results, args.batch_size, cached
+            )
+
+    baseline, cached = runs["every message"], runs["SenderCache"]
+    if (baseline["users"], baseline["messages"]) != (cached["users"], cached["messages"]):
+        sys.exit("The databases differ")
+    print(
+        f"{args.messages} messages from {args.senders} senders in batches of "
+        f"{args.batch_size}: {len(cached['users'])} users, databases identical"
+    )
+    for name, run in runs.items():
+        print(
+            f"  {name:14} {run['seconds']:7.3f} s {args.messages / run['seconds']:9.0f} messages/s "
+            f"{run['users_rows']:9d} users rows queued"
+        )
+    print(f"  speedup {baseline['seconds'] / cached['seconds']:.2f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--senders", type=int, default=12)
+    parser.add_argument("--batch-size", type=int, default=1000, help="Results per commit")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
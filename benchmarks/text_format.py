@@ -0,0 +1,169 @@
+"""Micro-benchmark of message text formatting (mentions and markdown escaping).
+
+Compares ``format_message_text`` against the implementation it replaced,
+which is kept here verbatim, on a synthetic corpus of short messages, long
+pasted texts, mentions, emoji and markdown. Outputs are checked to be
+identical before anything is timed:
+
+    python benchmarks/text_format.py --messages 20000
+"""
+from __future__ import annotations
+
+from types import SimpleNamespace
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mautrix.util import utf16_surrogate  # noqa: E402
+
+from dumper import format_message_text  # noqa: E402
+
+_MARKDOWN_ESCAPE_COMMON = r'^>(?:>>)?\s|\[.+\]\(.+\)|^#{1,3}|^\s*-'
+_URL_REGEX = r'(?P<url><[^: >]+:\/[^ >]+>|(?:https?|steam):\/\/[^\s<]+[^<.,:;\"\'\]\s])'
+_MARKDOWN_STOCK_REGEX = fr'(?P<markdown>[_\\~|\*`]|{_MARKDOWN_ESCAPE_COMMON})'
+
+
+def legacy_escape_markdown(text: str) -> str:
+    def replacement(match):
+        groupdict = match.groupdict()
+        is_url = groupdict.get('url')
+        if is_url:
+            return is_url
+        return '\\' + groupdict['markdown']
+
+    regex = _MARKDOWN_STOCK_REGEX
+    regex = f'(?:{_URL_REGEX}|{regex})'
+    return re.sub(regex, replacement, text, 0, re.MULTILINE)
+
+
+def legacy_format_message_text(text: str, ranges) -> str:
+    msg_text = utf16_surrogate.add(text)
+    for m in reversed(ranges):
+        offset = m.offset
+        leng = m.length
+        if not m.entity or not m.entity.id:
+            continue
+        msg_text = f"{msg_text[:offset]}<@{m.entity.id}>{msg_text[offset + leng:]}"
+    return legacy_escape_markdown(utf16_surrogate.remove(msg_text))
+
+
+_WORDS = (
+    "the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet "
+    "hello there how are you doing today see you tomorrow ok sure thanks"
+).split()
+_MARKUP = ("*bold*", "_it_", "~no~", "`x = 1`", "||spoiler||", "a|b", "\\n", "[link](url)")
+_EMOJI = ("😀", "👍🏽", "❤️", "🇫🇮", "é", "日本")
+_LINKS = ("https://example.com/some_path?a=1&b=2", "<https://example.com/x_y>", "http://x.io/a*b")
+
+
+def _range(offset: int, length: int, entity_id: str | None) -> SimpleNamespace:
+    entity = SimpleNamespace(id=entity_id) if entity_id is not None else None
+    return SimpleNamespace(offset=offset, length=length, entity=entity)
+
+
+def make_message(rng: random.Random) -> tuple[str, list[SimpleNamespace]]:
+    kind = rng.random()
+    if kind < 0.05:
+        # Long pasted text.
+        words = rng.randint(300, 3000)
+    elif kind < 0.3:
+        words = rng.randint(20, 100)
+    else:
+        words = rng.randint(1, 15)
+    pieces = []
+    for _ in range(words):
+        roll = rng.random()
+        if roll < 0.04:
+            pieces.append(rng.choice(_MARKUP))
+        elif roll < 0.07:
+            pieces.append(rng.choice(_EMOJI))
+        elif roll < 0.08:
+            pieces.append(rng.choice(_LINKS))
+        elif roll < 0.09:
+            pieces.append(rng.choice(("\n> quote", "\n# heading", "\n- item", "\n")))
+        else:
+            pieces.append(rng.choice(_WORDS))
+    text = " ".join(pieces)
+
+    ranges = []
+    if rng.random() < 0.3:
+        units = len(utf16_surrogate.add(text))
+        for _ in range(rng.randint(1, 8 if words > 100 else 3)):
+            offset = rng.randrange(units + 1)
+            length = rng.randint(0, 12)
+            entity_id = rng.choice((str(rng.randrange(10**14)), None, ""))
+            ranges.append(_range(offset, length, entity_id))
+        if rng.random() < 0.8:
+            # Messenger sends them in order and without overlap.
+            ranges.sort(key=lambda m: m.offset)
+            end = 0
+            for m in ranges:
+                m.offset = max(m.offset, end)
+                m.length = min(m.length, max(units - m.offset, 0))
+                end = m.offset + m.length
+    return text, ranges
+
+
+def outcome(func, text: str, ranges) -> str | type:
+    try:
+        return func(text, ranges)
+    except Exception as e:
+        return type(e)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [make_message(rng) for _ in range(args.messages)]
+    mentions = sum(1 for _, ranges in corpus if ranges)
+    characters = sum(len(text) for text, _ in corpus)
+
+    valid = []
+    for text, ranges in corpus:
+        # Ranges that split a surrogate pair make both fail the same way.
+        expected, actual = outcome(legacy_format_message_text, text, ranges), outcome(
+            format_message_text, text, ranges
+        )
+        if actual != expected:
+            sys.exit(f"Output differs for {text!r} with {ranges!r}:\n{expected!r}\n{actual!r}")
+        if isinstance(expected, str):
+            valid.append((text, ranges))
+    print(
+        f"{len(corpus)} messages ({mentions} with ranges, {characters / 2**20:.1f}M characters): "
+        f"output identical, {len(corpus) - len(valid)} raised the same error in both"
+    )
+    corpus = valid
+    characters = sum(len(text) for text, _ in corpus)
+
+    results = {}
+    for name, func in (
+        ("legacy", legacy_format_message_text),
+        ("format_message_text", format_message_text),
+    ):
+        seconds = min(
+            timeit.repeat(
+                lambda: [func(text, ranges) for text, ranges in corpus],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        results[name] = seconds
+        print(
+            f"  {name:20} {seconds:7.3f} s {seconds / len(corpus) * 1e6:8.2f} µs/message "
+            f"{characters / seconds / 2**20:8.1f}M characters/s"
+        )
+    print(f"  speedup {results['legacy'] / results['format_message_text']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
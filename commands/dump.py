@@ -1,40 +1,79 @@
+import argparse
 import asyncio
 import datetime
+import functools
 import getpass
 import hashlib
 import hmac
-import itertools
-import json
 import mimetypes
 import os
-import random
-import re
+import tempfile
 import time
 import uuid
-from typing import Any, Optional
+from typing import IO, Any
 
-import aiohttp
 import aiosqlite
 from aiohttp.client_exceptions import (
     ClientOSError,
     ClientPayloadError,
-    ContentTypeError,
+    ClientResponseError,
 )
-from mautrix.util import utf16_surrogate
 from mautrix.util.proxy import ProxyHandler
 from tqdm import tqdm
 
+from dumper import (
+    ATTACHMENT_TYPES,
+    TRANSFER_CHUNK_SIZE,
+    AccountPool,
+    AttachmentStore,
+    BackfillCheckpoint,
+    BackfillRun,
+    BackfillShard,
+    Backpressure,
+    LocalStore,
+    MediaCache,
+    Metrics,
+    PageProgress,
+    PageSizer,
+    RawArchive,
+    RunProfiler,
+    SeenIndex,
+    SenderCache,
+    StickerResolver,
+    ThreadProgress,
+    TransferLimits,
+    WebhookStore,
+    chunked,
+    convert_message,
+    count_db_rows,
+    current_rss,
+    flush_db_batch,
+    profiler,
+    serve_metrics,
+    write_metrics_file,
+)
 from maufbapi import AndroidAPI, AndroidState
-from maufbapi.http.errors import RateLimitExceeded, ResponseTypeError, ResponseError
+from maufbapi.http.cassette import Cassette
+from maufbapi.http.errors import ResponseError
+from maufbapi.http.governor import RateGovernor, is_rate_limit_error, last_request_seconds
 from maufbapi.types.graphql import (
     Attachment,
     AttachmentType,
     Message,
+    MessageList,
     MinimalSticker,
     ParticipantNode,
+    Thread,
 )
 
 
+def parse_date_ms(value: str) -> int:
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
 def add_command(subparsers):
     dump_parser = subparsers.add_parser(
         "dump",
@@ -53,22 +92,38 @@ def add_command(subparsers):
         "-l",
         "--latest",
         action="store_true",
-        help="Start from latest message instead of from earliest timestamp",
+        help=(
+            "Only sync new messages: stop at the first page that has nothing "
+            "but already dumped messages, and update the ones that changed"
+        ),
+    )
+    dump_parser.add_argument(
+        "--archive-raw",
+        action="store_true",
+        help=(
+            "Also keep the raw JSON of every message, compressed, so that "
+            "`reprocess` can rebuild messages without fetching them again"
+        ),
     )
     dump_parser.add_argument(
         "-c",
         "--credentials",
         type=str,
-        nargs="?",
-        default=os.path.join(
-            os.path.dirname(
+        nargs="+",
+        default=[
+            os.path.join(
                 os.path.dirname(
-                    __file__
-                )
+                    os.path.dirname(
+                        __file__
+                    )
+                ),
+                ".credentials"
             ),
-            ".credentials"
+        ],
+        help=(
+            "Files to save/read credentials. With several accounts, the pages "
+            "of each thread are fetched with every account that is in it"
         ),
-        help="File to save/read credentials",
     )
     dump_parser.add_argument(
         "-w",
@@ -78,73 +133,273 @@ def add_command(subparsers):
         default=[],
         help="Discord webhook URL (for preserving attachments)",
     )
+    dump_parser.add_argument(
+        "-s",
+        "--store-dir",
+        type=str,
+        required=False,
+        help=(
+            "Directory to save attachments to instead of uploading them to "
+            "webhooks (see `export --store-dir`)"
+        ),
+    )
     dump_parser.add_argument(
         "-m",
         "--messages-per-fetch",
         type=int,
         default=95,
         required=False,
-        help="Number of messages to fetch each time",
+        help=(
+            "Number of messages to fetch each time (the starting point with "
+            "--adaptive-page-size)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--adaptive-page-size",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help=(
+            "Grow the number of messages per fetch while the API keeps up, and "
+            "shrink it on timeouts and errors"
+        ),
+    )
+    dump_parser.add_argument(
+        "--min-messages-per-fetch",
+        type=int,
+        default=20,
+        required=False,
+        help="Smallest number of messages per fetch with --adaptive-page-size",
+    )
+    dump_parser.add_argument(
+        "--max-messages-per-fetch",
+        type=int,
+        default=500,
+        required=False,
+        help="Largest number of messages per fetch with --adaptive-page-size",
+    )
+    dump_parser.add_argument(
+        "--fetch-timeout",
+        type=float,
+        default=60.0,
+        required=False,
+        help=(
+            "Seconds to wait for a page with --adaptive-page-size before "
+            "retrying with a smaller one"
+        ),
+    )
+    dump_parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=int,
+        default=3,
+        required=False,
+        help="Number of threads to dump at the same time",
+    )
+    dump_parser.add_argument(
+        "--max-requests-per-minute",
+        type=int,
+        default=0,
+        required=False,
+        help=(
+            "Upper bound on GraphQL requests per minute for each account, "
+            "shared by all threads being dumped (0 for no limit)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--initial-requests-per-minute",
+        type=float,
+        default=120,
+        required=False,
+        help=(
+            "GraphQL requests per minute to start at; the rate is adjusted "
+            "to what the API allows as the dump goes on"
+        ),
     )
 
-    return dump_parser
-
-
-_MARKDOWN_ESCAPE_SUBREGEX = '|'.join(r'\{0}(?=([\s\S]*((?<!\{0})\{0})))'.format(c) for c in ('*', '`', '_', '~', '|'))
-
-_MARKDOWN_ESCAPE_COMMON = r'^>(?:>>)?\s|\[.+\]\(.+\)|^#{1,3}|^\s*-'
-
-_MARKDOWN_ESCAPE_REGEX = re.compile(fr'(?P<markdown>{_MARKDOWN_ESCAPE_SUBREGEX}|{_MARKDOWN_ESCAPE_COMMON})', re.MULTILINE)
-
-_URL_REGEX = r'(?P<url><[^: >]+:\/[^ >]+>|(?:https?|steam):\/\/[^\s<]+[^<.,:;\"\'\]\s])'
-
-_MARKDOWN_STOCK_REGEX = fr'(?P<markdown>[_\\~|\*`]|{_MARKDOWN_ESCAPE_COMMON})'
-
-
-def escape_markdown(text: str, *, as_needed: bool = False, ignore_links: bool = True) -> str:
-    r"""A helper function that escapes Discord's markdown.
+    dump_parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        required=False,
+        help=(
+            "Split the history of each thread into this many time windows and "
+            "fetch them at the same time (at least one per account in the "
+            "thread). A window that runs out of messages takes over half of "
+            "what's left of the busiest one. Interrupted runs resume the same "
+            "windows."
+        ),
+    )
+    dump_parser.add_argument(
+        "--shard-since",
+        type=parse_date_ms,
+        default="2008-01-01",
+        required=False,
+        help=(
+            "Date (YYYY-MM-DD) that the oldest shard starts at; older messages "
+            "are still fetched, by the oldest shard"
+        ),
+    )
 
-    Parameters
-    -----------
-    text: :class:`str`
-        The text to escape markdown from.
-    as_needed: :class:`bool`
-        Whether to escape the markdown characters as needed. This
-        means that it does not escape extraneous characters if it's
-        not necessary, e.g. ``**hello**`` is escaped into ``\*\*hello**``
-        instead of ``\*\*hello\*\*``. Note however that this can open
-        you up to some clever syntax abuse. Defaults to ``False``.
-    ignore_links: :class:`bool`
-        Whether to leave links alone when escaping markdown. For example,
-        if a URL in the text contains characters such as ``_`` then it will
-        be left alone. This option is not supported with ``as_needed``.
-        Defaults to ``True``.
+    dump_parser.add_argument(
+        "--record-http",
+        type=str,
+        required=False,
+        help=(
+            "Append every GraphQL request and its raw response to this file "
+            "(with access tokens scrubbed), for --replay-http"
+        ),
+    )
+    dump_parser.add_argument(
+        "--replay-http",
+        type=str,
+        required=False,
+        help=(
+            "Answer GraphQL requests from a file written by --record-http "
+            "instead of Facebook. Attachments can't be replayed, so use it "
+            "without webhooks or a store directory"
+        ),
+    )
 
-    Returns
-    --------
-    :class:`str`
-        The text with the markdown special characters escaped with a slash.
-    """
+    dump_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        required=False,
+        help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics",
+    )
+    dump_parser.add_argument(
+        "--metrics-file",
+        type=str,
+        required=False,
+        help="JSON file to keep rewriting with the current metrics",
+    )
+    dump_parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        required=False,
+        help="Seconds between rewrites of --metrics-file",
+    )
 
-    if not as_needed:
+    dump_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print how much wall and CPU time went to each stage of the dump at exit",
+    )
+    dump_parser.add_argument(
+        "--profile-output",
+        type=str,
+        required=False,
+        help=(
+            "Profile the whole run and save it to this file (pstats for cProfile; "
+            "text, or HTML if the name ends in .html, for the sampling profiler)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--profiler",
+        choices=("cprofile", "sampling"),
+        default="cprofile",
+        help="Profiler for --profile-output; sampling needs pyinstrument",
+    )
 
-        def replacement(match):
-            groupdict = match.groupdict()
-            is_url = groupdict.get('url')
-            if is_url:
-                return is_url
-            return '\\' + groupdict['markdown']
+    dump_parser.add_argument(
+        "--seen-index-max-ids",
+        type=int,
+        default=1_000_000,
+        required=False,
+        help=(
+            "Maximum number of already dumped message/attachment IDs to keep in "
+            "memory per thread; bigger threads are checked against the database"
+        ),
+    )
+    dump_parser.add_argument(
+        "--seen-index-bloom",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Use a Bloom filter to skip database lookups for new IDs in big threads",
+    )
+    dump_parser.add_argument(
+        "--attachment-workers",
+        type=int,
+        default=16,
+        required=False,
+        help="Number of messages whose attachments are processed at the same time",
+    )
+    dump_parser.add_argument(
+        "--max-downloads",
+        type=int,
+        default=8,
+        required=False,
+        help="Number of files downloaded from Facebook at the same time (0 for no limit)",
+    )
+    dump_parser.add_argument(
+        "--max-url-lookups",
+        type=int,
+        default=4,
+        required=False,
+        help=(
+            "Number of full size image and file URL lookups sent to Facebook at "
+            "the same time (0 for no limit)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--max-uploads",
+        type=int,
+        default=4,
+        required=False,
+        help="Number of files uploaded or saved at the same time (0 for no limit)",
+    )
+    dump_parser.add_argument(
+        "--db-queue-size",
+        type=int,
+        default=20_000,
+        required=False,
+        help=(
+            "Number of pending database writes at which fetching pauses until "
+            "the database catches up (0 for no limit)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--attachment-queue-size",
+        type=int,
+        default=2_000,
+        required=False,
+        help=(
+            "Number of messages with pending attachments at which fetching "
+            "pauses until uploads catch up (0 for no limit)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=0,
+        required=False,
+        help=(
+            "Memory use (RSS) in MiB at which fetching pauses while there is "
+            "queued work left (0 for no limit)"
+        ),
+    )
+    dump_parser.add_argument(
+        "--db-batch-size",
+        type=int,
+        default=500,
+        required=False,
+        help="Number of rows to collect before committing them in one transaction",
+    )
+    dump_parser.add_argument(
+        "--db-batch-interval",
+        type=float,
+        default=1.0,
+        required=False,
+        help="Maximum number of seconds to hold rows before committing them",
+    )
 
-        regex = _MARKDOWN_STOCK_REGEX
-        if ignore_links:
-            regex = f'(?:{_URL_REGEX}|{regex})'
-        return re.sub(regex, replacement, text, 0, re.MULTILINE)
-    else:
-        text = re.sub(r'\\', r'\\\\', text)
-        return _MARKDOWN_ESCAPE_REGEX.sub(r'\\\1', text)
+    return dump_parser
 
 
-async def get_credentials(credentials_filename) -> tuple[AndroidState, AndroidAPI]:
+async def get_credentials(
+    credentials_filename, cassette: Cassette | None = None
+) -> tuple[AndroidState, AndroidAPI]:
     def generate_state() -> AndroidState:
         state = AndroidState()
         state.session.region_hint = "ODN"
@@ -166,12 +421,14 @@ async def get_credentials(credentials_filename) -> tuple[AndroidState, AndroidAP
             api = AndroidAPI(
                 state,
                 proxy_handler=ProxyHandler(None),
+                cassette=cassette,
             )
     else:
         state = generate_state()
         api = AndroidAPI(
             state,
             proxy_handler=ProxyHandler(None),
+            cassette=cassette,
         )
 
         print("Generating config...")
@@ -198,160 +455,233 @@ async def reupload_fb_file(
     client: AndroidAPI,
     url: str,
     filename: str,
-    webhook_url: str,
+    store: AttachmentStore,
     *,
-    referer: str = "unknown"
+    referer: str = "unknown",
+    media_cache: MediaCache | None = None,
+    source_id: str | None = None,
+    limits: TransferLimits | None = None,
 ) -> None | tuple[str, str]:
-    def parse_ratelimit_header(request: Any, *, use_clock: bool = False) -> float:
-        reset: Optional[str] = request.headers.get("X-Ratelimit-Reset")
-        reset_after: Optional[str] = request.headers.get('X-Ratelimit-Reset-After')
-        if not reset:
-            # We raped Discord's servers too hard
-            return 60.0
-        if use_clock or not reset_after:
-            utc = datetime.timezone.utc
-            now = datetime.datetime.now(utc)
-            reset = datetime.datetime.fromtimestamp(float(reset), utc)
-            return (reset - now).total_seconds()
-        else:
-            return float(reset_after)
-        
+    if media_cache and source_id:
+        async with media_cache.claim(source_id):
+            if stored := await media_cache.get_source(source_id):
+                return stored
+            return await _reupload_fb_file(
+                client,
+                url,
+                filename,
+                store,
+                referer=referer,
+                media_cache=media_cache,
+                source_id=source_id,
+                limits=limits,
+            )
+    return await _reupload_fb_file(
+        client,
+        url,
+        filename,
+        store,
+        referer=referer,
+        media_cache=media_cache,
+        limits=limits,
+    )
+
+
+# Downloads are kept in memory up to this size before they spill over into a
+# temporary file.
+_SPOOL_MAX_SIZE = 1024 * 1024
+_MAX_UPLOAD_SIZE = 25_000_000  # 25 MiB being maximum upload size for Discord
+
+
+async def download_fb_file(
+    client: AndroidAPI,
+    url: str,
+    *,
+    referer: str = "unknown",
+    limits: TransferLimits | None = None,
+) -> None | tuple[IO[bytes], str, int]:
+    """Download a file into a spooled temporary file.
+
+    Returns the file (which the caller must close), the SHA-256 digest of
+    its contents and its size, or None if the file is too large to upload.
+    Error responses other than rate limits and server errors aren't retried
+    and raise ``ClientResponseError``, and the other errors are raised once
+    retrying didn't help, so that the caller knows to try again later.
+    """
+    limits = limits or TransferLimits()
     attempts = 0
     while True:
-        if attempts > 10:
-            print(f"[ERROR] Could not download attachment {filename} with URL {url}")
-            return None
-
+        file = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+        digest = hashlib.sha256()
+        size = 0
+        downloaded = False
         try:
-            async with client.raw_http_get(
+            async with limits.download, profiler.async_stage("download"), client.raw_http_get(
                 url, 
                 headers={"referer": f"fbapp://{client.state.application.client_id}/{referer}"},
                 sandbox=False,
             ) as resp:
-                length = int(resp.headers["Content-Length"])
-                if length > 25_000_000: # 25 MiB being maximum upload size for Discord
+                # An error page must not end up stored as the attachment.
+                resp.raise_for_status()
+                length = int(resp.headers.get("Content-Length", 0))
+                if length > _MAX_UPLOAD_SIZE:
                     return None
 
-                attachment_data = await resp.read()
-                break
-        except (ClientPayloadError, ClientOSError, asyncio.TimeoutError):
-            await asyncio.sleep(2 ** attempts)  # exponential backoff
-            attempts += 1
-            continue
-
-    form_data = aiohttp.FormData(quote_fields=False)
-    form_data.add_field("files[0]", attachment_data, filename=filename, content_type="application/octet-stream")
-    form_data.add_field("payload_json", json.dumps({
-        "attachments": [
-            {
-                "id": 0,
-                "filename": filename,
-            }
-        ],
-        "content": "",
-    }))
+                async for chunk in resp.content.iter_chunked(TRANSFER_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > _MAX_UPLOAD_SIZE:
+                        return None
+                    digest.update(chunk)
+                    file.write(chunk)
+                    limits.download.bytes += len(chunk)
+            downloaded = True
+            return file, digest.hexdigest(), size
+        except (ClientResponseError, ClientPayloadError, ClientOSError, asyncio.TimeoutError) as e:
+            if isinstance(e, ClientResponseError) and e.status != 429 and e.status < 500:
+                raise
+            if attempts >= 10:
+                print(f"[ERROR] Could not download attachment with URL {url}")
+                raise
+        finally:
+            # Only a complete download is handed over to the caller.
+            if not downloaded:
+                file.close()
+        await asyncio.sleep(2 ** attempts)  # exponential backoff
+        attempts += 1
+
+
+async def _reupload_fb_file(
+    client: AndroidAPI,
+    url: str,
+    filename: str,
+    store: AttachmentStore,
+    *,
+    referer: str = "unknown",
+    media_cache: MediaCache | None = None,
+    source_id: str | None = None,
+    limits: TransferLimits | None = None,
+) -> None | tuple[str, str]:
+    limits = limits or TransferLimits()
+    downloaded = await download_fb_file(client, url, referer=referer, limits=limits)
+    if not downloaded:
+        return None
 
-    multipart_writer = form_data._gen_form_data()
-    
-    while True:
-        resp = await client.http_post(webhook_url, data=multipart_writer)
-        reset_after = parse_ratelimit_header(resp)
-        try:
-            data = await resp.json()
-        except ContentTypeError:
-            await asyncio.sleep(reset_after)
-            continue
+    file, digest, size = downloaded
+    with file:
+        if not media_cache:
+            async with limits.upload, profiler.async_stage("upload"):
+                stored = await store.store(file, size, digest, filename)
+            if stored:
+                limits.upload.bytes += size
+            return stored
+
+        async with media_cache.claim(digest):
+            if not (stored := await media_cache.get(digest)):
+                async with limits.upload, profiler.async_stage("upload"):
+                    stored = await store.store(file, size, digest, filename)
+                if not stored:
+                    return None
+                limits.upload.bytes += size
+            media_cache.remember(digest, stored, source_id)
+            return stored
 
-        if "attachments" not in data:
-            if "retry_after" in data:
-                await asyncio.sleep(reset_after)
-                continue
-            else:
-                return None
-        return data["attachments"][0]["filename"], data["attachments"][0]["url"]
-    
 
 async def convert_sticker(
     client: AndroidAPI,
     sticker: MinimalSticker,
-    webhook_url: str,
+    store: AttachmentStore,
+    *,
+    sticker_resolver: StickerResolver,
+    media_cache: MediaCache | None = None,
+    limits: TransferLimits | None = None,
 ) -> None | dict[str, Any]:
-    try:
-        resp = await client.fetch_stickers([int(sticker.id)], sticker_labels_enabled=True)
-    except ResponseTypeError:
-       return None 
-    sticker = resp.nodes[0]
-
-    if sticker.animated_image:
-        image = sticker.animated_image
-        extension = "gif"
-    else:
-        image = sticker.thread_image
-        extension = "png"
-    url = image.uri
+    info = await sticker_resolver.resolve(sticker.id)
+    if not info:
+        return None
 
     reuploaded_url = await reupload_fb_file(
         client,
-        url,
-        f"sticker-{sticker.id}.{extension}",
-        webhook_url,
-        referer=""
+        info["uri"],
+        f"sticker-{sticker.id}.{info['extension']}",
+        store,
+        referer="",
+        media_cache=media_cache,
+        source_id=f"sticker:{sticker.id}",
+        limits=limits,
     )
+    if not reuploaded_url:
+        return None
+
     return {
         "url": reuploaded_url[1],
         "name": reuploaded_url[0],
-        "width": image.width,
-        "height": image.height,
-    } if reuploaded_url else None
+        "width": info["width"],
+        "height": info["height"],
+    }
 
 
 async def convert_attachment(
     client: AndroidAPI,
     attachment: Attachment,
-    webhook_url: str,
+    store: AttachmentStore,
     *,
     thread_id: str | int,
     message_id: str,
+    media_cache: MediaCache | None = None,
+    limits: TransferLimits | None = None,
 ) -> dict[str, Any] | None:
+    limits = limits or TransferLimits()
     filename = attachment.filename
     referer = "unknown"
     if attachment.mimetype and "." not in filename:
         filename += mimetypes.guess_extension(attachment.mimetype)
 
+    attachment_type = ATTACHMENT_TYPES.get(attachment.typename)
+    if not attachment_type:
+        print(f"[WARN] Unsupported attachment type {attachment.typename}")
+        return None
+
+    source_id = f"attachment:{attachment.id}"
+    if media_cache and (reuploaded_url := await media_cache.get_source(source_id)):
+        # Already stored, so there's no need to look up the download URL either.
+        return {
+            "url": reuploaded_url[1],
+            "name": reuploaded_url[0],
+            "type": attachment_type,
+            "id": attachment.id,
+        }
+
     if attachment.typename in (AttachmentType.IMAGE, AttachmentType.ANIMATED_IMAGE):
         if attachment.typename == AttachmentType.IMAGE:
             full_screen = attachment.image_full_screen
             width = attachment.original_dimensions.x
             height = attachment.original_dimensions.y
-            attachment_type = "image"
         else:
             full_screen = attachment.animated_image_full_screen
             width = attachment.animated_image_original_dimensions.x
             height = attachment.animated_image_original_dimensions.y
-            attachment_type = "gif"
         url = full_screen.uri
         if (width, height) > full_screen.dimensions:
-            url = await client.get_image_url(message_id, attachment.attachment_fbid) or url
+            async with limits.lookup, profiler.async_stage("URL lookup"):
+                url = await client.get_image_url(message_id, attachment.attachment_fbid) or url
         referer = "messenger_thread_photo"
     elif attachment.typename == AttachmentType.AUDIO:
         url = attachment.playable_url
-        attachment_type = "audioclip"
     elif attachment.typename == AttachmentType.VIDEO:
         url = attachment.attachment_video_url
-        attachment_type = "video"
-    elif attachment.typename == AttachmentType.FILE:
-        url = await client.get_file_url(thread_id, message_id, attachment.attachment_fbid)
-        attachment_type = "file"
-    else: 
-        print(f"[WARN] Unsupported attachment type {attachment.typename}")
-        return None
+    else:
+        async with limits.lookup, profiler.async_stage("URL lookup"):
+            url = await client.get_file_url(thread_id, message_id, attachment.attachment_fbid)
 
     reuploaded_url = await reupload_fb_file(
         client,
         url,
         filename,
-        webhook_url,
-        referer=referer
+        store,
+        referer=referer,
+        media_cache=media_cache,
+        source_id=source_id,
+        limits=limits,
     )
     return {
         "url": reuploaded_url[1],
@@ -364,208 +694,834 @@ async def convert_attachment(
 async def db_worker(
     queue: asyncio.Queue,
     conn: aiosqlite.Connection,
-    pbar: tqdm,
+    *,
+    batch_size: int = 1,
+    batch_interval: float = 0.0,
+    metrics: Metrics | None = None,
 ):
-    while True:
-        result = await queue.get()
-        
-        if "users" in result:
-            # Not updating existing users, since MinimalParticipants are less
-            # complete.
-            await conn.executemany(
-                (
-                    "INSERT INTO users(id, name, avatar_url) VALUES (?, ?, ?) "
-                    "ON CONFLICT DO NOTHING"
-                ),
-                result["users"],
-            )
-        if "message" in result:
-            # It's very likely that the new version of the message has the same data
-            # or less (if it was unsent), since Messenger doesn't allow editing
-            # messages.
-            await conn.execute(
-                (
-                    "INSERT INTO messages(id, sender_id, channel_id, text, timestamp, unsent_timestamp) "
-                    "VALUES (?, ?, ?, ?, ? ,?) "
-                    "ON CONFLICT DO NOTHING"
-                ),
-                result["message"],
-            )
-        if "replied_to" in result:
-            # Same reason why messages are not updated; you can't switch what a message
-            # is replying to.
-            await conn.execute(
-                (
-                    "INSERT INTO replied_to(message_id, replied_to_id) VALUES (?, ?)"
-                    "ON CONFLICT DO NOTHING"
-                ),
-                result["replied_to"],
-            )
-        if "attachments" in result:
-            await conn.executemany(
-                (
-                    "INSERT INTO attachments(id, message_id, name, type, url, width, height) "
-                    "VALUES(?, ?, ?, ?, ?, ?, ?) "
-                    "ON CONFLICT DO NOTHING"
-                ),
-                result["attachments"],
-            )
-        if "reactions" in result:
-            await conn.executemany(
-                (
-                    "INSERT INTO reactions(message_id, emoji, count) VALUES (?, ?, ?) "
-                    "ON CONFLICT (message_id, emoji) DO UPDATE SET count=excluded.count"
-                ),
-                result["reactions"]
-            )  
+    """Write queued results to the database in batches (group commit).
 
-        await conn.commit()
-        if "message" in result:
-            pbar.update(1)
-        queue.task_done()
+    Items are collected until ``batch_size`` rows are pending or the oldest
+    pending item has waited ``batch_interval`` seconds, whichever comes
+    first. An empty queue always flushes once the interval runs out, so
+    ``queue.join()`` never waits for longer than that. With a batch size of 1
+    every item is committed on its own.
+    """
+    batch = []
+    pending_rows = 0
+    deadline = 0.0
+
+    async def flush():
+        nonlocal batch, pending_rows
+        if not batch:
+            return
+        flushed, batch, pending_rows = batch, [], 0
+        await flush_db_batch(conn, flushed, metrics)
+        for _ in flushed:
+            queue.task_done()
+
+    try:
+        while True:
+            if not batch:
+                item = await queue.get()
+                deadline = time.monotonic() + batch_interval
+            else:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    # Linger until the deadline so that rows arriving in the
+                    # meantime join this batch. Not using wait_for(), since it
+                    # can swallow a cancellation that races with a new item.
+                    if (timeout := deadline - time.monotonic()) > 0:
+                        await asyncio.sleep(timeout)
+                    if queue.empty():
+                        await flush()
+                    continue
+
+            batch.append(item)
+            pending_rows += count_db_rows(item[1])
+            if pending_rows >= batch_size or time.monotonic() >= deadline:
+                await flush()
+    except asyncio.CancelledError:
+        # Don't lose anything that was already handed to the writer.
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        await flush()
+        raise
 
 
 async def attachment_worker(
     queue: asyncio.Queue,
     db_queue: asyncio.Queue,
-    client: AndroidAPI,
-    thread_id: str | int,
-    webhook_urls: list[str],
-    fetched_attachment_ids: list[str],
+    accounts: AccountPool,
+    store: AttachmentStore,
     attachment_pbar: tqdm,
+    sticker_resolver: StickerResolver,
+    media_cache: MediaCache | None = None,
+    limits: TransferLimits | None = None,
 ):
     while True:
-        message: Message = await queue.get()
+        # Only the attachments in new_attachment_ids are not in the database yet.
+        progress, (message, new_attachment_ids) = await queue.get()
+        message: Message
+        thread_id = progress.thread_id
+        # File URLs can only be looked up by members of the thread.
+        client = accounts.pick(thread_id)
         result = {}
+        try:
+            if message.sticker and message.sticker.id in new_attachment_ids:
+                if "attachments" not in result:
+                    result["attachments"] = []
+
+                converted_sticker = await convert_sticker(
+                    client,
+                    message.sticker,
+                    store,
+                    sticker_resolver=sticker_resolver,
+                    media_cache=media_cache,
+                    limits=limits,
+                )
+            
+                if converted_sticker:
+                    result["attachments"].append(
+                        (
+                            message.sticker.id,
+                            message.message_id,
+                            converted_sticker["name"],
+                            "sticker",
+                            converted_sticker["url"],
+                            converted_sticker["width"],
+                            converted_sticker["height"],
+                        )
+                    )
+        
+            if len(message.blob_attachments) > 0:
+                if "attachments" not in result:
+                    result["attachments"] = []
+            
+                attachments = await asyncio.gather(
+                    *[
+                        convert_attachment(
+                            client,
+                            attachment,
+                            store,
+                            thread_id=thread_id,
+                            message_id=message.message_id,
+                            media_cache=media_cache,
+                            limits=limits,
+                        )
+                        for attachment in message.blob_attachments
+                        if attachment.id in new_attachment_ids
+                    ],
+                    # The others are still written if one of them fails.
+                    return_exceptions=True,
+                )
+                error = None
+                for attachment in attachments:
+                    if isinstance(attachment, BaseException):
+                        error = error or attachment
+                        continue
+                    if not attachment:
+                        continue
+                    url = attachment["url"]
+                    name = attachment["name"]
+                    attachment_type = attachment["type"]
+                    attachment_id = attachment["id"]
+                    result["attachments"].append(
+                        (
+                            attachment_id,
+                            message.message_id,
+                            name,
+                            attachment_type,
+                            url,
+                            None,
+                            None,
+                        )
+                    )
+                if error:
+                    raise error
+        except Exception as e:
+            print(f"[WARN] Failed to store attachments of message {message.message_id}: {e!r}")
+            progress.fail()
+        finally:
+            # Whatever was stored is still written, and the thread isn't
+            # left waiting for this message.
+            progress.add()
+            db_queue.put_nowait((progress, result))
+            attachment_pbar.update(len(result.get("attachments", [])))
+            progress.done()
+            queue.task_done()
+
+
+def observe_graphql(
+    metrics: Metrics,
+    name: str,
+    seconds: float,
+    error: BaseException | None,
+) -> None:
+    if error is None:
+        outcome = "ok"
+    elif isinstance(error, ResponseError) and is_rate_limit_error(error):
+        outcome = "rate_limited"
+    else:
+        outcome = type(error).__name__
+    metrics.observe("graphql_request_seconds", seconds, query=name)
+    metrics.inc("graphql_requests_total", query=name, outcome=outcome)
+    if profiler.enabled:
+        profiler.record(f"graphql {name}", seconds)
 
-        if message.sticker and message.sticker.id not in fetched_attachment_ids:
-            if "attachments" not in result:
-                result["attachments"] = []
 
-            converted_sticker = await convert_sticker(
-                client,
-                message.sticker,
-                random.choice(webhook_urls),
+def register_metrics(
+    metrics: Metrics,
+    *,
+    accounts: AccountPool,
+    queues: dict[str, asyncio.Queue | None],
+    limits: TransferLimits,
+    store: AttachmentStore | None,
+) -> None:
+    metrics.describe("pages_total", "Pages of messages fetched")
+    metrics.describe("messages_total", "New messages fetched")
+    metrics.meter("messages_total", "New messages fetched per second, over the last minute")
+    metrics.describe("changed_messages_total", "Known messages found to have changed")
+    metrics.describe("graphql_request_seconds", "GraphQL request latency by friendly name")
+    metrics.describe("graphql_requests_total", "GraphQL requests by friendly name and outcome")
+    metrics.describe("db_commit_seconds", "Time taken to write and commit a batch of rows")
+    metrics.describe("db_rows_total", "Rows written to the database")
+
+    governors = [api.governor for api in accounts.apis]
+    metrics.gauge(
+        "graphql_rate_per_minute",
+        lambda: sum(governor.rate for governor in governors) * 60,
+        "GraphQL requests per minute currently allowed by the governors of all accounts",
+    )
+    metrics.counter(
+        "graphql_rate_limits_total",
+        lambda: sum(governor.rate_limits for governor in governors),
+        "Rate limits hit, each followed by a pause",
+    )
+    metrics.counter(
+        "graphql_wait_seconds_total",
+        lambda: sum(governor.waited_seconds for governor in governors),
+        "Total time GraphQL requests waited for the governor",
+    )
+    metrics.gauge(
+        "queue_depth",
+        lambda: {name: queue.qsize() for name, queue in queues.items() if queue},
+        "Items waiting in each pipeline queue",
+    )
+    metrics.gauge(
+        "transfers_active",
+        lambda: {name: limit.active for name, limit in limits.items().items()},
+        "Attachment transfers in progress",
+    )
+    metrics.counter(
+        "transfer_bytes_total",
+        lambda: {"downloads": limits.download.bytes, "uploads": limits.upload.bytes},
+        "Attachment bytes downloaded from Facebook and uploaded or saved",
+        label="direction",
+    )
+    if isinstance(store, WebhookStore):
+        metrics.counter(
+            "webhook_rate_limits_total",
+            lambda: store.pool.rate_limited,
+            "429 responses from Discord webhooks",
+        )
+    metrics.gauge("memory_bytes", lambda: current_rss() or 0, "Resident set size")
+
+
+async def report_pipeline_stats(
+    backpressure: Backpressure,
+    limits: TransferLimits,
+    pbar: tqdm,
+    interval: float = 1.0,
+):
+    while True:
+        postfix = {
+            f"{name} queue": depth
+            for name, depth in backpressure.depths().items()
+        }
+        postfix.update((name, str(limit)) for name, limit in limits.items().items())
+        if rss := current_rss():
+            postfix["memory"] = f"{rss // 2**20} MiB"
+        pbar.set_postfix(postfix)
+        await asyncio.sleep(interval)
+
+
+async def dump_thread(
+    args,
+    conn: aiosqlite.Connection,
+    accounts: AccountPool,
+    thread_id: int,
+    *,
+    position: int,
+    db_queue: asyncio.Queue,
+    attachment_queue: asyncio.Queue | None,
+    attachment_pbar: tqdm | None,
+    media_cache: MediaCache | None,
+    sticker_resolver: StickerResolver | None,
+    sender_cache: SenderCache,
+    store: AttachmentStore | None,
+    backpressure: Backpressure,
+    limits: TransferLimits,
+    metrics: Metrics,
+):
+    real_thread_id = thread_id
+
+    thread_info = await accounts.fetch_thread_info(thread_id)
+    if not thread_info:
+        print(
+            f"[ERROR] Could not retrieve thread information for ID {thread_id}"
+        )
+        return
+    elif thread_info[0].thread_key.id != thread_id:
+        print(
+            f"[WARN] Response contained different ID "
+            f"({thread_info[0].thread_key.id}) than expected {thread_id}"
+        )
+        real_thread_id = thread_info[0].thread_key.id
+
+    if real_thread_id is None:
+        print(
+            "[ERROR] Received thread ID was null??? Not dumping this channel."
+        )
+        return
+
+    info = thread_info[0]
+    progress = ThreadProgress(
+        real_thread_id,
+        tqdm(
+            total=info.messages_count,
+            position=position,
+            unit="messages",
+            desc=(info.name or str(real_thread_id))[:20],
+        ),
+    )
+    try:
+        await backfill_thread(
+            args,
+            conn,
+            accounts,
+            info,
+            thread_id,
+            progress,
+            db_queue=db_queue,
+            attachment_queue=attachment_queue,
+            attachment_pbar=attachment_pbar,
+            media_cache=media_cache,
+            sticker_resolver=sticker_resolver,
+            sender_cache=sender_cache,
+            store=store,
+            backpressure=backpressure,
+            limits=limits,
+            metrics=metrics,
+        )
+        await progress.wait()
+        if progress.failed:
+            print(
+                f"[WARN] {info.name} ({real_thread_id}): attachments of {progress.failed} "
+                f"pages could not be stored, so the checkpoint stops before them and "
+                f"the next run tries them again"
             )
-            
-            result["attachments"].append(
-                (
-                    message.sticker.id,
-                    message.message_id,
-                    converted_sticker["name"],
-                    "sticker",
-                    converted_sticker["url"],
-                    converted_sticker["width"],
-                    converted_sticker["height"],
-                )
+    finally:
+        progress.pbar.close()
+
+
+async def backfill_thread(
+    args,
+    conn: aiosqlite.Connection,
+    accounts: AccountPool,
+    info: Thread,
+    thread_id: int,
+    progress: ThreadProgress,
+    *,
+    db_queue: asyncio.Queue,
+    attachment_queue: asyncio.Queue | None,
+    attachment_pbar: tqdm | None,
+    media_cache: MediaCache | None,
+    sticker_resolver: StickerResolver | None,
+    sender_cache: SenderCache,
+    store: AttachmentStore | None,
+    backpressure: Backpressure,
+    limits: TransferLimits,
+    metrics: Metrics,
+):
+    real_thread_id = progress.thread_id
+    progress.add()
+    db_queue.put_nowait((progress, {"channel": (real_thread_id, info.name or "No name")}))
+
+    print(f"[INFO] Fetching users for thread {info.name} ({real_thread_id})")
+    async def user_data_worker(pcp: ParticipantNode):
+        actor = pcp.messaging_actor
+        name = (
+            actor.structured_name.text 
+            if actor.structured_name
+            else (
+                actor.nickname_for_viewer 
+                or actor.username 
+                or "Facebook user"
             )
+        )
+        profile_picture = None
+        if (fb_profile_pic := (
+            actor.profile_pic_large 
+            or actor.profile_pic_medium
+            or actor.profile_pic_small
+        )) and store:
+            url = fb_profile_pic.uri
+            try:
+                reuploaded = await reupload_fb_file(
+                    accounts.pick(real_thread_id),
+                    url,
+                    f"profile_picture-{pcp.id}.jpg",
+                    store,
+                    media_cache=media_cache,
+                    limits=limits,
+                )
+            except Exception as e:
+                # Participants are written again on every run, so the
+                # picture is tried again then.
+                print(f"[WARN] Failed to store the profile picture of {pcp.id}: {e!r}")
+                reuploaded = None
+            profile_picture = reuploaded[1] if reuploaded else None
+        return int(pcp.id), name, profile_picture
+
+    users_rows = await asyncio.gather(
+        *[user_data_worker(pcp) for pcp in info.all_participants.nodes]
+    )
+    progress.add()
+    db_queue.put_nowait((progress, {"participants": users_rows}))
+    sender_cache.add(*(row[0] for row in users_rows))
+
+    message_index = await SeenIndex(
+        conn,
+        count_query="SELECT COUNT(*) FROM messages WHERE channel_id = ?",
+        load_query="SELECT id FROM messages WHERE channel_id = ?",
+        lookup_query="SELECT id FROM messages WHERE id IN ({})",
+        params=(real_thread_id,),
+        max_ids=args.seen_index_max_ids,
+        bloom=args.seen_index_bloom,
+    ).load()
+    attachment_index = None
+    if attachment_queue:
+        # Attachment IDs are unique across all channels (stickers are shared),
+        # so misses from the channel's own set are double-checked in the table.
+        attachment_index = await SeenIndex(
+            conn,
+            count_query=(
+                "SELECT COUNT(*) FROM attachments "
+                "JOIN messages ON messages.id = attachments.message_id "
+                "WHERE messages.channel_id = ?"
+            ),
+            load_query=(
+                "SELECT attachments.id FROM attachments "
+                "JOIN messages ON messages.id = attachments.message_id "
+                "WHERE messages.channel_id = ?"
+            ),
+            lookup_query="SELECT id FROM attachments WHERE id IN ({})",
+            params=(real_thread_id,),
+            max_ids=args.seen_index_max_ids,
+            bloom=args.seen_index_bloom,
+            verify_misses=True,
+        ).load()
+
+    progress.pbar.total = info.messages_count - message_index.count
+    progress.pbar.refresh()
+
+    checkpoint = await BackfillCheckpoint.load(conn, real_thread_id)
+
+    def save_checkpoint():
+        progress.add()
+        db_queue.put_nowait((progress, {"checkpoint": checkpoint.row()}))
+
+    page_sizer = PageSizer(
+        args.messages_per_fetch,
+        adaptive=args.adaptive_page_size,
+        minimum=args.min_messages_per_fetch,
+        maximum=args.max_messages_per_fetch,
+        timeout=args.fetch_timeout,
+    )
+    raw_archive = RawArchive() if args.archive_raw else None
+
+    async def walk_history(
+        run: BackfillRun,
+        before_time_ms: int,
+        stop_at: int | None = None,
+        stop_when_known: bool = False,
+        shard: BackfillShard | None = None,
+    ):
+        while True:
+            if reason := backpressure.lagging():
+                progress.pbar.set_postfix_str(f"waiting: {reason}")
+                await backpressure.wait()
+                progress.pbar.set_postfix_str("")
+            started_at = time.monotonic()
+            try:
+                async with profiler.async_stage("fetch_messages"):
+                    resp = await accounts.fetch_messages(
+                        thread_id,
+                        before_time_ms,
+                        msg_count=page_sizer.size,
+                        timeout=page_sizer.timeout if page_sizer.adaptive else None,
+                        raw=raw_archive is not None,
+                    )
+            except ResponseError as e:
+                if is_rate_limit_error(e):
+                    # Still rate limited after the governor's retries, but
+                    # it keeps holding requests back until the limit is over.
+                    continue
+                if page_sizer.failure():
+                    continue
+                raise
+            except asyncio.TimeoutError:
+                if page_sizer.failure():
+                    continue
+                raise
+            # Time spent waiting for the governor doesn't count.
+            page_sizer.success(last_request_seconds.get() or time.monotonic() - started_at)
+
+            raw_nodes = {}
+            if raw_archive:
+                raw_nodes = {node.get("message_id"): node for node in resp.get("nodes") or []}
+                with profiler.stage("graphql deserialize"):
+                    resp = MessageList.deserialize(resp)
         
-        if len(message.blob_attachments) > 0:
-            if "attachments" not in result:
-                result["attachments"] = []
+            messages = resp.nodes
             
-            attachments = await asyncio.gather(
-                *[
-                    convert_attachment(
-                        client,
-                        attachment,
-                        random.choice(webhook_urls),
-                        thread_id=thread_id,
-                        message_id=message.message_id,
+            if len(messages) == 0 or not messages:
+                page = run.new_page(None)
+                page.last = True
+                page.seal()
+                break
+
+            page = run.new_page(messages[0].timestamp)
+            metrics.inc("pages_total")
+            # Read only now, since the shard may have been split during the fetch.
+            floor = shard.lower_timestamp if shard else None
+            if shard:
+                shard.position = messages[0].timestamp - 1
+            reached_floor = floor is not None and messages[0].timestamp <= floor
+            if reached_floor:
+                # The rest belongs to the next shard.
+                messages = [message for message in messages if message.timestamp > floor]
+            page_message_ids = {message.message_id for message in messages}
+            async with profiler.async_stage("seen index lookup"):
+                seen_message_ids = await message_index.seen(page_message_ids)
+                if attachment_index:
+                    seen_attachment_ids = await attachment_index.seen(
+                        x.id
+                        for message in messages
+                        for x in (message.sticker, *message.blob_attachments)
+                        if x
                     )
-                    for attachment in message.blob_attachments
-                    if attachment.id not in fetched_attachment_ids
-                ]
+            known_results = []
+            raw_rows = []
+            for message in messages:
+                if raw_archive and (
+                    message.message_id not in seen_message_ids or stop_when_known
+                ):
+                    with profiler.stage("archive raw message"):
+                        raw_rows.append((
+                            message.message_id,
+                            real_thread_id,
+                            message.timestamp,
+                            raw_archive.compress(raw_nodes[message.message_id]),
+                        ))
+                if message.message_id not in seen_message_ids:
+                    with profiler.stage("convert_message"):
+                        result = sender_cache.filter(
+                            convert_message(
+                                message,
+                                thread_id=real_thread_id,
+                            )
+                        )
+                    page.add()
+                    db_queue.put_nowait((page, result))
+                    message_index.add(message.message_id)
+                    counts["new"] += 1
+                    metrics.inc("messages_total")
+                elif stop_when_known:
+                    with profiler.stage("convert_message"):
+                        known_results.append(
+                            convert_message(
+                                message,
+                                thread_id=real_thread_id,
+                            )
+                        )
+
+                if attachment_queue:
+                    new_attachment_ids = {
+                        x.id
+                        for x in (message.sticker, *message.blob_attachments)
+                        if x and x.id not in seen_attachment_ids
+                    }
+                    if new_attachment_ids:
+                        if message.sticker and message.sticker.id in new_attachment_ids:
+                            # Fetched along with the other new stickers in the page.
+                            sticker_resolver.want(message.sticker.id)
+                        # Also skips repeats of the same sticker later on.
+                        attachment_index.add(*new_attachment_ids)
+                        seen_attachment_ids |= new_attachment_ids
+                        attachment_pbar.total += len(new_attachment_ids)
+                        attachment_pbar.refresh()
+
+                        page.add()
+                        attachment_queue.put_nowait((page, (message, new_attachment_ids)))
+
+            if raw_rows:
+                page.add()
+                db_queue.put_nowait((page, {"raw_messages": raw_rows}))
+
+            async with profiler.async_stage("find_changed_messages"):
+                updates = await find_changed_messages(conn, known_results)
+            for update in updates:
+                page.add()
+                db_queue.put_nowait((page, update))
+                counts["changed"] += 1
+                metrics.inc("changed_messages_total")
+
+            page.last = (
+                reached_floor
+                or (stop_at is not None and page.oldest_timestamp <= stop_at)
+                or (stop_when_known and seen_message_ids >= page_message_ids)
             )
-            for attachment in attachments:
-                if not attachment:
+            page.seal()
+            if page.last:
+                break
+            before_time_ms = page.oldest_timestamp - 1
+
+    def save_shards(*shards: BackfillShard):
+        progress.add()
+        db_queue.put_nowait((progress, {"shards": [shard.row() for shard in shards]}))
+
+    async def backfill_shards(shards: list[BackfillShard]):
+        # Shards are walked at the same time, and the checkpoint follows the
+        # shards that continue directly from it as they progress.
+        def merge_shards():
+            merged = []
+            moved = False
+            while shards:
+                shard = shards[0]
+                if shard.complete:
+                    if shard.lower_timestamp is not None:
+                        checkpoint.oldest_timestamp = shard.lower_timestamp + 1
+                    else:
+                        checkpoint.complete = True
+                        if shard.oldest_timestamp is not None:
+                            checkpoint.oldest_timestamp = shard.oldest_timestamp
+                    merged.append((shard.channel_id, shard.upper_timestamp))
+                    shards.pop(0)
+                    moved = True
                     continue
-                url = attachment["url"]
-                name = attachment["name"]
-                attachment_type = attachment["type"]
-                attachment_id = attachment["id"]
-                result["attachments"].append(
-                    (
-                        attachment_id,
-                        message.message_id,
-                        name,
-                        attachment_type,
-                        url,
-                        None,
-                        None,
-                    )
+                if (
+                    shard.oldest_timestamp is not None
+                    and shard.oldest_timestamp < checkpoint.oldest_timestamp
+                ):
+                    checkpoint.oldest_timestamp = shard.oldest_timestamp
+                    moved = True
+                break
+            if merged:
+                progress.add()
+                db_queue.put_nowait((progress, {"merged_shards": merged}))
+            if moved:
+                save_checkpoint()
+
+        def on_shard_page(shard: BackfillShard, page: PageProgress):
+            if page.oldest_timestamp is not None:
+                shard.oldest_timestamp = page.oldest_timestamp
+            shard.complete = page.last
+            save_shards(shard)
+            merge_shards()
+
+        merge_shards()
+        pending = [shard for shard in shards if not shard.complete]
+        if not pending:
+            return
+        print(f"[INFO] Backfilling {len(pending)} shards of {info.name} ({real_thread_id})")
+
+        def walk_shard(shard: BackfillShard) -> asyncio.Task:
+            return asyncio.create_task(
+                walk_history(
+                    BackfillRun(progress, functools.partial(on_shard_page, shard)),
+                    shard.resume_at,
+                    shard=shard,
                 )
+            )
 
-        db_queue.put_nowait(result)
-        attachment_pbar.update(len(result.get("attachments", [])))
-        queue.task_done()
-
+        # Interrupted runs may have saved more shards than are walked at
+        # once; the rest are walked as others finish.
+        walks = {walk_shard(shard): shard for shard in pending[:shard_count]}
+        del pending[:shard_count]
+        try:
+            while walks:
+                done, _ = await asyncio.wait(walks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del walks[task]
+                    task.result()
+                for _ in done:
+                    if pending:
+                        shard = pending.pop(0)
+                        walks[walk_shard(shard)] = shard
+                        continue
+                    # Keep as many walks going as there were to begin with,
+                    # by splitting the shard with the most time left to walk.
+                    busiest = max(
+                        (shard for shard in walks.values() if not shard.complete),
+                        key=lambda shard: shard.unwalked(args.shard_since),
+                        default=None,
+                    )
+                    if busiest and (shard := busiest.split(args.shard_since)):
+                        shards.insert(shards.index(busiest) + 1, shard)
+                        # Both at once, so that no part of the history is
+                        # ever left out of the saved shards.
+                        save_shards(busiest, shard)
+                        walks[walk_shard(shard)] = shard
+        finally:
+            for task in walks:
+                task.cancel()
 
-def convert_message(
-    message: Message,
-    *,
-    thread_id: str | int,
-) -> dict[str, Any]:
-    msg_text = ""
-
-    if not message.is_user_generated:
-        # System messages don't have message text, they only have
-        # a snippet to describe what was going on.
-        msg_text = f"*{message.snippet}*"
-    elif message.message:
-        msg_text = utf16_surrogate.add(message.message.text)
-        for m in reversed(message.message.ranges):
-            offset = m.offset
-            leng = m.length
-            if not m.entity or not m.entity.id:
-                continue
-            msg_text = f"{msg_text[:offset]}<@{m.entity.id}>{msg_text[offset + leng:]}"
-        msg_text = escape_markdown(utf16_surrogate.remove(msg_text))
-
-    result = {
-        "users": [
-            (
-                message.message_sender.id,
-                message.message_sender.messaging_actor.name or "Facebook user",
-                ""
-            )
-        ],
-        "message": (
-            message.message_id,
-            message.message_sender.id,
-            int(thread_id),
-            msg_text,
-            message.timestamp,
-            message.unsent_timestamp,
-        ),
-    }
+    print(f"[INFO] Fetching messages for {info.name} ({real_thread_id})")
+    started_at = int(time.time() * 1000)
+    counts = {"new": 0, "changed": 0}
+
+    if checkpoint.exists or args.latest:
+        # Catch up on everything sent since the last run, down to where the
+        # fetched range starts.
+        def on_head_page(page: PageProgress):
+            # With --latest the walk may stop on a page of known messages
+            # before reaching the checkpoint, and then there can be a gap.
+            if checkpoint.exists and page.last and (
+                page.oldest_timestamp is None
+                or page.oldest_timestamp <= checkpoint.newest_timestamp
+            ):
+                checkpoint.newest_timestamp = started_at
+                save_checkpoint()
+
+        await walk_history(
+            BackfillRun(progress, on_head_page),
+            started_at,
+            stop_at=checkpoint.newest_timestamp,
+            stop_when_known=args.latest,
+        )
 
-    if (
-        message.replied_to_message 
-        and message.replied_to_message.message
-        and (replied_to_id := message.replied_to_message.message.message_id)
-    ):
-        result["replied_to"] = (message.message_id, replied_to_id)
-    
-    if len(message.message_reactions) > 0:
-        reactions_grouped_by_emoji = itertools.groupby(
-            message.message_reactions,
-            lambda x: x.reaction
+    if args.latest:
+        print(
+            f"[INFO] {info.name} ({real_thread_id}): {counts['new']} new, "
+            f"{counts['changed']} changed messages"
         )
-        result["reactions"] = [
-            (
-                message.message_id,
-                reaction,
-                len(list(group)),
-            )
-            for reaction, group in reactions_grouped_by_emoji
-        ]
+        return
+
+    if checkpoint.complete:
+        return
+
+    shards = await BackfillShard.load_all(conn, real_thread_id)
+    # Pages of one walk are fetched one after another, so every account in
+    # the thread needs a shard of its own to fetch with.
+    shard_count = max(args.shards, len(accounts.members(real_thread_id)))
+    if not shards and shard_count > 1:
+        if not checkpoint.exists:
+            # Anchors the head walk of the next run.
+            checkpoint.oldest_timestamp = checkpoint.newest_timestamp = started_at
+            save_checkpoint()
+        upper = checkpoint.oldest_timestamp - 1
+        if upper > args.shard_since:
+            shards = BackfillShard.plan(real_thread_id, upper, args.shard_since, shard_count)
+            save_shards(*shards)
+    if shards:
+        await backfill_shards(shards)
+        return
+
+    # Continue backwards from the oldest fetched message (or from now on
+    # the first run), moving the checkpoint along with every written page.
+    def on_tail_page(page: PageProgress):
+        if checkpoint.newest_timestamp is None:
+            checkpoint.newest_timestamp = started_at
+        if page.oldest_timestamp is None:
+            checkpoint.complete = True
+            if checkpoint.oldest_timestamp is None:
+                checkpoint.oldest_timestamp = started_at
+        else:
+            checkpoint.oldest_timestamp = page.oldest_timestamp
+        save_checkpoint()
+
+    if checkpoint.oldest_timestamp is not None:
+        print(f"[INFO] Continuing from timestamp {checkpoint.oldest_timestamp}")
+    await walk_history(
+        BackfillRun(progress, on_tail_page),
+        checkpoint.oldest_timestamp - 1 if checkpoint.exists else started_at,
+    )
+
 
-    return result
+async def find_changed_messages(
+    conn: aiosqlite.Connection,
+    results: list[dict[str, Any]],
+) -> list[dict[str, Any]]:
+    """Compare converted messages against the stored ones.
+
+    Returns db_worker results that bring every changed message (text,
+    unsent timestamp or reactions) up to date.
+    """
+    if not results:
+        return []
+
+    message_ids = [result["message"][0] for result in results]
+    stored = {}
+    for chunk in chunked(message_ids):
+        placeholders = ", ".join("?" * len(chunk))
+        async with conn.execute(
+            f"SELECT id, text, unsent_timestamp FROM messages WHERE id IN ({placeholders})",
+            chunk,
+        ) as cursor:
+            async for message_id, text, unsent_timestamp in cursor:
+                stored[message_id] = (text, unsent_timestamp, {})
+        async with conn.execute(
+            f"SELECT message_id, emoji, count FROM reactions WHERE message_id IN ({placeholders})",
+            chunk,
+        ) as cursor:
+            async for message_id, emoji, count in cursor:
+                stored[message_id][2][emoji] = count
+
+    updates = []
+    for result in results:
+        message_id, _, _, text, _, unsent_timestamp = result["message"]
+        if message_id not in stored:
+            # Not written yet, so there's nothing to compare against.
+            continue
+        reactions = {emoji: count for _, emoji, count in result.get("reactions", [])}
+        if stored[message_id] == (text, unsent_timestamp, reactions):
+            continue
+
+        update = {
+            "message_update": (text, unsent_timestamp, message_id),
+            "cleared_reactions": [(message_id,)],
+        }
+        if "reactions" in result:
+            update["reactions"] = result["reactions"]
+        updates.append(update)
+    return updates
 
 
 async def execute(args):
-    if len(args.webhook) == 0:
+    run_profiler = None
+    if args.profile_output:
+        run_profiler = RunProfiler(args.profiler, args.profile_output)
+        run_profiler.start()
+    if args.profile or run_profiler:
+        profiler.enable()
+    try:
+        await _execute(args)
+    finally:
+        if run_profiler:
+            run_profiler.stop()
+            print(f"[INFO] Saved {args.profiler} profile to {args.profile_output}")
+        if profiler.enabled:
+            print(profiler.report())
+
+
+async def _execute(args):
+    if args.store_dir:
+        if len(args.webhook) > 0:
+            print("[WARN] Both webhooks and a store directory were provided. Using the store directory.")
+    elif len(args.webhook) == 0:
         print("[WARN] Webhooks were not provided. Not uploading attachments.")
 
     schema_path = os.path.join(
@@ -580,201 +1536,203 @@ async def execute(args):
         with open(schema_path) as f:
             await conn.executescript(f.read())
 
-        state, api = await get_credentials(args.credentials)
-        for thread_id in args.id:
-            real_thread_id = thread_id
-            
-            thread_info = await api.fetch_thread_info(thread_id)
-            if not thread_info:
-                print(
-                    f"[ERROR] Could not retrieve thread information for ID {thread_id}"
-                )
-                continue
-            elif thread_info[0].thread_key.id != thread_id:
-                print(
-                    f"[WARN] Response contained different ID "
-                    f"({thread_info[0].thread_key.id}) than expected {thread_id}"
-                )
-                real_thread_id = thread_info[0].thread_key.id
-            
-            if real_thread_id is None:
-                print(
-                    "[ERROR] Received thread ID was null??? Not dumping this channel."
-                )
-                continue
-            
-            info = thread_info[0]
-            await conn.execute(
-                "INSERT INTO channels (id, name) VALUES (?, ?) ON CONFLICT DO UPDATE SET name=excluded.name",
-                (real_thread_id, info.name or "No name")
+        if args.record_http and args.replay_http:
+            print("[ERROR] Can't both record and replay HTTP requests")
+            return
+        cassette = None
+        if args.record_http:
+            cassette = Cassette(args.record_http, "record")
+        elif args.replay_http:
+            cassette = Cassette(args.replay_http, "replay")
+
+        metrics = Metrics()
+        credentials = []
+        for credentials_filename in dict.fromkeys(args.credentials):
+            state, api = await get_credentials(credentials_filename, cassette)
+            if cassette:
+                cassette.secrets.add(state.session.access_token)
+            if profiler.enabled:
+                api.stage_observer = profiler.record
+            # Rate limits are per account, so every account gets its own
+            # governor, shared by all threads that are fetched with it.
+            api.governor = RateGovernor(
+                rate=args.initial_requests_per_minute / 60,
+                max_rate=args.max_requests_per_minute / 60,
             )
-            await conn.commit()
-
-            print(f"[INFO] Fetching users for thread {info.name} ({real_thread_id})")
-            async def user_data_worker(pcp: ParticipantNode):
-                actor = pcp.messaging_actor
-                name = (
-                    actor.structured_name.text 
-                    if actor.structured_name
-                    else (
-                        actor.nickname_for_viewer 
-                        or actor.username 
-                        or "Facebook user"
-                    )
+            if args.replay_http:
+                # Replays run at full speed.
+                api.governor = RateGovernor(rate=1e6, burst=1e6)
+            api.graphql_observer = functools.partial(observe_graphql, metrics)
+            credentials.append((credentials_filename, state, api))
+        accounts = AccountPool(credentials)
+
+        concurrency = max(args.concurrency, 1)
+        positions = asyncio.Queue()
+        for position in range(concurrency):
+            positions.put_nowait(position)
+
+        # One writer and one set of attachment workers serve every thread, so
+        # SQLite only ever sees a single writer.
+        db_queue = asyncio.Queue()
+        tasks = [
+            asyncio.create_task(
+                db_worker(
+                    db_queue,
+                    conn,
+                    batch_size=max(args.db_batch_size, 1),
+                    batch_interval=args.db_batch_interval,
+                    metrics=metrics,
                 )
-                profile_picture = None
-                if (fb_profile_pic := (
-                    actor.profile_pic_large 
-                    or actor.profile_pic_medium
-                    or actor.profile_pic_small
-                )) and len(args.webhook) > 0:
-                    url = fb_profile_pic.uri
-                    reuploaded = await reupload_fb_file(
-                        api,
-                        url,
-                        f"profile_picture-{pcp.id}.jpg",
-                        random.choice(args.webhook)
-                    )
-                    profile_picture = reuploaded[1] if reuploaded else None
-                return int(pcp.id), name, profile_picture
+            ),
+        ]
 
-            users_rows = await asyncio.gather(
-                *[user_data_worker(pcp) for pcp in info.all_participants.nodes]
-            )
-            await conn.executemany(
-                (
-                    "INSERT INTO users(id, name, avatar_url) VALUES (?, ?, ?) "
-                    "ON CONFLICT DO UPDATE SET name=excluded.name, "
-                    "avatar_url=coalesce(excluded.avatar_url, avatar_url)"
-                ),
-                users_rows
-            )
-            await conn.commit()
-
-            fetched_message_ids = []
-            fetched_message_count = 0
-            async with conn.execute(
-                "SELECT id FROM messages WHERE channel_id = ?",
-                (real_thread_id,)
-            ) as cursor:
-                async for row in cursor:
-                    fetched_message_ids.append(row[0])
-                    fetched_message_count += 1
-            
-            # if dumped_message_count > 0:
-            #     async with conn.execute(
-            #         "SELECT timestamp FROM messages WHERE channel_id = ? ORDER BY timestamp ASC LIMIT 1",
-            #         (real_thread_id,)
-            #     ) as cursor:
-            #         earliest_timestamp = (await cursor.fetchone())[0]
-            #         before_time_ms = earliest_timestamp
-            #         print(f"[INFO] Continuing from timestamp {before_time_ms}")
-            # else:
-            #     before_time_ms = int(time.time() * 1000)
-            #     print("[INFO] Starting from newest message")
-            
-            message_pbar = tqdm(
-                total=info.messages_count - fetched_message_count,
-                position=0,
-                unit="messages",
+        sender_cache = await SenderCache(conn).load()
+        limits = TransferLimits(
+            downloads=args.max_downloads,
+            lookups=args.max_url_lookups,
+            uploads=args.max_uploads,
+        )
+        if args.store_dir:
+            store = LocalStore(args.store_dir)
+        elif len(args.webhook) > 0:
+            store = WebhookStore(accounts.primary, args.webhook)
+        else:
+            store = None
+
+        if store:
+            media_cache = MediaCache(conn, db_queue, store.key)
+            sticker_resolver = await StickerResolver(accounts.primary, conn, db_queue).load()
+            attachment_pbar = tqdm(
+                total=1,
+                position=concurrency,
+                unit="attachments"
             )
-            db_queue = asyncio.Queue()
-            tasks = [
-                asyncio.create_task(db_worker(db_queue, conn, message_pbar)),
-            ]
-
-            if len(args.webhook) > 0:
-                fetched_attachment_ids = []
-                async with conn.execute(
-                    "SELECT id FROM attachments"
-                ) as cursor:
-                    async for row in cursor:
-                        fetched_attachment_ids.append(row[0])
-
-                attachment_pbar = tqdm(
-                    total=1,
-                    position=1,
-                    unit="attachments"
-                )
-                attachment_queue = asyncio.Queue()
-                tasks.extend(
-                    asyncio.create_task(
-                        attachment_worker(
-                            attachment_queue,
-                            db_queue,
-                            api,
-                            real_thread_id,
-                            args.webhook,
-                            fetched_attachment_ids,
-                            attachment_pbar,
-                        )
+            attachment_queue = asyncio.Queue()
+            tasks.extend(
+                asyncio.create_task(
+                    attachment_worker(
+                        attachment_queue,
+                        db_queue,
+                        accounts,
+                        store,
+                        attachment_pbar,
+                        sticker_resolver,
+                        media_cache,
+                        limits,
                     )
-                    for _ in range(max((os.cpu_count() or 3) - 1, 2) // 2)
                 )
-            else:
-                fetched_attachment_ids = []
-                attachment_pbar = None
-                attachment_queue = None
-            
-            print(f"[INFO] Fetching messages for {info.name} ({real_thread_id})")
-            backfill_more = True
-            before_time_ms = int(time.time() * 1000)
+                for _ in range(max(args.attachment_workers, 1))
+            )
+        else:
+            media_cache = None
+            sticker_resolver = None
+            attachment_pbar = None
+            attachment_queue = None
 
-            while backfill_more:
-                try:
-                    resp = await api.fetch_messages(
-                        thread_id,
-                        before_time_ms,
-                        msg_count=95
-                    )
-                except RateLimitExceeded as _:
-                    print("[WARN] Rate limited. Waiting for 300 seconds before resuming.")
-                    await asyncio.sleep(300)
-                    continue
-                except ResponseError as e:
-                    code = e.data.get("code", "")
-                    subcode = e.data.get("subcode") or e.data.get("error_subcode")
-                    code_str = f"{code}.{subcode}" if subcode else str(code)
+        backpressure = Backpressure(
+            {
+                "database": (db_queue, args.db_queue_size),
+                "attachment": (attachment_queue, args.attachment_queue_size),
+            },
+            max_memory=args.max_memory * 2**20,
+        )
+        if attachment_pbar:
+            tasks.append(
+                asyncio.create_task(
+                    report_pipeline_stats(backpressure, limits, attachment_pbar)
+                )
+            )
 
-                    if code_str != "1675004":  # Rate limit exceeded
-                        raise
+        register_metrics(
+            metrics,
+            accounts=accounts,
+            queues={"database": db_queue, "attachment": attachment_queue},
+            limits=limits,
+            store=store,
+        )
+        metrics_runner = None
+        if args.metrics_port:
+            metrics_runner = await serve_metrics(metrics, args.metrics_port)
+            print(f"[INFO] Serving metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+        if args.metrics_file:
+            tasks.append(
+                asyncio.create_task(
+                    write_metrics_file(metrics, args.metrics_file, args.metrics_interval)
+                )
+            )
 
-                    print("[WARN] Rate limited. Waiting for 300 seconds before resuming.")
-                    await asyncio.sleep(300)
-                    continue
-            
-                messages = resp.nodes
-                
-                if len(messages) == 0 or not messages:
-                    backfill_more = False
-                    break
-
-                for message in messages:
-                    if attachment_pbar:
-                        attachments = [message.sticker, *message.blob_attachments]
-                        
-                        for x in attachments:
-                            if x and x.id not in fetched_attachment_ids:
-                                attachment_pbar.total += 1
+        async def scheduled_dump(thread_id: int):
+            # The progress bar position doubles as the concurrency slot: a
+            # thread only starts once another one has finished and freed its line.
+            position = await positions.get()
+            try:
+                await dump_thread(
+                    args,
+                    conn,
+                    accounts,
+                    thread_id,
+                    position=position,
+                    db_queue=db_queue,
+                    attachment_queue=attachment_queue,
+                    attachment_pbar=attachment_pbar,
+                    media_cache=media_cache,
+                    sticker_resolver=sticker_resolver,
+                    sender_cache=sender_cache,
+                    store=store,
+                    backpressure=backpressure,
+                    limits=limits,
+                    metrics=metrics,
+                )
+            finally:
+                positions.put_nowait(position)
 
-                        attachment_pbar.refresh()
-                    
-                    if message.message_id not in fetched_message_ids:
-                        result = convert_message(
-                            message,
-                            thread_id=real_thread_id,
-                        )
-                        db_queue.put_nowait(result)
+        try:
+            results = await asyncio.gather(
+                *[scheduled_dump(thread_id) for thread_id in args.id],
+                return_exceptions=True,
+            )
+            for thread_id, result in zip(args.id, results):
+                if isinstance(result, Exception):
+                    print(f"[ERROR] Failed to dump thread {thread_id}: {result!r}")
 
-                    if attachment_queue:
-                        attachment_queue.put_nowait(message)
-                
-                before_time_ms = messages[0].timestamp - 1
-            
             if attachment_queue:
                 await attachment_queue.join()
             await db_queue.join()
 
+            if attachment_queue:
+                for name, limit in limits.items().items():
+                    if limit.total:
+                        print(
+                            f"[INFO] {limit.total} {name}: {limit.average():.1f} "
+                            f"running on average, at most {limit.peak} at once "
+                            f"(limit: {limit.limit or 'none'})"
+                        )
+            for name, _, client in accounts.accounts:
+                governor = client.governor
+                if profiler.enabled:
+                    profiler.record(
+                        "waiting for governor", governor.waited_seconds, calls=governor.requests
+                    )
+                print(
+                    f"[INFO] {governor.requests} GraphQL requests, "
+                    f"{governor.rate_limits} rate limits, ending at "
+                    f"{governor.rate * 60:.1f} requests per minute"
+                    + (f" with {name}" if len(accounts.accounts) > 1 else "")
+                )
+            if cassette:
+                print(
+                    f"[INFO] {cassette.recorded} GraphQL responses recorded, "
+                    f"{cassette.replayed} replayed"
+                )
+            if backpressure.pauses:
+                print(
+                    f"[INFO] Fetching was paused {backpressure.pauses} times for "
+                    f"{backpressure.paused_seconds:.0f} seconds in total to let "
+                    "the database and uploads catch up"
+                )
+        finally:
             for task in tasks:
                 task.cancel()
             await asyncio.gather(*tasks, return_exceptions=True)
+            if metrics_runner:
+                await metrics_runner.cleanup()
@@ -1,13 +1,14 @@
-import base64
-import json
 import os
+import pathlib
 import time
-import gzip
+from typing import Any, Callable
 
 import aiosqlite
 from multidict import MultiDict
 from tqdm import tqdm
 
+from dumper import GzipBase64Writer, JSONStreamWriter, chunked
+
 
 def add_command(subparsers):
     export_parser = subparsers.add_parser(
@@ -22,136 +23,226 @@ def add_command(subparsers):
         required=True,
         help="IDs of threads to export (the long string of number in the chat URL)",
     )
+    export_parser.add_argument(
+        "-s",
+        "--store-dir",
+        type=str,
+        required=False,
+        help="Directory that `dump --store-dir` saved attachments to",
+    )
+    export_parser.add_argument(
+        "--media-url",
+        type=str,
+        required=False,
+        help=(
+            "URL the store directory will be served from. Defaults to the path "
+            "of the store directory relative to the exported files"
+        ),
+    )
+    export_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=2000,
+        required=False,
+        help="Number of messages to read and write at a time",
+    )
     return export_parser
 
 
-async def get_all_attachments(
-    connection: aiosqlite.Connection
+def media_url_resolver(args) -> Callable[[str | None], str | None]:
+    """Rewrite the relative paths left by `dump --store-dir` into usable URLs."""
+    if args.media_url:
+        base = args.media_url.rstrip("/")
+    elif args.store_dir:
+        base = os.path.relpath(args.store_dir).replace(os.sep, "/")
+    else:
+        base = None
+
+    def resolve(url: str | None) -> str | None:
+        if not url or not base or "://" in url:
+            return url
+        return f"{base}/{url}"
+
+    return resolve
+
+
+async def get_attachments(
+    connection: aiosqlite.Connection,
+    message_ids: list[str],
+    resolve_url: Callable[[str | None], str | None],
 ) -> MultiDict:
     attachments = MultiDict()
-    async with connection.execute(
-        "SELECT message_id, name, type, url, width, height FROM attachments"
-    ) as cursor:
-        async for attachment in cursor:
-            (
-                message_id,
-                name,
-                attachment_type, 
-                url,
-                width,
-                height
-            ) = attachment
-
-            if not url or not name:
-                continue
-
-            dumped_attachment = {
-                "url": url,
-                "name": name,
-            }
-
-            if width:
-                dumped_attachment["width"] = width
-            if height:
-                dumped_attachment["height"] = height
-            attachments.add(message_id, dumped_attachment)
+    for chunk in chunked(message_ids):
+        async with connection.execute(
+            "SELECT message_id, name, type, url, width, height FROM attachments "
+            f"WHERE message_id IN ({', '.join('?' * len(chunk))}) ORDER BY rowid",
+            chunk,
+        ) as cursor:
+            async for attachment in cursor:
+                (
+                    message_id,
+                    name,
+                    attachment_type, 
+                    url,
+                    width,
+                    height
+                ) = attachment
+
+                if not url or not name:
+                    continue
+
+                dumped_attachment = {
+                    "url": resolve_url(url),
+                    "name": name,
+                }
+
+                if width:
+                    dumped_attachment["width"] = width
+                if height:
+                    dumped_attachment["height"] = height
+                attachments.add(message_id, dumped_attachment)
     
     return attachments
 
 
-async def get_all_reactions(
-    connection: aiosqlite.Connection
+async def get_reactions(
+    connection: aiosqlite.Connection,
+    message_ids: list[str],
 ) -> MultiDict:
     reactions = MultiDict()
-    async with connection.execute(
-        "SELECT message_id, emoji, count FROM reactions"
-    ) as cursor:
-        async for reaction in cursor:
-            (
-                message_id,
-                emoji,
-                count
-            ) = reaction
-
-            if not emoji or not count:
-                continue
-
-            reactions.add(
-                message_id,
-                {
-                    "n": emoji,
-                    "c": count,
-                },
-            )
+    for chunk in chunked(message_ids):
+        async with connection.execute(
+            "SELECT message_id, emoji, count FROM reactions "
+            f"WHERE message_id IN ({', '.join('?' * len(chunk))}) ORDER BY rowid",
+            chunk,
+        ) as cursor:
+            async for reaction in cursor:
+                (
+                    message_id,
+                    emoji,
+                    count
+                ) = reaction
+
+                if not emoji or not count:
+                    continue
+
+                reactions.add(
+                    message_id,
+                    {
+                        "n": emoji,
+                        "c": count,
+                    },
+                )
     
     return reactions
 
 
-async def execute(args):
-    if not os.path.exists(args.database):
-        print("[ERROR] No database file found.")
-        exit(1)
+async def get_meta(
+    connection: aiosqlite.Connection,
+    thread_ids: list[int],
+    resolve_url: Callable[[str | None], str | None],
+) -> tuple[dict[str, Any], dict[int, int]]:
+    """Gather the channels and users for the archive metadata.
 
-    async with aiosqlite.connect(args.database) as conn:
-        dump = {
-            "meta": {
-                "users": {},
-                "userindex": [],
-                "servers": [{
-                    "name": "\u200B",
-                    "type": "server"
-                }],
-                "channels": {},
-            },
-            "data": {},
-        }
+    Also returns the position of each user in ``userindex``, which messages
+    refer to their sender by, keyed by the sender ID as stored.
+    """
+    user_indices = {}
+    meta = {
+        "users": {},
+        "userindex": [],
+        "servers": [{
+            "name": "\u200B",
+            "type": "server"
+        }],
+        "channels": {},
+    }
 
-        all_attachments = await get_all_attachments(conn)
-        all_reactions = await get_all_reactions(conn)
+    for thread_id in thread_ids:
+        str_thread_id = str(thread_id)
+
+        async with connection.execute("SELECT name FROM channels WHERE id = ?", (thread_id,)) as cursor:
+            name = (await cursor.fetchone())[0]
         
-        for thread_id in args.id:
-            str_thread_id = str(thread_id)
-
-            async with conn.execute("SELECT name FROM channels WHERE id = ?", (thread_id,)) as cursor:
-                name = (await cursor.fetchone())[0]
-            
-            dump["meta"]["channels"][str_thread_id] = {
-                "server": 0,
-                "name": name,
-                "nsfw": False,
-            }
-
-            async with conn.execute(
-                (
-                    "SELECT DISTINCT sender_id, name, avatar_url "
-                    "FROM messages "
-                    "LEFT JOIN users ON messages.sender_id = users.id "
-                    "WHERE channel_id = ?"
-                ),
-                (thread_id,),
-            ) as cursor:
-                async for user in cursor:
-                    id, name, avatar_url = user
-                    str_id = str(id)
-                    dump["meta"]["userindex"].append(str_id)
-                    dump["meta"]["users"][str_id] = {
-                        "name": name,
-                        "avatar": avatar_url,
-                        "tag": "0",
-                    }
-            
-            dump["data"][str_thread_id] = {}
-            async with conn.execute(
-                (
-                    "SELECT messages.id, sender_id, text, timestamp, unsent_timestamp, replied_to_id "
-                    "FROM messages "
-                    "LEFT JOIN replied_to ON replied_to.message_id = messages.id "
-                    "WHERE channel_id = ?"
-                ),
-                (thread_id,)   
-            ) as cursor:
-                rows = await cursor.fetchall()
-                for message in tqdm(rows):
+        meta["channels"][str_thread_id] = {
+            "server": 0,
+            "name": name,
+            "nsfw": False,
+        }
+
+        async with connection.execute(
+            (
+                "SELECT DISTINCT sender_id, name, avatar_url "
+                "FROM messages "
+                "LEFT JOIN users ON messages.sender_id = users.id "
+                "WHERE channel_id = ?"
+            ),
+            (thread_id,),
+        ) as cursor:
+            async for user in cursor:
+                id, name, avatar_url = user
+                str_id = str(id)
+                # Users in more than one channel are listed again, but
+                # messages refer to where they were listed first.
+                user_indices.setdefault(id, len(meta["userindex"]))
+                meta["userindex"].append(str_id)
+                meta["users"][str_id] = {
+                    "name": name,
+                    "avatar": resolve_url(avatar_url),
+                    "tag": "0",
+                }
+
+    return meta, user_indices
+
+
+async def write_archive(
+    connection: aiosqlite.Connection,
+    args,
+    writers: list[JSONStreamWriter],
+    flush: Callable[[], None],
+) -> None:
+    """Write the archive for the viewer to every writer, a batch of messages at a time.
+
+    The metadata (channels and users) is small and written first, and then
+    messages are read, converted and written ``args.batch_size`` at a time,
+    with ``flush`` called after each batch.
+    """
+    resolve_url = media_url_resolver(args)
+    meta, user_indices = await get_meta(connection, args.id, resolve_url)
+
+    for writer in writers:
+        writer.begin()
+        writer.item("meta", meta)
+        writer.begin("data")
+    flush()
+
+    for thread_id in args.id:
+        str_thread_id = str(thread_id)
+        for writer in writers:
+            writer.begin(str_thread_id)
+
+        async with connection.execute(
+            "SELECT COUNT(*) FROM messages WHERE channel_id = ?", (thread_id,)
+        ) as cursor:
+            (count,) = await cursor.fetchone()
+        pbar = tqdm(total=count, unit="messages")
+
+        async with connection.execute(
+            (
+                "SELECT messages.id, sender_id, text, timestamp, unsent_timestamp, replied_to_id "
+                "FROM messages "
+                "LEFT JOIN replied_to ON replied_to.message_id = messages.id "
+                "WHERE channel_id = ?"
+            ),
+            (thread_id,)   
+        ) as cursor:
+            while rows := await cursor.fetchmany(max(args.batch_size, 1)):
+                message_ids = [message[0] for message in rows]
+                reactions_by_message = await get_reactions(connection, message_ids)
+                attachments_by_message = await get_attachments(
+                    connection, message_ids, resolve_url
+                )
+                for message in rows:
                     (
                         message_id,
                         sender_id,
@@ -161,8 +252,8 @@ async def execute(args):
                         replied_to_id,
                     ) = message
 
-                    dumped_message = dump["data"][str_thread_id][message_id] = {
-                        "u": dump["meta"]["userindex"].index(str(sender_id)),
+                    dumped_message = {
+                        "u": user_indices[sender_id],
                         "t": timestamp,
                     }
 
@@ -175,37 +266,85 @@ async def execute(args):
                     if replied_to_id:
                         dumped_message["r"] = replied_to_id
 
-                    if (reactions := all_reactions.getall(message_id, None)):
+                    if (reactions := reactions_by_message.getall(message_id, None)):
                         dumped_message["re"] = reactions
                     
-                    if (attachments := all_attachments.getall(message_id, None)):
+                    if (attachments := attachments_by_message.getall(message_id, None)):
                         dumped_message["a"] = attachments
 
-    output_filename = f"archive-{int(time.time())}"            
-    
-    with open(f"{output_filename}.json", "w") as f:
-        json.dump(dump, f, indent=4, ensure_ascii=False)
-    
-    print(f"Raw message data dumped to {output_filename}.json")
-    
+                    for writer in writers:
+                        writer.item(message_id, dumped_message)
+                flush()
+                pbar.update(len(rows))
+        pbar.close()
+
+        for writer in writers:
+            writer.end()
+
+    for writer in writers:
+        writer.end()
+        writer.end()
+    flush()
+
+
+async def execute(args):
+    if not os.path.exists(args.database):
+        print("[ERROR] No database file found.")
+        exit(1)
+
     with open("template.html") as f:
         template = f.read()
-    
-    compressed_data = gzip.compress(
-        json.dumps(
-            dump,
-            ensure_ascii=False
-        )
-        .encode("utf-8")
-    )
-    
-    template = template.replace(
-        '"/*[ARCHIVE]*/"',
-        f'"data:application/gzip;base64,{base64.b64encode(compressed_data).decode("utf-8")}"',
-    )
+    template_head, _, template_tail = template.partition('"/*[ARCHIVE]*/"')
 
-    with open(f"{output_filename}.html", "w") as f:
-        f.write(template)
-    print(f"Viewer exported to {output_filename}.html")
+    output_filename = f"archive-{int(time.time())}"
+
+    # Both files are written as the messages are read: the raw data as
+    # indented JSON, and the viewer with the same data compressed and
+    # embedded as a data URL, so no more than a batch of messages is ever
+    # held in memory.
+    # Read-only, so that exporting never changes the database, not even
+    # while a dump is writing to it.
+    database_uri = f"{pathlib.Path(args.database).resolve().as_uri()}?mode=ro"
+    async with aiosqlite.connect(database_uri, uri=True) as conn:
+        async with conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'attachments_message'"
+        ) as cursor:
+            if not await cursor.fetchone():
+                print(
+                    "[WARN] Attachments are looked up without an index, which is slow. "
+                    "Run dump or reprocess once to add it."
+                )
 
-                
+        with (
+            open(f"{output_filename}.json", "w") as json_file,
+            open(f"{output_filename}.html", "w") as html_file,
+        ):
+            html_file.write(template_head)
+            html_file.write('"data:application/gzip;base64,')
+            compressed = GzipBase64Writer(html_file)
+
+            json_parts = []
+            html_parts = []
+
+            def flush():
+                json_file.write("".join(json_parts))
+                json_parts.clear()
+                compressed.write("".join(html_parts))
+                html_parts.clear()
+
+            await write_archive(
+                conn,
+                args,
+                [
+                    JSONStreamWriter(json_parts.append, indent=4),
+                    JSONStreamWriter(html_parts.append),
+                ],
+                flush,
+            )
+
+            compressed.close()
+            html_file.write('"')
+            html_file.write(template_tail)
+
+    print(f"Raw message data dumped to {output_filename}.json")
+    print(f"Viewer exported to {output_filename}.html")
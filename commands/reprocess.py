@@ -0,0 +1,211 @@
+import os
+
+import aiosqlite
+from tqdm import tqdm
+
+from dumper import (
+    ATTACHMENT_TYPES,
+    LocalStore,
+    RawArchive,
+    SenderCache,
+    WebhookStore,
+    chunked,
+    convert_message,
+    flush_db_batch,
+)
+from maufbapi.types.graphql import Message
+
+
+def add_command(subparsers):
+    reprocess_parser = subparsers.add_parser(
+        "reprocess",
+        help="rebuild messages from the raw JSON kept by `dump --archive-raw`"
+    )
+    reprocess_parser.add_argument(
+        "-i",
+        "--id",
+        type=int,
+        nargs="+",
+        required=False,
+        help="Thread IDs to reprocess (defaults to every archived thread)",
+    )
+    reprocess_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=2000,
+        required=False,
+        help="Number of messages to rebuild per transaction",
+    )
+    reprocess_parser.add_argument(
+        "--store-dir",
+        type=str,
+        required=False,
+        help=(
+            "Use the attachments that `dump --store-dir` stored in this directory "
+            "(defaults to the ones uploaded to webhooks)"
+        ),
+    )
+    return reprocess_parser
+
+
+async def get_stored_sources(
+    conn: aiosqlite.Connection,
+    store_key: str,
+    source_ids: list[str],
+) -> dict[str, tuple[str, str]]:
+    stored = {}
+    for chunk in chunked(source_ids):
+        cursor = await conn.execute(
+            "SELECT source_id, name, url FROM media_sources "
+            "JOIN media USING (store, digest) "
+            f"WHERE store = ? AND source_id IN ({', '.join('?' * len(chunk))})",
+            [store_key, *chunk],
+        )
+        for source_id, name, url in await cursor.fetchall():
+            stored[source_id] = (name, url)
+    return stored
+
+
+async def get_existing_attachments(
+    conn: aiosqlite.Connection,
+    attachment_ids: list[str],
+) -> set[str]:
+    existing = set()
+    for chunk in chunked(attachment_ids):
+        cursor = await conn.execute(
+            f"SELECT id FROM attachments WHERE id IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        )
+        existing.update(attachment_id for (attachment_id,) in await cursor.fetchall())
+    return existing
+
+
+def convert_attachments(
+    message: Message,
+    stored: dict[str, tuple[str, str]],
+    sticker_sizes: dict[str, tuple[int, int]],
+) -> list[tuple]:
+    """Attachment rows for files that were already stored by an earlier dump.
+
+    Nothing is downloaded: attachments that were never stored (or were
+    stored before the media cache existed) are left as they are.
+    """
+    rows = []
+    if message.sticker and (file := stored.get(f"sticker:{message.sticker.id}")):
+        name, url = file
+        width, height = sticker_sizes.get(message.sticker.id, (None, None))
+        rows.append((message.sticker.id, message.message_id, name, "sticker", url, width, height))
+    for attachment in message.blob_attachments:
+        attachment_type = ATTACHMENT_TYPES.get(attachment.typename)
+        if attachment_type and (file := stored.get(f"attachment:{attachment.id}")):
+            name, url = file
+            rows.append((attachment.id, message.message_id, name, attachment_type, url, None, None))
+    return rows
+
+
+async def execute(args):
+    if not os.path.exists(args.database):
+        print("[ERROR] No database file found.")
+        exit(1)
+
+    schema_path = os.path.join(
+        os.path.dirname(
+            os.path.dirname(__file__)
+        ),
+        "database",
+        "schema.sql"
+    )
+
+    async with aiosqlite.connect(args.database) as conn:
+        with open(schema_path) as f:
+            await conn.executescript(f.read())
+
+        channel_filter = ""
+        params = []
+        if args.id:
+            channel_filter = f"AND channel_id IN ({', '.join('?' * len(args.id))})"
+            params = list(args.id)
+
+        cursor = await conn.execute(
+            f"SELECT COUNT(*) FROM raw_messages WHERE 1 {channel_filter}", params
+        )
+        (total,) = await cursor.fetchone()
+        if not total:
+            print("[WARN] No archived messages found. Dump with --archive-raw to keep them.")
+            return
+
+        store_key = LocalStore.key_for(args.store_dir) if args.store_dir else WebhookStore.key
+        cursor = await conn.execute("SELECT id, width, height FROM stickers")
+        sticker_sizes = {
+            sticker_id: (width, height)
+            for sticker_id, width, height in await cursor.fetchall()
+        }
+
+        archive = RawArchive()
+        sender_cache = await SenderCache(conn).load()
+        pbar = tqdm(total=total, unit="messages")
+        counts = {"messages": 0, "attachments": 0, "failed": 0}
+        last_rowid = 0
+        while True:
+            # Paged by rowid rather than with one long-running cursor, as the
+            # same connection writes between pages.
+            cursor = await conn.execute(
+                "SELECT rowid, id, channel_id, data FROM raw_messages "
+                f"WHERE rowid > ? {channel_filter} ORDER BY rowid LIMIT ?",
+                [last_rowid, *params, max(args.batch_size, 1)],
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+
+            messages = []
+            for _, message_id, channel_id, data in rows:
+                try:
+                    messages.append((channel_id, Message.deserialize(archive.decompress(data))))
+                except Exception as e:
+                    print(f"[WARN] Could not read archived message {message_id}: {e!r}")
+                    counts["failed"] += 1
+
+            stored = await get_stored_sources(
+                conn,
+                store_key,
+                [
+                    *(
+                        f"attachment:{attachment.id}"
+                        for _, message in messages
+                        for attachment in message.blob_attachments
+                    ),
+                    *(
+                        f"sticker:{message.sticker.id}"
+                        for _, message in messages
+                        if message.sticker
+                    ),
+                ],
+            )
+            batch = []
+            attachment_ids = set()
+            for channel_id, message in messages:
+                result = sender_cache.filter(convert_message(message, thread_id=channel_id))
+                _, _, _, text, _, unsent_timestamp = result["message"]
+                result["message_update"] = (text, unsent_timestamp, message.message_id)
+                result["cleared_reactions"] = [(message.message_id,)]
+                if attachments := convert_attachments(message, stored, sticker_sizes):
+                    result["attachments"] = attachments
+                    attachment_ids.update(attachment[0] for attachment in attachments)
+                batch.append((None, result))
+            # Attachments that are already in the table are skipped on insert,
+            # so only the others are counted.
+            existing = await get_existing_attachments(conn, list(attachment_ids))
+            counts["attachments"] += len(attachment_ids - existing)
+            await flush_db_batch(conn, batch)
+
+            counts["messages"] += len(messages)
+            pbar.update(len(rows))
+        pbar.close()
+
+        print(
+            f"[INFO] Rebuilt {counts['messages']} messages and {counts['attachments']} "
+            f"new stored attachments from the archive"
+            + (f", {counts['failed']} could not be read" if counts["failed"] else "")
+        )
@@ -39,6 +39,9 @@ CREATE TABLE IF NOT EXISTS attachments(
     FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
 );
 
+-- For looking up the attachments of a batch of messages (export).
+CREATE INDEX IF NOT EXISTS attachments_message ON attachments(message_id);
+
 CREATE TABLE IF NOT EXISTS reactions(
     message_id TEXT NOT NULL,
     emoji TEXT NOT NULL,
@@ -46,3 +49,71 @@ CREATE TABLE IF NOT EXISTS reactions(
     FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE,
     UNIQUE(message_id, emoji)
 );
+
+CREATE TABLE IF NOT EXISTS checkpoints(
+    channel_id BIGINT PRIMARY KEY NOT NULL,
+    -- Every message between these two timestamps (in ms, inclusive) has been
+    -- fetched and written.
+    oldest_timestamp BIGINT NOT NULL,
+    newest_timestamp BIGINT NOT NULL,
+    -- Whether oldest_timestamp is the start of the thread.
+    complete BOOLEAN NOT NULL DEFAULT 0,
+    FOREIGN KEY (channel_id) REFERENCES channels(id) ON DELETE CASCADE
+);
+
+-- Time windows of a sharded backfill (dump --shards) that haven't been merged
+-- into the channel's checkpoint yet.
+CREATE TABLE IF NOT EXISTS checkpoint_shards(
+    channel_id BIGINT NOT NULL,
+    -- The shard covers messages after lower_timestamp (NULL for the oldest
+    -- shard, which runs to the start of the thread) up to upper_timestamp.
+    upper_timestamp BIGINT NOT NULL,
+    lower_timestamp BIGINT,
+    -- Every message of the shard from oldest_timestamp up has been written.
+    oldest_timestamp BIGINT,
+    complete BOOLEAN NOT NULL DEFAULT 0,
+    PRIMARY KEY (channel_id, upper_timestamp),
+    FOREIGN KEY (channel_id) REFERENCES channels(id) ON DELETE CASCADE
+);
+
+-- Files that were already stored, by the store they're in and the SHA-256 of
+-- their contents.
+CREATE TABLE IF NOT EXISTS media(
+    store TEXT NOT NULL, -- webhook or local:<directory>
+    digest TEXT NOT NULL,
+    `name` TEXT NOT NULL,
+    `url` TEXT NOT NULL,
+    PRIMARY KEY (store, digest)
+);
+
+-- Which file a Facebook attachment or sticker ID resolved to, so that it
+-- doesn't have to be downloaded again.
+CREATE TABLE IF NOT EXISTS media_sources(
+    store TEXT NOT NULL,
+    source_id TEXT NOT NULL, -- attachment:<id> or sticker:<id>
+    digest TEXT NOT NULL,
+    PRIMARY KEY (store, source_id),
+    FOREIGN KEY (store, digest) REFERENCES media(store, digest) ON DELETE CASCADE
+);
+
+-- Sticker metadata from Facebook. Where sticker images were stored is in
+-- media_sources.
+CREATE TABLE IF NOT EXISTS stickers(
+    id TEXT PRIMARY KEY NOT NULL,
+    uri TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    animated BOOLEAN NOT NULL DEFAULT 0
+);
+
+-- The raw GraphQL JSON of messages (dump --archive-raw), compressed with zstd
+-- using maufbapi's dictionary, for `reprocess` to rebuild messages from.
+CREATE TABLE IF NOT EXISTS raw_messages(
+    id TEXT PRIMARY KEY NOT NULL,
+    channel_id BIGINT NOT NULL,
+    `timestamp` BIGINT NOT NULL,
+    `data` BLOB NOT NULL,
+    FOREIGN KEY (id) REFERENCES messages(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS raw_messages_channel ON raw_messages(channel_id, `timestamp`);
@@ -0,0 +1,21 @@
+from .seen import BloomFilter, SeenIndex
+from .webhooks import WebhookPool
+from .store import TRANSFER_CHUNK_SIZE, AttachmentStore, LocalStore, WebhookStore
+from .pipeline import Backpressure, ConcurrencyLimit, TransferLimits, current_rss
+from .metrics import Metrics, serve_metrics, write_metrics_file
+from .profiling import RunProfiler, StageProfiler, profiler
+from .text import escape_markdown, format_message_text
+from .archive import RawArchive
+from .jsonstream import GzipBase64Writer, JSONStreamWriter
+from .rows import ATTACHMENT_TYPES, SenderCache, convert_message, count_db_rows, flush_db_batch
+from .sqlite import LOOKUP_CHUNK_SIZE, chunked
+from .accounts import AccountPool
+from .media import MediaCache, StickerResolver
+from .backfill import (
+    BackfillCheckpoint,
+    BackfillRun,
+    BackfillShard,
+    PageProgress,
+    PageSizer,
+    ThreadProgress,
+)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from maufbapi import AndroidAPI, AndroidState
+from maufbapi.http.errors import ResponseError
+from maufbapi.types.graphql import Thread
+
+
+class AccountPool:
+    """The accounts to fetch with, each with its own session and rate limit.
+
+    A thread is looked up with each account in turn until one can see it,
+    and for group threads, its participants tell which of the accounts are
+    members. Requests for the thread are then spread across the members:
+    each one goes to the member whose governor should let it through
+    soonest, given the requests it already has in flight. A one-to-one
+    thread is identified by the other user's ID, which means a different
+    thread to every other account, so it stays with the account that found
+    it.
+    """
+
+    def __init__(self, accounts: list[tuple[str, AndroidState, AndroidAPI]]) -> None:
+        self.accounts = accounts
+        self._in_flight: dict[AndroidAPI, int] = {api: 0 for _, _, api in accounts}
+        self._members: dict[int, list[AndroidAPI]] = {}
+
+    @property
+    def primary(self) -> AndroidAPI:
+        """The first account, used for requests that aren't about a thread."""
+        return self.accounts[0][2]
+
+    @property
+    def apis(self) -> list[AndroidAPI]:
+        return [api for _, _, api in self.accounts]
+
+    def members(self, thread_id: int) -> list[AndroidAPI]:
+        return self._members.get(thread_id) or [self.primary]
+
+    async def fetch_thread_info(self, thread_id: int) -> list[Thread]:
+        for name, _, api in self.accounts:
+            try:
+                thread_info = await api.fetch_thread_info(thread_id)
+            except ResponseError as e:
+                if len(self.accounts) == 1:
+                    raise
+                print(f"[WARN] Could not fetch thread {thread_id} with {name}: {e}")
+                continue
+            if not thread_info:
+                continue
+
+            info = thread_info[0]
+            members = [api]
+            if info.thread_key.thread_fbid and not info.thread_key.other_user_id:
+                participant_ids = {int(pcp.id) for pcp in info.all_participants.nodes}
+                members += [
+                    member
+                    for _, state, member in self.accounts
+                    if member is not api and state.session.uid in participant_ids
+                ]
+            self._members[thread_id] = members
+            if info.thread_key.id is not None:
+                self._members[info.thread_key.id] = members
+            return thread_info
+        return []
+
+    def pick(self, thread_id: int) -> AndroidAPI:
+        return min(
+            self.members(thread_id),
+            key=lambda api: api.governor.expected_wait(self._in_flight[api]),
+        )
+
+    async def fetch_messages(self, thread_id: int, *args, **kwargs):
+        api = self.pick(thread_id)
+        self._in_flight[api] += 1
+        try:
+            return await api.fetch_messages(thread_id, *args, **kwargs)
+        finally:
+            self._in_flight[api] -= 1
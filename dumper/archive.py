@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from typing import Any
+import json
+
+import zstandard as zstd
+
+from maufbapi.http.base import zstd_dict
+
+
+class RawArchive:
+    """Compresses raw GraphQL message nodes for the ``raw_messages`` table.
+
+    Nodes are stored as compact JSON compressed with zstd, using the
+    dictionary Facebook compresses its own GraphQL responses with, which
+    suits single messages much better than compressing them on their own.
+    """
+
+    def __init__(self, level: int = 3) -> None:
+        self._compressor = zstd.ZstdCompressor(level=level, dict_data=zstd_dict)
+        self._decompressor = zstd.ZstdDecompressor(dict_data=zstd_dict)
+
+    def compress(self, node: dict[str, Any]) -> bytes:
+        data = json.dumps(node, ensure_ascii=False, separators=(",", ":"))
+        return self._compressor.compress(data.encode("utf-8"))
+
+    def decompress(self, data: bytes) -> dict[str, Any]:
+        return json.loads(self._decompressor.decompress(data))
@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+from typing import Callable
+import asyncio
+import collections
+
+import aiosqlite
+from tqdm import tqdm
+
+
+class PageSizer:
+    """Number of messages to ask for in each fetch of a thread.
+
+    With ``adaptive`` unset this is simply ``size``. Otherwise the size grows
+    by a quarter after every few pages that came back well within
+    ``timeout``, and is halved when a fetch times out or fails. The size that
+    failed becomes a ceiling that's only slowly raised again, so the size
+    settles just under the largest page the server serves reliably for the
+    thread.
+    """
+
+    # Healthy pages in a row needed before growing.
+    GROW_AFTER = 3
+    # Healthy pages in a row needed before trying past the ceiling again.
+    PROBE_AFTER = 50
+
+    def __init__(
+        self,
+        size: int,
+        *,
+        adaptive: bool = False,
+        minimum: int = 20,
+        maximum: int = 500,
+        timeout: float = 60.0,
+    ) -> None:
+        self.adaptive = adaptive
+        self.minimum = min(minimum, size)
+        self.maximum = max(maximum, size)
+        self.timeout = timeout
+        self.size = size
+        self.ceiling = self.maximum
+        self._streak = 0
+
+    def success(self, latency: float) -> None:
+        if not self.adaptive:
+            return
+        if latency > self.timeout / 2:
+            # Slow enough to be close to failing.
+            self._streak = 0
+            self.size = max(self.minimum, self.size * 3 // 4)
+            return
+
+        self._streak += 1
+        if self._streak % self.PROBE_AFTER == 0:
+            self.ceiling = min(self.maximum, self.ceiling + max(self.ceiling // 10, 1))
+        if self._streak % self.GROW_AFTER == 0:
+            self.size = min(self.ceiling, max(self.size * 5 // 4, self.size + 1))
+
+    def failure(self) -> bool:
+        """Shrink after a failed fetch; returns whether it's worth retrying."""
+        if not self.adaptive or self.size <= self.minimum:
+            return False
+        self._streak = 0
+        self.ceiling = max(self.minimum, self.size * 9 // 10)
+        self.size = max(self.minimum, self.size // 2)
+        return True
+
+
+class ThreadProgress:
+    """Progress bar and in-flight queue item count for a single thread."""
+
+    def __init__(self, thread_id: int, pbar: tqdm) -> None:
+        self.thread_id = thread_id
+        self.pbar = pbar
+        self.pending = 0
+        # Pages that were kept out of the checkpoint by failed attachments.
+        self.failed = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    def add(self, count: int = 1) -> None:
+        self.pending += count
+        self._drained.clear()
+
+    def done(self, count: int = 1) -> None:
+        self.pending -= count
+        if self.pending <= 0:
+            self._drained.set()
+
+    async def wait(self) -> None:
+        await self._drained.wait()
+
+
+class PageProgress:
+    """Queue items belonging to a single fetched page of messages.
+
+    Used in place of the thread's :class:`ThreadProgress` for everything
+    queued from the page, so that the page knows when all of its rows and
+    attachments have been written.
+    """
+
+    def __init__(self, run: "BackfillRun", oldest_timestamp: int | None) -> None:
+        self.run = run
+        self.thread = run.thread
+        self.thread_id = run.thread.thread_id
+        self.pbar = run.thread.pbar
+        # None for the empty page that marks the start of the thread.
+        self.oldest_timestamp = oldest_timestamp
+        self.last = False
+        self.pending = 0
+        self.sealed = False
+        self.failed = False
+
+    @property
+    def complete(self) -> bool:
+        return self.sealed and self.pending <= 0 and not self.failed
+
+    def add(self, count: int = 1) -> None:
+        self.pending += count
+        self.thread.add(count)
+
+    def done(self, count: int = 1) -> None:
+        self.pending -= count
+        if self.complete:
+            self.run.page_complete()
+        self.thread.done(count)
+
+    def seal(self) -> None:
+        """Mark that everything from this page has been queued."""
+        self.sealed = True
+        if self.complete:
+            self.run.page_complete()
+
+    def fail(self) -> None:
+        """Mark that some of the page's attachments couldn't be stored.
+
+        The page then never completes, so the checkpoint stops short of it
+        and the next run fetches the page again, retrying the attachments
+        that are still missing.
+        """
+        if not self.failed:
+            self.failed = True
+            self.thread.failed += 1
+
+
+class BackfillRun:
+    """A backwards walk through part of a thread's history.
+
+    Pages are reported to ``on_page`` in the order they were fetched, and only
+    once everything queued for them has been written, so a checkpoint never
+    covers rows that are still in flight. Nothing after a failed page is
+    reported.
+    """
+
+    def __init__(
+        self,
+        thread: ThreadProgress,
+        on_page: Callable[[PageProgress], None],
+    ) -> None:
+        self.thread = thread
+        self.on_page = on_page
+        self._pages: collections.deque[PageProgress] = collections.deque()
+
+    def new_page(self, oldest_timestamp: int | None) -> PageProgress:
+        page = PageProgress(self, oldest_timestamp)
+        self._pages.append(page)
+        return page
+
+    def page_complete(self) -> None:
+        while self._pages and self._pages[0].complete:
+            self.on_page(self._pages.popleft())
+
+
+class BackfillCheckpoint:
+    """The range of a channel's history that has been completely fetched."""
+
+    def __init__(
+        self,
+        channel_id: int,
+        oldest_timestamp: int | None = None,
+        newest_timestamp: int | None = None,
+        complete: bool = False,
+    ) -> None:
+        self.channel_id = channel_id
+        self.oldest_timestamp = oldest_timestamp
+        self.newest_timestamp = newest_timestamp
+        self.complete = complete
+
+    @property
+    def exists(self) -> bool:
+        return self.oldest_timestamp is not None and self.newest_timestamp is not None
+
+    @classmethod
+    async def load(cls, conn: aiosqlite.Connection, channel_id: int) -> "BackfillCheckpoint":
+        async with conn.execute(
+            "SELECT oldest_timestamp, newest_timestamp, complete FROM checkpoints WHERE channel_id = ?",
+            (channel_id,),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return cls(channel_id)
+        return cls(channel_id, row[0], row[1], bool(row[2]))
+
+    def row(self) -> tuple[int, int, int, int]:
+        return (
+            self.channel_id,
+            self.oldest_timestamp,
+            self.newest_timestamp,
+            int(self.complete),
+        )
+
+
+class BackfillShard:
+    """One time window of a sharded backfill.
+
+    Covers the messages sent after ``lower_timestamp`` up to and including
+    ``upper_timestamp``. The oldest shard has no lower bound and runs to the
+    start of the thread, so the shards still cover everything if the thread
+    turns out to be older than expected.
+
+    How the messages of a thread are spread over time isn't known up front,
+    so shards that are still being walked can be :meth:`split`, handing the
+    older half of what they have left to a new shard.
+    """
+
+    # Shards with less than twice this much time left to walk aren't split.
+    MIN_SPLIT_MS = 60 * 60 * 1000
+
+    def __init__(
+        self,
+        channel_id: int,
+        upper_timestamp: int,
+        lower_timestamp: int | None,
+        oldest_timestamp: int | None = None,
+        complete: bool = False,
+    ) -> None:
+        self.channel_id = channel_id
+        self.upper_timestamp = upper_timestamp
+        self.lower_timestamp = lower_timestamp
+        self.oldest_timestamp = oldest_timestamp
+        self.complete = complete
+        # How far back the walk has fetched, which is ahead of
+        # oldest_timestamp while fetched pages are still being written.
+        self.position = self.resume_at
+
+    @property
+    def resume_at(self) -> int:
+        if self.oldest_timestamp is None:
+            return self.upper_timestamp
+        return self.oldest_timestamp - 1
+
+    def unwalked(self, since: int) -> int:
+        """Milliseconds left to walk; ``since`` bounds the oldest shard."""
+        lower = self.lower_timestamp if self.lower_timestamp is not None else since
+        return self.position - lower
+
+    def split(self, since: int) -> "BackfillShard | None":
+        """Hand the older half of what's left to walk to a new shard.
+
+        The walk of this shard stops at the new lower bound once it reads it
+        after its next page. Returns None if there's too little left.
+        """
+        if self.complete or self.unwalked(since) < 2 * self.MIN_SPLIT_MS:
+            return None
+        middle = self.position - self.unwalked(since) // 2
+        shard = BackfillShard(self.channel_id, middle, self.lower_timestamp)
+        self.lower_timestamp = middle
+        return shard
+
+    @classmethod
+    def plan(
+        cls,
+        channel_id: int,
+        upper_timestamp: int,
+        lower_timestamp: int,
+        count: int,
+    ) -> list["BackfillShard"]:
+        """Split a range into ``count`` equally long shards, newest first."""
+        span = (upper_timestamp - lower_timestamp) // count
+        bounds = [upper_timestamp - span * i for i in range(count)]
+        return [
+            cls(channel_id, upper, bounds[i + 1] if i + 1 < count else None)
+            for i, upper in enumerate(bounds)
+        ]
+
+    @classmethod
+    async def load_all(cls, conn: aiosqlite.Connection, channel_id: int) -> list["BackfillShard"]:
+        async with conn.execute(
+            "SELECT upper_timestamp, lower_timestamp, oldest_timestamp, complete "
+            "FROM checkpoint_shards WHERE channel_id = ? ORDER BY upper_timestamp DESC",
+            (channel_id,),
+        ) as cursor:
+            return [
+                cls(channel_id, row[0], row[1], row[2], bool(row[3]))
+                async for row in cursor
+            ]
+
+    def row(self) -> tuple[int, int, int | None, int | None, int]:
+        return (
+            self.channel_id,
+            self.upper_timestamp,
+            self.lower_timestamp,
+            self.oldest_timestamp,
+            int(self.complete),
+        )
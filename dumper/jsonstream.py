@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from typing import IO, Any, Callable
+import base64
+import json
+import zlib
+
+
+class JSONStreamWriter:
+    """Writes a JSON object piece by piece instead of all at once.
+
+    Objects are opened and closed with :meth:`begin` and :meth:`end`, and
+    everything in between is written with :meth:`item`, so only one item has
+    to be in memory at a time. The result is the same as ``json.dumps`` with
+    the same ``indent`` and ``ensure_ascii=False`` would give for the whole
+    object.
+    """
+
+    def __init__(self, write: Callable[[str], Any], *, indent: int | None = None) -> None:
+        self._write = write
+        self.indent = indent
+        # json.dumps leaves out the space after commas when indenting.
+        self._separator = ", " if indent is None else ","
+        # Number of items written so far to each open object.
+        self._counts: list[int] = []
+
+    def _newline(self, depth: int) -> str:
+        if self.indent is None:
+            return ""
+        return "\n" + " " * (self.indent * depth)
+
+    def _key(self, key: str | None) -> str:
+        if not self._counts:
+            return ""
+        prefix = self._separator if self._counts[-1] else ""
+        self._counts[-1] += 1
+        return f"{prefix}{self._newline(len(self._counts))}{json.dumps(key, ensure_ascii=False)}: "
+
+    def begin(self, key: str | None = None) -> None:
+        """Open an object, under ``key`` in the current one unless it's the outermost."""
+        self._write(self._key(key) + "{")
+        self._counts.append(0)
+
+    def item(self, key: str, value: Any) -> None:
+        data = json.dumps(value, indent=self.indent, ensure_ascii=False)
+        if self.indent is not None and self._counts:
+            # Strings in JSON never contain raw newlines, so this only
+            # indents the lines json.dumps broke the value into.
+            data = data.replace("\n", self._newline(len(self._counts)))
+        self._write(self._key(key) + data)
+
+    def end(self) -> None:
+        count = self._counts.pop()
+        self._write((self._newline(len(self._counts)) if count else "") + "}")
+
+
+class GzipBase64Writer:
+    """Gzip-compresses text and writes it out base64-encoded as it comes in.
+
+    Only the compressor's window and less than three bytes of compressed
+    data waiting for base64 are held, however much text is written.
+    """
+
+    def __init__(self, file: IO[str], *, level: int = 9) -> None:
+        self.file = file
+        # wbits of 16 + 15 makes zlib write a gzip header and trailer.
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._pending = b""
+
+    def _encode(self, data: bytes) -> None:
+        data = self._pending + data
+        # base64 turns every 3 bytes into 4 characters without padding.
+        end = len(data) - len(data) % 3
+        if end:
+            self.file.write(base64.b64encode(data[:end]).decode("ascii"))
+        self._pending = data[end:]
+
+    def write(self, text: str) -> None:
+        self._encode(self._compressor.compress(text.encode("utf-8")))
+
+    def close(self) -> None:
+        self._encode(self._compressor.flush())
+        self.file.write(base64.b64encode(self._pending).decode("ascii"))
+        self._pending = b""
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+from typing import Any
+import asyncio
+import contextlib
+
+import aiosqlite
+
+from maufbapi import AndroidAPI
+from maufbapi.http.errors import ResponseTypeError
+
+
+class MediaCache:
+    """Content-addressed index of files that were already stored.
+
+    Files are identified by the SHA-256 digest of their contents, and
+    Facebook attachment and sticker IDs are mapped to those digests, so that
+    the same file is only stored once and known attachments are not even
+    downloaded again. Entries are kept per store, by its ``key``, since a
+    file stored in one doesn't make it to another. New entries are written
+    through the db writer and kept in memory until then.
+    """
+
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        db_queue: asyncio.Queue,
+        store_key: str,
+    ) -> None:
+        self.conn = conn
+        self.db_queue = db_queue
+        self.store_key = store_key
+        self._by_digest: dict[str, tuple[str, str]] = {}
+        self._by_source: dict[str, str] = {}
+        self._locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+    @contextlib.asynccontextmanager
+    async def claim(self, key: str):
+        """Make concurrent transfers of the same file wait for each other."""
+        lock, users = self._locks.get(key, (asyncio.Lock(), 0))
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users <= 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+    async def get(self, digest: str) -> tuple[str, str] | None:
+        if digest in self._by_digest:
+            return self._by_digest[digest]
+        async with self.conn.execute(
+            "SELECT name, url FROM media WHERE store = ? AND digest = ?",
+            (self.store_key, digest),
+        ) as cursor:
+            row = await cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def get_source(self, source_id: str) -> tuple[str, str] | None:
+        if source_id in self._by_source:
+            return await self.get(self._by_source[source_id])
+        async with self.conn.execute(
+            "SELECT name, url FROM media_sources "
+            "JOIN media USING (store, digest) "
+            "WHERE store = ? AND source_id = ?",
+            (self.store_key, source_id),
+        ) as cursor:
+            row = await cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+    def remember(
+        self,
+        digest: str,
+        stored: tuple[str, str] | None = None,
+        source_id: str | None = None,
+    ) -> None:
+        result = {}
+        if stored and digest not in self._by_digest:
+            self._by_digest[digest] = stored
+            result["media"] = [(self.store_key, digest, *stored)]
+        if source_id and source_id not in self._by_source:
+            self._by_source[source_id] = digest
+            result["media_sources"] = [(self.store_key, source_id, digest)]
+        if result:
+            self.db_queue.put_nowait((None, result))
+
+
+class StickerResolver:
+    """Sticker metadata, fetched in batches and cached in the stickers table.
+
+    Sticker IDs can be announced with :meth:`want` as soon as they show up in
+    a page, and are then fetched together with the others that are wanted at
+    about the same time. Where the sticker images were stored is up to the
+    media cache.
+    """
+
+    def __init__(
+        self,
+        client: AndroidAPI,
+        conn: aiosqlite.Connection,
+        db_queue: asyncio.Queue,
+        *,
+        batch_size: int = 50,
+        batch_delay: float = 0.1,
+    ) -> None:
+        self.client = client
+        self.conn = conn
+        self.db_queue = db_queue
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._cache: dict[str, dict[str, Any] | None] = {}
+        self._futures: dict[str, asyncio.Future] = {}
+        self._pending: list[str] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def load(self) -> "StickerResolver":
+        """Load the stickers table; there are only so many stickers."""
+        async with self.conn.execute(
+            "SELECT id, uri, width, height, animated FROM stickers"
+        ) as cursor:
+            async for row in cursor:
+                self._cache[row[0]] = {
+                    "uri": row[1],
+                    "width": row[2],
+                    "height": row[3],
+                    "extension": "gif" if row[4] else "png",
+                }
+        return self
+
+    def want(self, sticker_id: str) -> asyncio.Future:
+        """Queue a sticker for the next batch unless it's known or on its way."""
+        if sticker_id in self._futures:
+            return self._futures[sticker_id]
+        future = asyncio.get_running_loop().create_future()
+        if sticker_id in self._cache:
+            future.set_result(self._cache[sticker_id])
+            return future
+
+        self._futures[sticker_id] = future
+        self._pending.append(sticker_id)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif not self._flush_handle:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_delay, self._flush
+            )
+        return future
+
+    async def resolve(self, sticker_id: str) -> dict[str, Any] | None:
+        """Sticker info, or None for stickers Facebook doesn't know.
+
+        Raises if the sticker's batch couldn't be fetched.
+        """
+        if sticker_id not in self._cache:
+            await asyncio.shield(self.want(sticker_id))
+        if sticker_id not in self._cache:
+            # The failure was already logged for the whole batch.
+            raise RuntimeError(f"Could not fetch sticker {sticker_id}")
+        return self._cache[sticker_id]
+
+    @staticmethod
+    def _row(sticker_id: str, info: dict[str, Any]) -> tuple:
+        return (
+            sticker_id,
+            info["uri"],
+            info["width"],
+            info["height"],
+            int(info["extension"] == "gif"),
+        )
+
+    def _flush(self) -> None:
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            task = asyncio.create_task(self._fetch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, batch: list[str]) -> None:
+        try:
+            resp = await self.client.fetch_stickers(
+                [int(sticker_id) for sticker_id in batch],
+                sticker_labels_enabled=True,
+            )
+            nodes = {sticker.id: sticker for sticker in resp.nodes}
+        except ResponseTypeError:
+            if len(batch) > 1:
+                # Don't let one bad sticker take the rest of the batch with it.
+                await asyncio.gather(*(self._fetch([sticker_id]) for sticker_id in batch))
+                return
+            nodes = {}
+        except Exception as e:
+            # Not cached, so that resolve() fails for them and they're tried
+            # again if they show up later.
+            print(f"[WARN] Failed to fetch {len(batch)} stickers: {e!r}")
+            for sticker_id in batch:
+                future = self._futures.pop(sticker_id)
+                if not future.done():
+                    future.set_result(None)
+            return
+
+        rows = []
+        for sticker_id in batch:
+            info = None
+            if sticker := nodes.get(sticker_id):
+                image = sticker.animated_image or sticker.thread_image
+                info = {
+                    "uri": image.uri,
+                    "width": image.width,
+                    "height": image.height,
+                    "extension": "gif" if sticker.animated_image else "png",
+                }
+                rows.append(self._row(sticker_id, info))
+            self._cache[sticker_id] = info
+            future = self._futures.pop(sticker_id)
+            if not future.done():
+                future.set_result(info)
+        if rows:
+            self.db_queue.put_nowait((None, {"stickers": rows}))
@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+from typing import Any, Callable
+import asyncio
+import collections
+import json
+import os
+import tempfile
+import time
+
+from aiohttp import web
+
+PREFIX = "messenger_dumper_"
+
+# Seconds; suits both GraphQL requests and database commits.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, **extra: str) -> str:
+    items = [*labels, *extra.items()]
+    if not items:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in items
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Meter:
+    """Events per second over a sliding window."""
+
+    def __init__(self, window: int = 60) -> None:
+        self.window = window
+        self._seconds: collections.deque[list[int]] = collections.deque()
+
+    def mark(self, count: float = 1) -> None:
+        second = int(time.monotonic())
+        if self._seconds and self._seconds[-1][0] == second:
+            self._seconds[-1][1] += count
+        else:
+            self._seconds.append([second, count])
+        self._trim(second)
+
+    def _trim(self, second: int) -> None:
+        while self._seconds and self._seconds[0][0] <= second - self.window:
+            self._seconds.popleft()
+
+    def rate(self) -> float:
+        self._trim(int(time.monotonic()))
+        return sum(count for _, count in self._seconds) / self.window
+
+
+class Metrics:
+    """Counters, gauges and histograms of a running dump.
+
+    Counters and histograms are updated as things happen, gauges are
+    functions that are only called when the metrics are read. Counters
+    that are already kept elsewhere can be read the same way. Everything
+    can be rendered in the Prometheus text format or as a JSON-able dict.
+    """
+
+    def __init__(self) -> None:
+        self.started_at = time.time()
+        self._help: dict[str, str] = {}
+        self._counters: dict[str, dict[Labels, float]] = {}
+        self._histograms: dict[str, dict[Labels, Histogram]] = {}
+        self._gauges: dict[str, Callable[[], float | dict[str, float]]] = {}
+        self._counter_funcs: dict[str, tuple[Callable[[], float | dict[str, float]], str]] = {}
+        self._meters: dict[str, Meter] = {}
+
+    def describe(self, name: str, help: str) -> None:
+        self._help[name] = help
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        series = self._counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+        if meter := self._meters.get(name):
+            meter.mark(value)
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        series = self._histograms.setdefault(name, {})
+        key = _labels(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def gauge(
+        self,
+        name: str,
+        func: Callable[[], float | dict[str, float]],
+        help: str | None = None,
+    ) -> None:
+        """Register a gauge; functions returning a dict give one series per key."""
+        self._gauges[name] = func
+        if help:
+            self.describe(name, help)
+
+    def counter(
+        self,
+        name: str,
+        func: Callable[[], float | dict[str, float]],
+        help: str | None = None,
+        label: str = "name",
+    ) -> None:
+        """Register a counter kept elsewhere, read when the metrics are.
+
+        Functions returning a dict give one series per key, under ``label``.
+        """
+        self._counter_funcs[name] = (func, label)
+        if help:
+            self.describe(name, help)
+
+    def meter(self, name: str, help: str | None = None, window: int = 60) -> None:
+        """Also publish the per-second rate of a counter.
+
+        The rate of ``<name>_total`` is published as ``<name>_per_second``.
+        """
+        self._meters[name] = Meter(window)
+        if help:
+            self.describe(self._rate_name(name), help)
+
+    @staticmethod
+    def _rate_name(name: str) -> str:
+        return f"{name.removesuffix('_total')}_per_second"
+
+    def _read_counters(self) -> dict[str, dict[Labels, float]]:
+        counters = dict(self._counters)
+        for name, (func, label) in self._counter_funcs.items():
+            value = func()
+            if isinstance(value, dict):
+                counters[name] = {((label, str(key)),): item for key, item in value.items()}
+            else:
+                counters[name] = {(): value}
+        return counters
+
+    def _read_gauges(self) -> dict[str, float | dict[str, float]]:
+        values = {name: func() for name, func in self._gauges.items()}
+        for name, meter in self._meters.items():
+            values[self._rate_name(name)] = meter.rate()
+        return values
+
+    def render_prometheus(self) -> str:
+        lines = []
+
+        def header(name: str, kind: str) -> None:
+            if help := self._help.get(name):
+                lines.append(f"# HELP {PREFIX}{name} {help}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for name, series in self._read_counters().items():
+            header(name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for name, value in self._read_gauges().items():
+            header(name, "gauge")
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    lines.append(f"{PREFIX}{name}{_format_labels((('name', str(key)),))} {item}")
+            else:
+                lines.append(f"{PREFIX}{name} {value}")
+        for name, series in self._histograms.items():
+            header(name, "histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{PREFIX}{name}_bucket{_format_labels(labels, le=str(bound))} {cumulative}"
+                    )
+                lines.append(
+                    f"{PREFIX}{name}_bucket{_format_labels(labels, le='+Inf')} {histogram.count}"
+                )
+                lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, Any]:
+        def key(labels: Labels) -> str:
+            return ",".join(f"{k}={v}" for k, v in labels) or "total"
+
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started_at,
+            "counters": {
+                name: {key(labels): value for labels, value in series.items()}
+                for name, series in self._read_counters().items()
+            },
+            "gauges": self._read_gauges(),
+            "histograms": {
+                name: {
+                    key(labels): {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(zip(map(str, histogram.buckets), histogram.counts)),
+                    }
+                    for labels, histogram in series.items()
+                }
+                for name, series in self._histograms.items()
+            },
+        }
+
+
+async def serve_metrics(metrics: Metrics, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    """Serve the metrics in the Prometheus text format at /metrics."""
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            text=metrics.render_prometheus(),
+            content_type="text/plain",
+            charset="utf-8",
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def _write_atomically(path: str, data: str) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def write_metrics_file(metrics: Metrics, path: str, interval: float = 10.0) -> None:
+    """Rewrite a JSON file with the metrics every ``interval`` seconds."""
+    try:
+        while True:
+            _write_atomically(path, json.dumps(metrics.snapshot(), indent=2))
+            await asyncio.sleep(interval)
+    finally:
+        # One last time, so the file ends up with the final numbers.
+        _write_atomically(path, json.dumps(metrics.snapshot(), indent=2))
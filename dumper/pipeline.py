@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def current_rss() -> int | None:
+    """Resident set size of this process in bytes, if it can be found out."""
+    if psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Backpressure:
+    """Holds back new work while the stages after it are falling behind.
+
+    Every queue has a depth it shouldn't grow past, and optionally the whole
+    process has an RSS limit. :meth:`wait` blocks while any of them is
+    exceeded. Producers call it before fetching more work, so queues can
+    only overshoot their depth by what a single fetch produces, while
+    callbacks can keep using ``put_nowait``.
+    """
+
+    def __init__(
+        self,
+        queues: dict[str, tuple[asyncio.Queue, int]],
+        *,
+        max_memory: int = 0,
+        poll_interval: float = 0.2,
+    ) -> None:
+        self.queues = {
+            name: (queue, depth)
+            for name, (queue, depth) in queues.items()
+            if queue is not None and depth > 0
+        }
+        self.max_memory = max_memory
+        self.poll_interval = poll_interval
+
+        self.pauses = 0
+        self.paused_seconds = 0.0
+
+    def depths(self) -> dict[str, int]:
+        return {name: queue.qsize() for name, (queue, _) in self.queues.items()}
+
+    def lagging(self) -> str | None:
+        """Why new work should wait, or None if it doesn't have to."""
+        for name, (queue, depth) in self.queues.items():
+            if queue.qsize() >= depth:
+                return f"{name} queue at {queue.qsize()}/{depth}"
+        # Memory isn't necessarily given back to the OS, so it's only worth
+        # waiting for while there's queued work that will free some up.
+        if (
+            self.max_memory
+            and any(queue.qsize() for queue, _ in self.queues.values())
+            and (rss := current_rss())
+            and rss >= self.max_memory
+        ):
+            return f"memory at {rss // 2**20}/{self.max_memory // 2**20} MiB"
+        return None
+
+    async def wait(self) -> None:
+        if not self.lagging():
+            return
+        self.pauses += 1
+        started_at = time.monotonic()
+        try:
+            while self.lagging():
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            self.paused_seconds += time.monotonic() - started_at
+
+
+class ConcurrencyLimit:
+    """Semaphore that keeps track of how busy it is.
+
+    A limit of 0 doesn't limit anything, but still counts.
+    """
+
+    def __init__(self, limit: int = 0) -> None:
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.active = 0
+        self.peak = 0
+        self.waiting = 0
+        self.total = 0
+        # Bytes moved by whoever holds the slots.
+        self.bytes = 0
+        self._started_at = self._changed_at = time.monotonic()
+        self._busy = 0.0
+
+    def _account(self) -> None:
+        now = time.monotonic()
+        self._busy += self.active * (now - self._changed_at)
+        self._changed_at = now
+
+    async def __aenter__(self) -> None:
+        if self._semaphore:
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+        self._account()
+        self.active += 1
+        self.total += 1
+        self.peak = max(self.peak, self.active)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._account()
+        self.active -= 1
+        if self._semaphore:
+            self._semaphore.release()
+
+    def average(self) -> float:
+        """Average number of slots in use since the limit was created."""
+        self._account()
+        elapsed = self._changed_at - self._started_at
+        return self._busy / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        limit = self.limit or "-"
+        text = f"{self.active}/{limit}"
+        if self.waiting:
+            text += f" +{self.waiting}"
+        return text
+
+
+class TransferLimits:
+    """How many attachment transfers of each kind may run at the same time.
+
+    0 means no limit.
+    """
+
+    def __init__(self, downloads: int = 0, lookups: int = 0, uploads: int = 0) -> None:
+        self.download = ConcurrencyLimit(downloads)
+        self.lookup = ConcurrencyLimit(lookups)
+        self.upload = ConcurrencyLimit(uploads)
+
+    def items(self) -> dict[str, ConcurrencyLimit]:
+        return {
+            "downloads": self.download,
+            "URL lookups": self.lookup,
+            "uploads": self.upload,
+        }
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from typing import Any
+import contextlib
+import cProfile
+import time
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+class StageStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.wall = 0.0
+        # None for stages that await, whose CPU time can't be told apart
+        # from that of whatever else ran in the meantime.
+        self.cpu: float | None = None
+
+
+class StageProfiler:
+    """Wall and CPU time spent in each stage of the pipeline.
+
+    Synchronous stages are measured with :meth:`stage`, which records both
+    wall and CPU time. Stages that await are measured with
+    :meth:`async_stage`, which only records wall time: concurrent stages
+    overlap, so their wall times add up to more than the run took.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.stages: dict[str, StageStats] = {}
+        self.started_at = time.perf_counter()
+        self._cpu_started_at = time.process_time()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.started_at = time.perf_counter()
+        self._cpu_started_at = time.process_time()
+
+    def record(self, name: str, wall: float, cpu: float | None = None, calls: int = 1) -> None:
+        stats = self.stages.get(name)
+        if not stats:
+            stats = self.stages[name] = StageStats()
+        stats.calls += calls
+        stats.wall += wall
+        if cpu is not None:
+            stats.cpu = (stats.cpu or 0.0) + cpu
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    @contextlib.asynccontextmanager
+    async def _async_stage(self, name: str):
+        wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall)
+
+    def stage(self, name: str) -> contextlib.AbstractContextManager:
+        return self._stage(name) if self.enabled else contextlib.nullcontext()
+
+    def async_stage(self, name: str) -> contextlib.AbstractAsyncContextManager:
+        return self._async_stage(name) if self.enabled else contextlib.nullcontext()
+
+    def report(self) -> str:
+        wall = time.perf_counter() - self.started_at
+        cpu = time.process_time() - self._cpu_started_at
+        lines = [
+            f"Run took {wall:.1f} s wall time and {cpu:.1f} s CPU time",
+            f"{'stage':<32} {'calls':>10} {'wall s':>10} {'% run':>7} {'cpu s':>10} {'ms/call':>9}",
+        ]
+        ranked = sorted(self.stages.items(), key=lambda item: item[1].wall, reverse=True)
+        for name, stats in ranked:
+            cpu_text = f"{stats.cpu:.2f}" if stats.cpu is not None else "-"
+            per_call = stats.wall / stats.calls * 1000 if stats.calls else 0
+            lines.append(
+                f"{name:<32} {stats.calls:>10} {stats.wall:>10.2f} "
+                f"{stats.wall / wall * 100 if wall else 0:>6.1f}% {cpu_text:>10} {per_call:>9.2f}"
+            )
+        return "\n".join(lines)
+
+
+# Stages are measured in many places, so there's one profiler per process
+# (like cProfile), which does nothing until it's enabled.
+profiler = StageProfiler()
+
+
+class RunProfiler:
+    """Whole-run profile with cProfile or pyinstrument's sampling profiler."""
+
+    def __init__(self, kind: str, output: str) -> None:
+        if kind == "sampling" and not pyinstrument:
+            raise RuntimeError("The sampling profiler needs pyinstrument to be installed")
+        self.kind = kind
+        self.output = output
+        self._profiler: Any = None
+
+    def start(self) -> None:
+        if self.kind == "sampling":
+            self._profiler = pyinstrument.Profiler(async_mode="disabled")
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self) -> None:
+        if self.kind == "sampling":
+            self._profiler.stop()
+            if self.output.endswith(".html"):
+                self._profiler.write_html(self.output)
+            else:
+                with open(self.output, "w") as f:
+                    f.write(self._profiler.output_text(unicode=True))
+        else:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.output)
@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+from typing import Any
+import itertools
+import time
+
+import aiosqlite
+
+from maufbapi.types.graphql import AttachmentType, Message
+
+from .metrics import Metrics
+from .profiling import profiler
+from .text import format_message_text
+
+# Attachment types as stored in the attachments table.
+ATTACHMENT_TYPES = {
+    AttachmentType.IMAGE: "image",
+    AttachmentType.ANIMATED_IMAGE: "gif",
+    AttachmentType.AUDIO: "audioclip",
+    AttachmentType.VIDEO: "video",
+    AttachmentType.FILE: "file",
+}
+
+
+def convert_message(
+    message: Message,
+    *,
+    thread_id: str | int,
+) -> dict[str, Any]:
+    msg_text = ""
+
+    if not message.is_user_generated:
+        # System messages don't have message text, they only have
+        # a snippet to describe what was going on.
+        msg_text = f"*{message.snippet}*"
+    elif message.message:
+        with profiler.stage("mentions and escape_markdown"):
+            msg_text = format_message_text(message.message.text, message.message.ranges)
+
+    result = {
+        "users": [
+            (
+                message.message_sender.id,
+                message.message_sender.messaging_actor.name or "Facebook user",
+                ""
+            )
+        ],
+        "message": (
+            message.message_id,
+            message.message_sender.id,
+            int(thread_id),
+            msg_text,
+            message.timestamp,
+            message.unsent_timestamp,
+        ),
+    }
+
+    if (
+        message.replied_to_message 
+        and message.replied_to_message.message
+        and (replied_to_id := message.replied_to_message.message.message_id)
+    ):
+        result["replied_to"] = (message.message_id, replied_to_id)
+    
+    if len(message.message_reactions) > 0:
+        reactions_grouped_by_emoji = itertools.groupby(
+            message.message_reactions,
+            lambda x: x.reaction
+        )
+        result["reactions"] = [
+            (
+                message.message_id,
+                reaction,
+                len(list(group)),
+            )
+            for reaction, group in reactions_grouped_by_emoji
+        ]
+
+    return result
+
+
+class SenderCache:
+    """IDs of users that already have a row, or have one queued.
+
+    Message senders are inserted with ``ON CONFLICT DO NOTHING``, so once a
+    user has a row, the row that comes with each of their messages doesn't
+    change anything. Those rows are dropped before they're even queued.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection) -> None:
+        self.conn = conn
+        self._ids: set[int] = set()
+
+    async def load(self) -> "SenderCache":
+        async with self.conn.execute("SELECT id FROM users") as cursor:
+            async for (user_id,) in cursor:
+                self._ids.add(user_id)
+        return self
+
+    def add(self, *user_ids: int | str) -> None:
+        self._ids.update(int(user_id) for user_id in user_ids)
+
+    def new_users(self, rows: list[tuple]) -> list[tuple]:
+        """Filter users rows down to users that don't have a row yet."""
+        new_rows = []
+        for row in rows:
+            user_id = int(row[0])
+            if user_id not in self._ids:
+                self._ids.add(user_id)
+                new_rows.append(row)
+        return new_rows
+
+    def filter(self, result: dict[str, Any]) -> dict[str, Any]:
+        if "users" in result:
+            if users := self.new_users(result["users"]):
+                result["users"] = users
+            else:
+                del result["users"]
+        return result
+
+
+# Statements run by the database writer, in the order they are run within a
+# batch. Each entry is (result key, whether the key holds a list of rows, SQL).
+_DB_STATEMENTS: list[tuple[str, bool, str]] = [
+    (
+        "channel",
+        False,
+        "INSERT INTO channels (id, name) VALUES (?, ?) ON CONFLICT DO UPDATE SET name=excluded.name",
+    ),
+    (
+        # Full participant info from the thread query, so existing users are
+        # updated with it.
+        "participants",
+        True,
+        (
+            "INSERT INTO users(id, name, avatar_url) VALUES (?, ?, ?) "
+            "ON CONFLICT DO UPDATE SET name=excluded.name, "
+            "avatar_url=coalesce(excluded.avatar_url, avatar_url)"
+        ),
+    ),
+    (
+        # Not updating existing users, since MinimalParticipants are less
+        # complete.
+        "users",
+        True,
+        (
+            "INSERT INTO users(id, name, avatar_url) VALUES (?, ?, ?) "
+            "ON CONFLICT DO NOTHING"
+        ),
+    ),
+    (
+        # It's very likely that the new version of the message has the same data
+        # or less (if it was unsent), since Messenger doesn't allow editing
+        # messages.
+        "message",
+        False,
+        (
+            "INSERT INTO messages(id, sender_id, channel_id, text, timestamp, unsent_timestamp) "
+            "VALUES (?, ?, ?, ?, ? ,?) "
+            "ON CONFLICT DO NOTHING"
+        ),
+    ),
+    (
+        # Messages that were unsent or otherwise changed since they were dumped,
+        # found by --latest.
+        "message_update",
+        False,
+        "UPDATE messages SET text = ?, unsent_timestamp = ? WHERE id = ?",
+    ),
+    (
+        # Raw message JSON for `reprocess` (dump --archive-raw). Replaced when
+        # a message is fetched again, like changed messages are.
+        "raw_messages",
+        True,
+        (
+            "INSERT INTO raw_messages(id, channel_id, timestamp, data) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET data=excluded.data"
+        ),
+    ),
+    (
+        # Same reason why messages are not updated; you can't switch what a message
+        # is replying to.
+        "replied_to",
+        False,
+        (
+            "INSERT INTO replied_to(message_id, replied_to_id) VALUES (?, ?)"
+            "ON CONFLICT DO NOTHING"
+        ),
+    ),
+    (
+        "attachments",
+        True,
+        (
+            "INSERT INTO attachments(id, message_id, name, type, url, width, height) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT DO NOTHING"
+        ),
+    ),
+    (
+        # Reactions of changed messages are replaced rather than merged, so
+        # that removed reactions go away.
+        "cleared_reactions",
+        True,
+        "DELETE FROM reactions WHERE message_id = ?",
+    ),
+    (
+        "reactions",
+        True,
+        (
+            "INSERT INTO reactions(message_id, emoji, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (message_id, emoji) DO UPDATE SET count=excluded.count"
+        ),
+    ),
+    (
+        "stickers",
+        True,
+        (
+            "INSERT INTO stickers(id, uri, width, height, animated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT DO UPDATE SET uri=excluded.uri, width=excluded.width, "
+            "height=excluded.height, animated=excluded.animated"
+        ),
+    ),
+    (
+        "media",
+        True,
+        (
+            "INSERT INTO media(store, digest, name, url) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT DO NOTHING"
+        ),
+    ),
+    (
+        "media_sources",
+        True,
+        (
+            "INSERT INTO media_sources(store, source_id, digest) VALUES (?, ?, ?) "
+            "ON CONFLICT DO NOTHING"
+        ),
+    ),
+    (
+        # Shards that were split also get a new lower bound.
+        "shards",
+        True,
+        (
+            "INSERT INTO checkpoint_shards(channel_id, upper_timestamp, lower_timestamp, "
+            "oldest_timestamp, complete) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (channel_id, upper_timestamp) DO UPDATE SET "
+            "lower_timestamp=excluded.lower_timestamp, "
+            "oldest_timestamp=excluded.oldest_timestamp, complete=excluded.complete"
+        ),
+    ),
+    (
+        # Shards that were merged into the checkpoint.
+        "merged_shards",
+        True,
+        "DELETE FROM checkpoint_shards WHERE channel_id = ? AND upper_timestamp = ?",
+    ),
+    (
+        # Last, so that a checkpoint is never committed without the rows it covers.
+        "checkpoint",
+        False,
+        (
+            "INSERT INTO checkpoints(channel_id, oldest_timestamp, newest_timestamp, complete) "
+            "VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (channel_id) DO UPDATE SET oldest_timestamp=excluded.oldest_timestamp, "
+            "newest_timestamp=excluded.newest_timestamp, complete=excluded.complete"
+        ),
+    ),
+]
+
+
+def count_db_rows(result: dict[str, Any]) -> int:
+    return sum(
+        (len(result[key]) if many else 1)
+        for key, many, _ in _DB_STATEMENTS
+        if key in result
+    )
+
+
+async def flush_db_batch(
+    conn: aiosqlite.Connection,
+    batch: list[tuple[Any, dict[str, Any]]],
+    metrics: Metrics | None = None,
+) -> None:
+    """Write a batch of ``(progress, result)`` pairs in one transaction.
+
+    ``progress`` is whatever tracks the rows of the result (``dump`` uses
+    its thread and page progress), or ``None``. Once the batch is committed,
+    its ``pbar`` is advanced for every message and ``done()`` is called.
+    """
+    rows = {key: [] for key, _, _ in _DB_STATEMENTS}
+    for _, result in batch:
+        for key, many, _ in _DB_STATEMENTS:
+            if key not in result:
+                continue
+            if many:
+                rows[key].extend(result[key])
+            else:
+                rows[key].append(result[key])
+
+    # sqlite3 opens a transaction implicitly before the first INSERT, so the
+    # whole batch is committed (and fsync'd) at once.
+    started_at = time.monotonic()
+    async with profiler.async_stage("database write"):
+        for key, _, statement in _DB_STATEMENTS:
+            if rows[key]:
+                await conn.executemany(statement, rows[key])
+        await conn.commit()
+    if metrics:
+        metrics.observe("db_commit_seconds", time.monotonic() - started_at)
+        metrics.inc("db_rows_total", sum(len(table_rows) for table_rows in rows.values()))
+
+    for progress, result in batch:
+        if progress is None:
+            # Bookkeeping rows that don't belong to any thread.
+            continue
+        if "message" in result:
+            progress.pbar.update(1)
+        progress.done()
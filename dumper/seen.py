@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from typing import Any, Iterable
+import hashlib
+import math
+
+import aiosqlite
+
+from .sqlite import chunked
+
+
+class BloomFilter:
+    """A plain Bloom filter over strings.
+
+    Never gives false negatives, and false positives at roughly
+    ``error_rate`` once ``capacity`` items have been added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    @property
+    def memory_size(self) -> int:
+        return len(self._bits)
+
+
+class SeenIndex:
+    """Membership index of IDs that are already stored in the database.
+
+    Up to ``max_ids`` IDs are kept in a hash set. Anything bigger is looked up
+    in SQLite instead, with an optional Bloom filter in front of it so that
+    IDs that are definitely new never reach the database.
+
+    ``verify_misses`` is for IDs that are unique across the whole table
+    rather than within the loaded scope (e.g. attachment IDs, which are
+    global, loaded per channel): IDs missing from the set are then still
+    looked up in the database before they're reported as new.
+    """
+
+    def __init__(
+        self,
+        conn: aiosqlite.Connection,
+        *,
+        count_query: str,
+        load_query: str,
+        lookup_query: str,
+        params: tuple[Any, ...] = (),
+        max_ids: int = 1_000_000,
+        bloom: bool = True,
+        verify_misses: bool = False,
+    ) -> None:
+        self.conn = conn
+        self.count_query = count_query
+        self.load_query = load_query
+        self.lookup_query = lookup_query
+        self.params = params
+        self.max_ids = max_ids
+        self.use_bloom = bloom
+        self.verify_misses = verify_misses
+
+        self.count = 0
+        self._ids: set[str] | None = None
+        self._bloom: BloomFilter | None = None
+        # IDs seen during this run, which may not have been written yet.
+        self._recent: set[str] = set()
+
+    @property
+    def in_memory(self) -> bool:
+        return self._ids is not None
+
+    async def load(self) -> SeenIndex:
+        async with self.conn.execute(self.count_query, self.params) as cursor:
+            self.count = (await cursor.fetchone())[0]
+
+        if self.count <= self.max_ids:
+            self._ids = set()
+            async with self.conn.execute(self.load_query, self.params) as cursor:
+                async for row in cursor:
+                    self._ids.add(row[0])
+        elif self.use_bloom:
+            # Leave room for what gets added during this run.
+            self._bloom = BloomFilter(int(self.count * 1.25))
+            async with self.conn.execute(self.load_query, self.params) as cursor:
+                async for row in cursor:
+                    self._bloom.add(row[0])
+        return self
+
+    def add(self, *ids: str) -> None:
+        if self._ids is not None:
+            self._ids.update(ids)
+            return
+        if self._bloom is not None:
+            for id in ids:
+                self._bloom.add(id)
+        self._recent.update(ids)
+        if len(self._recent) > self.max_ids:
+            # They've long been written by now.
+            self._recent.clear()
+
+    async def _lookup(self, ids: list[str]) -> set[str]:
+        found = set()
+        for chunk in chunked(ids):
+            query = self.lookup_query.format(", ".join("?" * len(chunk)))
+            async with self.conn.execute(query, chunk) as cursor:
+                async for row in cursor:
+                    found.add(row[0])
+        return found
+
+    async def seen(self, ids: Iterable[str]) -> set[str]:
+        """Return the subset of ``ids`` that is already stored."""
+        ids = {id for id in ids if id}
+        if not ids:
+            return set()
+
+        if self._ids is not None:
+            seen = ids & self._ids
+            if self.verify_misses and len(seen) < len(ids):
+                seen |= await self._lookup(list(ids - seen))
+            return seen
+
+        seen = ids & self._recent
+        candidates = [
+            id for id in ids - seen if self._bloom is None or id in self._bloom
+        ]
+        if candidates:
+            seen |= await self._lookup(candidates)
+        return seen
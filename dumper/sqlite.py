@@ -0,0 +1,14 @@
+from __future__ import annotations
+
+from typing import Iterator, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER is 999 on older versions.
+LOOKUP_CHUNK_SIZE = 500
+
+
+def chunked(items: Sequence[T], size: int = LOOKUP_CHUNK_SIZE) -> Iterator[Sequence[T]]:
+    """Split ``items`` for ``IN (...)`` lookups that bind one variable per item."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+from typing import IO, Any
+import asyncio
+import json
+import os
+import tempfile
+
+import aiohttp
+import aiohttp.payload
+from aiohttp.client_exceptions import ContentTypeError
+
+from maufbapi import AndroidAPI
+
+from .webhooks import WebhookPool
+
+# Files are streamed in chunks of this size.
+TRANSFER_CHUNK_SIZE = 64 * 1024
+
+
+class SpooledFilePayload(aiohttp.payload.Payload):
+    """Upload body that streams a file in fixed-size chunks.
+
+    Unlike aiohttp's own file payloads this doesn't need a real file
+    descriptor, so a SpooledTemporaryFile stays in memory while it's small.
+    """
+
+    def __init__(self, value: IO[bytes], size: int, **kwargs: Any) -> None:
+        super().__init__(value, **kwargs)
+        self._size = size
+
+    async def write(self, writer: Any) -> None:
+        self._value.seek(0)
+        while chunk := self._value.read(TRANSFER_CHUNK_SIZE):
+            await writer.write(chunk)
+
+
+class WebhookStore:
+    """Stores files as attachments of Discord webhook messages."""
+
+    # What the media cache tells stores apart by. Attachment URLs work no
+    # matter which webhook they were uploaded with.
+    key = "webhook"
+
+    def __init__(self, client: AndroidAPI, webhook_urls: list[str]) -> None:
+        self.client = client
+        self.pool = WebhookPool(webhook_urls)
+
+    async def store(
+        self,
+        file: IO[bytes],
+        size: int,
+        digest: str,
+        filename: str,
+    ) -> None | tuple[str, str]:
+        payload_json = json.dumps({
+            "attachments": [
+                {
+                    "id": 0,
+                    "filename": filename,
+                }
+            ],
+            "content": "",
+        })
+
+        while True:
+            # The body is streamed from the file, so it's rebuilt for every attempt.
+            form_data = aiohttp.FormData(quote_fields=False)
+            form_data.add_field(
+                "files[0]",
+                SpooledFilePayload(file, size, content_type="application/octet-stream"),
+                filename=filename,
+            )
+            form_data.add_field("payload_json", payload_json)
+
+            # Rate limits are waited out in the pool, not here.
+            webhook_url = await self.pool.acquire()
+            try:
+                resp = await self.client.http_post(webhook_url, data=form_data())
+                try:
+                    data = await resp.json()
+                except ContentTypeError:
+                    data = None
+            except BaseException:
+                self.pool.release(webhook_url)
+                raise
+            self.pool.release(webhook_url, resp.status, resp.headers, data)
+
+            if data is None or resp.status == 429:
+                continue
+            if "attachments" not in data:
+                return None
+            return data["attachments"][0]["filename"], data["attachments"][0]["url"]
+
+
+class LocalStore:
+    """Stores files in a content-addressed directory tree.
+
+    A file with digest ``abcdef...`` and name ``photo.jpg`` ends up at
+    ``ab/cd/abcdef....jpg`` under ``root``, and that relative path is what
+    goes into the database, for ``export`` to point at wherever the store
+    ends up. Files are written from a thread pool, into a temporary file
+    that's atomically renamed into place once it's complete.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.key = self.key_for(root)
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key_for(root: str) -> str:
+        """What the media cache tells this store apart from others by."""
+        return f"local:{os.path.abspath(root)}"
+
+    @staticmethod
+    def path_for(digest: str, filename: str) -> str:
+        extension = os.path.splitext(filename)[1].lower()
+        return "/".join((digest[:2], digest[2:4], f"{digest}{extension}"))
+
+    def _write(self, file: IO[bytes], path: str) -> None:
+        full_path = os.path.join(self.root, *path.split("/"))
+        if os.path.exists(full_path):
+            return
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                file.seek(0)
+                while chunk := file.read(TRANSFER_CHUNK_SIZE):
+                    out.write(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def store(
+        self,
+        file: IO[bytes],
+        size: int,
+        digest: str,
+        filename: str,
+    ) -> None | tuple[str, str]:
+        path = self.path_for(digest, filename)
+        await asyncio.to_thread(self._write, file, path)
+        return filename, path
+
+
+AttachmentStore = WebhookStore | LocalStore
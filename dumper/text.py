@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+from typing import Any, Sequence
+import re
+
+from mautrix.util import utf16_surrogate
+
+_MARKDOWN_ESCAPE_SUBREGEX = '|'.join(r'\{0}(?=([\s\S]*((?<!\{0})\{0})))'.format(c) for c in ('*', '`', '_', '~', '|'))
+
+_MARKDOWN_ESCAPE_COMMON = r'^>(?:>>)?\s|\[.+\]\(.+\)|^#{1,3}|^\s*-'
+
+_MARKDOWN_ESCAPE_REGEX = re.compile(fr'(?P<markdown>{_MARKDOWN_ESCAPE_SUBREGEX}|{_MARKDOWN_ESCAPE_COMMON})', re.MULTILINE)
+
+_URL_REGEX = r'(?P<url><[^: >]+:\/[^ >]+>|(?:https?|steam):\/\/[^\s<]+[^<.,:;\"\'\]\s])'
+
+_MARKDOWN_STOCK_REGEX = fr'(?P<markdown>[_\\~|\*`]|{_MARKDOWN_ESCAPE_COMMON})'
+
+_MARKDOWN_STOCK_ESCAPE = re.compile(_MARKDOWN_STOCK_REGEX, re.MULTILINE)
+_MARKDOWN_STOCK_ESCAPE_IGNORING_LINKS = re.compile(
+    f'(?:{_URL_REGEX}|{_MARKDOWN_STOCK_REGEX})', re.MULTILINE
+)
+# Every markdown match contains one of these, so text without them is left as is.
+_MARKDOWN_CHARS = re.compile(r'[_\\~|*`>\[#-]')
+# Text with these has UTF-16 offsets that differ from string indices.
+_NOT_BMP = re.compile('[\ud800-\udfff\U00010000-\U0010ffff]')
+_SURROGATES = re.compile('[\ud800-\udfff]')
+
+
+def _stock_replacement(match: re.Match) -> str:
+    if match.lastgroup == 'url':
+        return match.group(0)
+    return '\\' + match.group(0)
+
+
+def escape_markdown(text: str, *, as_needed: bool = False, ignore_links: bool = True) -> str:
+    r"""A helper function that escapes Discord's markdown.
+
+    Parameters
+    -----------
+    text: :class:`str`
+        The text to escape markdown from.
+    as_needed: :class:`bool`
+        Whether to escape the markdown characters as needed. This
+        means that it does not escape extraneous characters if it's
+        not necessary, e.g. ``**hello**`` is escaped into ``\*\*hello**``
+        instead of ``\*\*hello\*\*``. Note however that this can open
+        you up to some clever syntax abuse. Defaults to ``False``.
+    ignore_links: :class:`bool`
+        Whether to leave links alone when escaping markdown. For example,
+        if a URL in the text contains characters such as ``_`` then it will
+        be left alone. This option is not supported with ``as_needed``.
+        Defaults to ``True``.
+
+    Returns
+    --------
+    :class:`str`
+        The text with the markdown special characters escaped with a slash.
+    """
+
+    if not as_needed:
+        if not _MARKDOWN_CHARS.search(text):
+            return text
+        if ignore_links:
+            return _MARKDOWN_STOCK_ESCAPE_IGNORING_LINKS.sub(_stock_replacement, text)
+        return _MARKDOWN_STOCK_ESCAPE.sub(_stock_replacement, text)
+    else:
+        text = re.sub(r'\\', r'\\\\', text)
+        return _MARKDOWN_ESCAPE_REGEX.sub(r'\\\1', text)
+
+
+def _apply_mentions(text: str, ranges: Sequence[Any]) -> str:
+    # Ranges are applied last to first, each to the result of the previous
+    # one. When they're in order, inside the text and don't overlap, that's
+    # the same as splicing them all into the original text at once.
+    mentions = [m for m in reversed(ranges) if m.entity and m.entity.id]
+    if not mentions:
+        return text
+    in_order = True
+    end = len(text)
+    for m in mentions:
+        if m.offset < 0 or m.length < 0 or m.offset + m.length > end:
+            in_order = False
+            break
+        end = m.offset
+    if not in_order:
+        for m in mentions:
+            text = f"{text[:m.offset]}<@{m.entity.id}>{text[m.offset + m.length:]}"
+        return text
+
+    parts = []
+    end = len(text)
+    for m in mentions:
+        parts.append(text[m.offset + m.length:end])
+        parts.append(f"<@{m.entity.id}>")
+        end = m.offset
+    parts.append(text[:end])
+    parts.reverse()
+    return "".join(parts)
+
+
+def format_message_text(text: str, ranges: Sequence[Any] = ()) -> str:
+    """Replace mentions in message text with ``<@id>`` and escape markdown.
+
+    ``ranges`` are Messenger's ``MessageRange``\\s, whose offsets count
+    UTF-16 code units. The result is the same as replacing each range in
+    turn on the text with surrogate pairs added, removing them again and
+    passing the result to :func:`escape_markdown`, but the surrogate round
+    trip is only made for text that needs it, mentions are spliced in with
+    one join, and escaping is skipped for text without markdown characters.
+    """
+    if ranges:
+        if _NOT_BMP.search(text):
+            text = utf16_surrogate.remove(_apply_mentions(utf16_surrogate.add(text), ranges))
+        else:
+            text = _apply_mentions(text, ranges)
+    elif _SURROGATES.search(text):
+        # Surrogates in the text itself don't survive the round trip unchanged.
+        text = utf16_surrogate.remove(utf16_surrogate.add(text))
+    return escape_markdown(text)
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+from typing import Any, Mapping
+import asyncio
+import math
+import time
+
+# How long to stay away from a webhook that answered with something
+# unexpected and didn't say when to come back.
+_DEFAULT_BACKOFF = 60.0
+
+
+class _Bucket:
+    """Discord rate limit state of one bucket."""
+
+    def __init__(self) -> None:
+        self.limit: int | None = None
+        # None until the first response tells us what the limit is.
+        self.remaining: int | None = None
+        self.reset_at = 0.0
+        # Longest Reset-After seen, used to guess when a fresh window resets.
+        self.window = 1.0
+        self.in_flight = 0
+
+    def available_at(self, now: float) -> float:
+        if self.remaining is not None and self.remaining <= 0 and now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        if self.remaining is None:
+            # Send a single request to learn the limits first.
+            return now if self.in_flight == 0 else math.inf
+        if self.remaining > 0:
+            return now
+        return self.reset_at
+
+
+class WebhookPool:
+    """Spreads uploads over several webhooks according to their rate limits.
+
+    Rate limit headers of every response are tracked per bucket. Webhooks
+    that Discord reports as sharing a bucket (``X-RateLimit-Bucket``) share
+    its state, and global rate limits pause the whole pool. Uploads wait
+    in a single FIFO queue for whichever webhook frees up first, instead of
+    each sleeping on a randomly picked one, so throughput grows with the
+    number of webhooks.
+    """
+
+    def __init__(self, urls: list[str]) -> None:
+        self.urls = list(urls)
+        self._bucket_keys: dict[str, str] = {url: url for url in self.urls}
+        self._buckets: dict[str, _Bucket] = {url: _Bucket() for url in self.urls}
+        self._global_reset_at = 0.0
+        self._lock = asyncio.Lock()
+        self._changed = asyncio.Event()
+
+        self.uploads = {url: 0 for url in self.urls}
+        self.rate_limited = 0
+
+    def _bucket(self, url: str) -> _Bucket:
+        return self._buckets[self._bucket_keys[url]]
+
+    def _earliest(self) -> tuple[str, float]:
+        now = time.monotonic()
+        best_url, best_at = self.urls[0], math.inf
+        for url in self.urls:
+            available_at = max(self._bucket(url).available_at(now), self._global_reset_at)
+            if available_at < best_at:
+                best_url, best_at = url, available_at
+        return best_url, best_at
+
+    async def acquire(self) -> str:
+        """Wait for a webhook that can take a request right now and reserve it.
+
+        Every acquired webhook must be handed back with :meth:`release`.
+        """
+        async with self._lock:
+            while True:
+                url, available_at = self._earliest()
+                delay = available_at - time.monotonic()
+                if delay <= 0:
+                    bucket = self._bucket(url)
+                    bucket.in_flight += 1
+                    if bucket.remaining is not None:
+                        bucket.remaining -= 1
+                    self.uploads[url] += 1
+                    return url
+
+                # Wake up early if a response changes the picture.
+                self._changed.clear()
+                waiter = asyncio.ensure_future(self._changed.wait())
+                try:
+                    await asyncio.wait({waiter}, timeout=None if math.isinf(delay) else delay)
+                finally:
+                    waiter.cancel()
+
+    def release(
+        self,
+        url: str,
+        status: int | None = None,
+        headers: Mapping[str, str] | None = None,
+        data: Any = None,
+    ) -> None:
+        """Hand a webhook back along with the response it produced, if any.
+
+        ``data`` is the decoded JSON body, or None if it wasn't JSON.
+        """
+        now = time.monotonic()
+        headers = headers or {}
+
+        if bucket_id := headers.get("X-RateLimit-Bucket"):
+            bucket = self._bucket(url)
+            shared = self._buckets.setdefault(bucket_id, bucket)
+            if shared is not bucket:
+                shared.in_flight += bucket.in_flight
+            self._bucket_keys[url] = bucket_id
+        bucket = self._bucket(url)
+        bucket.in_flight = max(bucket.in_flight - 1, 0)
+
+        if limit := headers.get("X-RateLimit-Limit"):
+            bucket.limit = int(limit)
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        new_window = False
+        if reset_after:
+            bucket.window = max(bucket.window, float(reset_after))
+            reset_at = now + float(reset_after)
+            # Reset-After is rounded, so only a clearly later reset is a new window.
+            new_window = reset_at > bucket.reset_at + 0.1
+            bucket.reset_at = reset_at
+        if (remaining := headers.get("X-RateLimit-Remaining")) is not None:
+            # Requests still in flight will use up some of what's left.
+            remaining = max(int(remaining) - bucket.in_flight, 0)
+            if bucket.remaining is None or new_window:
+                bucket.remaining = remaining
+            else:
+                bucket.remaining = min(bucket.remaining, remaining)
+
+        if status == 429:
+            self.rate_limited += 1
+            retry_after = None
+            if isinstance(data, dict) and "retry_after" in data:
+                retry_after = float(data["retry_after"])
+            elif headers.get("Retry-After"):
+                retry_after = float(headers["Retry-After"])
+            retry_after = retry_after if retry_after is not None else _DEFAULT_BACKOFF
+
+            is_global = (
+                headers.get("X-RateLimit-Global", "").lower() == "true"
+                or (isinstance(data, dict) and data.get("global"))
+                or headers.get("X-RateLimit-Scope") == "global"
+            )
+            if is_global:
+                self._global_reset_at = max(self._global_reset_at, now + retry_after)
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, now + retry_after)
+        elif status is not None and status >= 400 and data is None and not reset_after:
+            # An error page rather than an API response, e.g. from Cloudflare.
+            bucket.remaining = 0
+            bucket.reset_at = now + _DEFAULT_BACKOFF
+
+        self._changed.set()
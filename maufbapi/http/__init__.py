@@ -8,3 +8,5 @@ from .errors import (
     ResponseError,
     TwoFactorRequired,
 )
+from .governor import RateGovernor, is_rate_limit_error
+from .cassette import Cassette, CassetteMiss
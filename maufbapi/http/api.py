@@ -189,13 +189,22 @@ class AndroidAPI(LoginAPI, PostLoginAPI, UploadAPI, BaseAndroidAPI):
         )
         return resp.messaging_actors
 
-    async def fetch_messages(self, thread_id: int, before_time_ms: int, **kwargs) -> MessageList:
+    async def fetch_messages(
+        self,
+        thread_id: int,
+        before_time_ms: int,
+        timeout: float | None = None,
+        raw: bool = False,
+        **kwargs,
+    ) -> MessageList | JSON:
         return await self.graphql(
             MoreMessagesQuery(
                 thread_id=str(thread_id), before_time_ms=str(before_time_ms), **kwargs
             ),
             path=["data", "message_thread", "messages"],
-            response_type=MessageList,
+            # The raw JSON of the message list can be deserialized with MessageList later.
+            response_type=JSON if raw else MessageList,
+            timeout=timeout,
         )
 
     async def fetch_stickers(self, ids: list[int], **kwargs) -> StickerPreviewResponse:
@@ -15,10 +15,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
-from typing import Awaitable, Callable, Type, TypeVar
+from typing import TYPE_CHECKING, Awaitable, Callable, Type, TypeVar
 from contextlib import asynccontextmanager
 from functools import partial
 from urllib.parse import quote, urlparse
+import asyncio
 import base64
 import hashlib
 import json
@@ -40,12 +41,16 @@ from mautrix.util.proxy import ProxyHandler, proxy_with_retry
 from ..state import AndroidState
 from ..types import GraphQLMutation, GraphQLQuery
 from .errors import GraphQLError, ResponseError, ResponseTypeError, error_class_map, error_code_map
+from .governor import RateGovernor
 
 try:
     from aiohttp_socks import ProxyConnector
 except ImportError:
     ProxyConnector = None
 
+if TYPE_CHECKING:
+    from .cassette import Cassette
+
 
 T = TypeVar("T")
 
@@ -68,6 +73,14 @@ class BaseAndroidAPI:
     rupload_url = URL("https://rupload.facebook.com")
     http: ClientSession
     log: TraceLogger
+    # Paces and retries GraphQL requests if set
+    governor: RateGovernor | None = None
+    # Called with the friendly name, duration and error (if any) of every GraphQL request
+    graphql_observer: Callable[[str, float, BaseException | None], None] | None = None
+    # Called with the name, wall time and CPU time of response processing steps
+    stage_observer: Callable[[str, float, float], None] | None = None
+    # Records or replays GraphQL exchanges if set
+    cassette: Cassette | None
 
     # Seems to be a per-minute request identifier
     _cid: str
@@ -84,11 +97,13 @@ class BaseAndroidAPI:
         log: TraceLogger | None = None,
         proxy_handler: ProxyHandler | None = None,
         on_proxy_update: Callable[[], Awaitable[None]] | None = None,
+        cassette: Cassette | None = None,
     ) -> None:
         self.log = log or logging.getLogger("maufbapi.http")
 
         self.proxy_handler = proxy_handler
         self.on_proxy_update = on_proxy_update
+        self.cassette = cassette
         self.setup_http()
 
         self.state = state
@@ -177,7 +192,10 @@ class BaseAndroidAPI:
             else:
                 self.log.warning("http_proxy is set, but aiohttp-socks is not installed")
 
-        self.http = ClientSession(connector=connector)
+        if self.cassette:
+            self.http = self.cassette.session(connector=connector)
+        else:
+            self.http = ClientSession(connector=connector)
         return None
 
     def raw_http_get(
@@ -228,6 +246,7 @@ class BaseAndroidAPI:
         response_type: Type[T] | None = JSON,
         path: list[str] | None = None,
         b: bool = True,
+        timeout: float | None = None,
     ) -> T:
         headers = {
             **self._headers,
@@ -262,6 +281,34 @@ class BaseAndroidAPI:
             del params["doc_id"]
         if not req.include_client_country_code:
             params.pop("client_country_code")
+        request = partial(self._graphql_request, req, params, headers, response_type, path, b)
+        if self.graphql_observer:
+            request = partial(self._observe_graphql, req.__class__.__name__, request)
+        if self.governor:
+            return await self.governor.run(request, timeout=timeout)
+        if timeout:
+            return await asyncio.wait_for(request(), timeout)
+        return await request()
+
+    async def _observe_graphql(self, name: str, request: Callable[[], Awaitable[T]]) -> T:
+        started_at = time.monotonic()
+        try:
+            result = await request()
+        except BaseException as e:
+            self.graphql_observer(name, time.monotonic() - started_at, e)
+            raise
+        self.graphql_observer(name, time.monotonic() - started_at, None)
+        return result
+
+    async def _graphql_request(
+        self,
+        req: GraphQLQuery,
+        params: dict[str, str],
+        headers: dict[str, str],
+        response_type: Type[T] | None,
+        path: list[str] | None,
+        b: bool,
+    ) -> T:
         resp = await self.http_post(
             url=(self.b_graph_url if b else self.graph_url) / "graphql",
             data=params,
@@ -272,14 +319,32 @@ class BaseAndroidAPI:
         if response_type is None:
             self._handle_response_headers(resp)
             return None
+        started_at = self._stage_started()
         json_data = await self._handle_response(resp)
+        started_at = self._stage_done("graphql decode", started_at)
         if path:
             for item in path:
                 json_data = json_data[item]
         if response_type is not JSON:
-            return response_type.deserialize(json_data)
+            result = response_type.deserialize(json_data)
+            self._stage_done("graphql deserialize", started_at)
+            return result
         return json_data
 
+    def _stage_started(self) -> tuple[float, float] | None:
+        if not self.stage_observer:
+            return None
+        return time.perf_counter(), time.thread_time()
+
+    def _stage_done(
+        self, name: str, started_at: tuple[float, float] | None
+    ) -> tuple[float, float] | None:
+        if not started_at:
+            return None
+        now = time.perf_counter(), time.thread_time()
+        self.stage_observer(name, now[0] - started_at[0], now[1] - started_at[1])
+        return now
+
     async def _decompress_zstd(self, resp: ClientResponse) -> None:
         if (
             resp.headers.get("content-encoding") == "x-fb-dz"
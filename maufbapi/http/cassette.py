@@ -0,0 +1,251 @@
+# mautrix-facebook - A Matrix-Facebook Messenger puppeting bridge.
+# Copyright (C) 2022 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Any, Iterable, Iterator
+from collections import defaultdict, deque
+import base64
+import json
+import re
+
+from aiohttp import ClientResponse, ClientSession
+from aiohttp.client import _RequestContextManager
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from .base import zstd_decomp
+
+# Long-lived user access tokens all start with EAA.
+_TOKEN_RE = re.compile(r"EAA[A-Za-z0-9]{20,}")
+_TOKEN_FIELD_RE = re.compile(r'(access_token["\']?\s*[=:]\s*["\']?)[^"\'&\s,}]+')
+SCRUBBED = "<scrubbed>"
+# Response headers that are kept, the rest isn't needed for decoding.
+_KEPT_HEADERS = ("content-type", "content-encoding", "x-fb-dz-dict")
+# Variables that depend on when the request was made (the first page of a
+# thread is fetched from the current time).
+_VOLATILE_VARIABLES = ("before_time_ms",)
+
+
+class CassetteMiss(LookupError):
+    """A request was made in replay mode that wasn't recorded."""
+
+
+class Cassette:
+    """Recorded GraphQL exchanges, for replaying them without the network.
+
+    In ``record`` mode, sessions made by :meth:`session` make real requests
+    and append every GraphQL exchange to ``path`` as a line of JSON: the
+    friendly name, doc ID and variables of the request, and the status,
+    relevant headers and raw (possibly zstd-compressed) body of the
+    response. Access tokens are scrubbed on the way. Other requests pass
+    through without being recorded.
+
+    In ``replay`` mode, sessions answer GraphQL requests from the file
+    instead, without any delay. Each recorded response for a request is
+    replayed once in order, and the last one is repeated after that. If
+    there's no recording with exactly the same variables, one that only
+    differs in time-dependent variables is used instead. Requests that
+    weren't recorded raise :class:`CassetteMiss`.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", secrets: Iterable[str] = ()) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.secrets = {secret for secret in secrets if secret}
+        self.recorded = 0
+        self.replayed = 0
+        self._entries: dict[tuple[str, str], deque[dict[str, Any]]] = defaultdict(deque)
+        self._loose_entries: dict[tuple[str, str], deque[dict[str, Any]]] = defaultdict(deque)
+        if mode == "replay":
+            with open(path) as f:
+                for entry in self.load(f):
+                    name, variables = entry["friendly_name"], entry["variables"]
+                    self._entries[self.key(name, variables)].append(entry)
+                    self._loose_entries[self.loose_key(name, variables)].append(entry)
+
+    @staticmethod
+    def load(lines: Iterator[str]) -> Iterator[dict[str, Any]]:
+        for line in lines:
+            if line.strip():
+                entry = json.loads(line)
+                entry["body"] = base64.b64decode(entry["body"])
+                yield entry
+
+    @staticmethod
+    def key(friendly_name: str, variables: Any) -> tuple[str, str]:
+        return friendly_name, json.dumps(variables, sort_keys=True)
+
+    @classmethod
+    def loose_key(cls, friendly_name: str, variables: Any) -> tuple[str, str]:
+        if isinstance(variables, dict):
+            variables = {k: v for k, v in variables.items() if k not in _VOLATILE_VARIABLES}
+        return cls.key(friendly_name, variables)
+
+    @staticmethod
+    def decode_body(entry: dict[str, Any]) -> bytes:
+        """The plain body of a recorded response."""
+        if (
+            entry["headers"].get("content-encoding") == "x-fb-dz"
+            and entry["headers"].get("x-fb-dz-dict") == "1"
+        ):
+            return zstd_decomp.decompress(entry["body"])
+        return entry["body"]
+
+    def session(self, **kwargs: Any) -> RecordingSession | ReplaySession:
+        if self.mode == "record":
+            return RecordingSession(self, ClientSession(**kwargs))
+        return ReplaySession(self)
+
+    def scrub(self, text: str) -> str:
+        for secret in self.secrets:
+            text = text.replace(secret, SCRUBBED)
+        text = _TOKEN_RE.sub(SCRUBBED, text)
+        return _TOKEN_FIELD_RE.sub(rf"\1{SCRUBBED}", text)
+
+    def _scrub_body(self, headers: dict[str, str], body: bytes) -> tuple[dict[str, str], bytes]:
+        entry = {"headers": headers, "body": body}
+        plain = self.decode_body(entry)
+        text = plain.decode("utf-8", errors="surrogateescape")
+        scrubbed = self.scrub(text)
+        if scrubbed == text:
+            return headers, body
+        # Stored uncompressed, as recompressing wouldn't give the original bytes anyway.
+        headers = {k: v for k, v in headers.items() if k not in ("content-encoding", "x-fb-dz-dict")}
+        return headers, scrubbed.encode("utf-8", errors="surrogateescape")
+
+    def record(self, params: dict[str, str], resp: ClientResponse, body: bytes) -> None:
+        headers = {
+            name: resp.headers[name] for name in _KEPT_HEADERS if name in resp.headers
+        }
+        headers, body = self._scrub_body(headers, body)
+        entry = {
+            "friendly_name": params["fb_api_req_friendly_name"],
+            "doc_id": params.get("doc_id") or params.get("client_doc_id"),
+            "variables": json.loads(self.scrub(params["variables"])),
+            "status": resp.status,
+            "headers": headers,
+            "body": base64.b64encode(body).decode("ascii"),
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.recorded += 1
+
+    def replay(self, params: dict[str, str]) -> dict[str, Any]:
+        name, variables = params["fb_api_req_friendly_name"], json.loads(params["variables"])
+        entries = self._entries.get(self.key(name, variables))
+        if not entries:
+            entries = self._loose_entries.get(self.loose_key(name, variables))
+        if not entries:
+            raise CassetteMiss(
+                f"No recorded response for {name} with variables {params['variables']}"
+            )
+        self.replayed += 1
+        return entries.popleft() if len(entries) > 1 else entries[0]
+
+
+def _graphql_params(kwargs: dict[str, Any]) -> dict[str, str] | None:
+    data = kwargs.get("data")
+    if isinstance(data, dict) and "fb_api_req_friendly_name" in data and "variables" in data:
+        return data
+    return None
+
+
+class RecordingSession:
+    """Wraps a :class:`ClientSession` to record GraphQL exchanges."""
+
+    def __init__(self, cassette: Cassette, session: ClientSession) -> None:
+        self.cassette = cassette
+        self.session = session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.session, name)
+
+    async def _request(self, method: str, url: str | URL, **kwargs: Any) -> ClientResponse:
+        resp = await self.session.request(method, url, **kwargs)
+        if params := _graphql_params(kwargs):
+            # The body is cached in the response, so it can still be read normally.
+            self.cassette.record(params, resp, await resp.read())
+        return resp
+
+    def request(self, method: str, url: str | URL, **kwargs: Any) -> _RequestContextManager:
+        return _RequestContextManager(self._request(method, url, **kwargs))
+
+    def get(self, url: str | URL, **kwargs: Any) -> _RequestContextManager:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str | URL, **kwargs: Any) -> _RequestContextManager:
+        return self.request("POST", url, **kwargs)
+
+    async def close(self) -> None:
+        await self.session.close()
+
+
+class ReplayResponse:
+    """The parts of :class:`ClientResponse` that responses are read with."""
+
+    def __init__(self, method: str, url: URL, entry: dict[str, Any]) -> None:
+        self.method = method
+        self.url = url
+        self.status = entry["status"]
+        self.headers = CIMultiDictProxy(CIMultiDict(entry["headers"]))
+        self._body = entry["body"]
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return self._body.decode(encoding, errors)
+
+    async def json(self, **_: Any) -> Any:
+        return json.loads(self._body)
+
+    def release(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class ReplaySession:
+    """Stands in for a :class:`ClientSession`, answering from a cassette."""
+
+    def __init__(self, cassette: Cassette) -> None:
+        self.cassette = cassette
+        self.closed = False
+
+    async def _request(self, method: str, url: str | URL, **kwargs: Any) -> ReplayResponse:
+        params = _graphql_params(kwargs)
+        if not params:
+            raise CassetteMiss(f"Only GraphQL requests can be replayed, not {method} {url}")
+        return ReplayResponse(method, URL(url), self.cassette.replay(params))
+
+    def request(self, method: str, url: str | URL, **kwargs: Any) -> _RequestContextManager:
+        return _RequestContextManager(self._request(method, url, **kwargs))
+
+    def get(self, url: str | URL, **kwargs: Any) -> _RequestContextManager:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str | URL, **kwargs: Any) -> _RequestContextManager:
+        return self.request("POST", url, **kwargs)
+
+    async def close(self) -> None:
+        self.closed = True
@@ -0,0 +1,212 @@
+# mautrix-facebook - A Matrix-Facebook Messenger puppeting bridge.
+# Copyright (C) 2022 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from typing import Awaitable, Callable, TypeVar
+from contextvars import ContextVar
+import asyncio
+import logging
+import time
+
+from .errors import RateLimitExceeded, ResponseError
+
+T = TypeVar("T")
+
+# How long the last request made in the current context took, not counting
+# the time it spent waiting for its turn.
+last_request_seconds: ContextVar[float | None] = ContextVar("last_request_seconds", default=None)
+
+
+def is_rate_limit_error(e: ResponseError) -> bool:
+    if isinstance(e, RateLimitExceeded):
+        return True
+    code = e.data.get("code", "")
+    subcode = e.data.get("subcode") or e.data.get("error_subcode")
+    code_str = f"{code}.{subcode}" if subcode else str(code)
+    return code_str == "1675004"  # Rate limit exceeded
+
+
+class RateGovernor:
+    """Paces requests at a rate learned from the server's rate limits.
+
+    Requests are taken from a token bucket that refills at ``rate`` requests
+    per second. Every successful request raises the rate a little (additive
+    increase, more cautiously near the rate that last got limited), and a
+    rate limit error halves it (multiplicative decrease). After a rate limit
+    everything is paused for ``probe_delay`` seconds and then a single probe
+    request is let through; the pause doubles every time the probe is rate
+    limited too, up to ``max_probe_delay``. Rate limited requests are retried
+    up to ``max_retries`` times.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float = 2.0,
+        min_rate: float = 1 / 60,
+        max_rate: float = 0,
+        burst: float = 5,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+        probe_delay: float = 5.0,
+        max_probe_delay: float = 300.0,
+        max_retries: int = 8,
+        log: logging.Logger | None = None,
+    ) -> None:
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(rate, max_rate) if max_rate else rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.initial_probe_delay = probe_delay
+        self.max_probe_delay = max_probe_delay
+        self.max_retries = max_retries
+        self.log = log or logging.getLogger("maufbapi.governor")
+
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._probe_delay = probe_delay
+        self._probing = False
+        self._probe_in_flight = False
+        self._settled = asyncio.Event()
+        self._lock = asyncio.Lock()
+        # Bumped on every rate limit, so that requests that were already in
+        # flight don't count as more rate limits.
+        self._generation = 0
+        # Rate at which the last rate limit was hit.
+        self._limit_rate: float | None = None
+
+        self.requests = 0
+        self.rate_limits = 0
+        self.waited_seconds = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def acquire(self) -> tuple[int, bool]:
+        """Wait for a request slot. Returns the generation and whether it's a probe."""
+        started_at = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._probing and self._probe_in_flight:
+                    self._settled.clear()
+                    await self._settled.wait()
+                    continue
+                if (delay := self._paused_until - now) > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                if self._probing:
+                    self._probe_in_flight = True
+                    probe = True
+                    break
+                if self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    continue
+                self._tokens -= 1
+                probe = False
+                break
+        self.requests += 1
+        self.waited_seconds += time.monotonic() - started_at
+        return self._generation, probe
+
+    def expected_wait(self, queued: int = 0) -> float:
+        """Estimate how long a request would wait for its turn behind ``queued`` others."""
+        now = time.monotonic()
+        tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        return max(self._paused_until - now, 0.0) + max(queued + 1 - tokens, 0.0) / self.rate
+
+    def _settle_probe(self, probe: bool) -> None:
+        if probe:
+            self._probe_in_flight = False
+            self._settled.set()
+
+    def succeeded(self, generation: int, probe: bool) -> None:
+        if probe:
+            self._probing = False
+            self._probe_delay = self.initial_probe_delay
+            self._settle_probe(probe)
+        if generation != self._generation:
+            return
+        increase = self.increase / self.rate
+        if self._limit_rate and self.rate >= self._limit_rate * 0.9:
+            # Creep up on the rate that got limited last time.
+            increase /= 10
+        self.rate += increase
+        if self.max_rate:
+            self.rate = min(self.rate, self.max_rate)
+
+    def failed(self, generation: int, probe: bool) -> None:
+        """For requests that failed in some other way than a rate limit."""
+        self._settle_probe(probe)
+
+    def rate_limited(self, generation: int, probe: bool) -> None:
+        self._settle_probe(probe)
+        if generation != self._generation and not probe:
+            # Already slowed down because of another request.
+            return
+        self._generation += 1
+        self.rate_limits += 1
+        if not probe:
+            self._limit_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        delay = self._probe_delay
+        self._probe_delay = min(self.max_probe_delay, self._probe_delay * 2)
+        self._paused_until = time.monotonic() + delay
+        self._probing = True
+        self._tokens = 0
+        self.log.warning(
+            f"Rate limited, trying again in {delay:.0f} seconds "
+            f"at {self.rate * 60:.1f} requests per minute"
+        )
+
+    async def run(
+        self,
+        request: Callable[[], Awaitable[T]],
+        timeout: float | None = None,
+    ) -> T:
+        """Send a request when the rate allows, retrying it if it gets rate limited.
+
+        ``timeout`` only covers the request itself, not waiting for its turn.
+        """
+        retries = 0
+        while True:
+            generation, probe = await self.acquire()
+            started_at = time.monotonic()
+            try:
+                if timeout:
+                    result = await asyncio.wait_for(request(), timeout)
+                else:
+                    result = await request()
+            except ResponseError as e:
+                if not is_rate_limit_error(e):
+                    self.failed(generation, probe)
+                    raise
+                self.rate_limited(generation, probe)
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                continue
+            except BaseException:
+                self.failed(generation, probe)
+                raise
+            last_request_seconds.set(time.monotonic() - started_at)
+            self.succeeded(generation, probe)
+            return result
@@ -0,0 +1,124 @@
+"""End-to-end tests of ``dump`` against the fake servers in ``benchmarks/``.
+
+    python -m pytest tests
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+sys.path.insert(0, os.path.join(_ROOT, "benchmarks"))
+
+from yarl import URL  # noqa: E402
+
+import commands.dump  # noqa: E402
+from dump_offline import write_credentials  # noqa: E402
+from fake_servers import FakeConfig, FakeServers, ThreadSpec  # noqa: E402
+from maufbapi import AndroidAPI  # noqa: E402
+
+_URL_ATTRIBUTES = ("a_url", "b_url", "graph_url", "b_graph_url", "rupload_url")
+_THREAD_ID = 1000
+
+
+class DumpTestCase(unittest.IsolatedAsyncioTestCase):
+    thread = ThreadSpec(id=_THREAD_ID, messages=1000)
+
+    async def asyncSetUp(self) -> None:
+        self.servers = FakeServers(FakeConfig(threads=[self.thread]))
+        await self.servers.start()
+        self._urls = {name: getattr(AndroidAPI, name) for name in _URL_ATTRIBUTES}
+        for name in _URL_ATTRIBUTES:
+            setattr(AndroidAPI, name, URL(self.servers.url))
+
+        self._workdir = tempfile.TemporaryDirectory(prefix="dump-test-")
+        self.workdir = self._workdir.name
+        self.database = os.path.join(self.workdir, "database.sqlite3")
+        self.credentials = os.path.join(self.workdir, "credentials.json")
+        write_credentials(self.credentials)
+
+    async def asyncTearDown(self) -> None:
+        for name, url in self._urls.items():
+            setattr(AndroidAPI, name, url)
+        await self.servers.stop()
+        self._workdir.cleanup()
+
+    async def dump(self, *argv: str) -> None:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-d", "--database")
+        subparsers = parser.add_subparsers()
+        commands.dump.add_command(subparsers).set_defaults(func=commands.dump.execute)
+        args = parser.parse_args([
+            "-d", self.database,
+            "dump",
+            "--id", str(_THREAD_ID),
+            "--credentials", self.credentials,
+            "--store-dir", os.path.join(self.workdir, "store"),
+            "--db-batch-interval", "0.01",
+            *argv,
+        ])
+        await args.func(args)
+
+    def query(self, sql: str, *params) -> list[tuple]:
+        with sqlite3.connect(self.database) as conn:
+            return conn.execute(sql, params).fetchall()
+
+
+class FailedAttachmentTest(DumpTestCase):
+    # Only images at their full screen size, which are downloaded straight
+    # from their CDN path.
+    thread = ThreadSpec(
+        id=_THREAD_ID,
+        messages=1000,
+        attachment_ratio=0.2,
+        sticker_ratio=0.0,
+        file_ratio=0.0,
+        large_image_ratio=0.0,
+    )
+
+    async def test_failed_download_is_retried_by_next_run(self) -> None:
+        synthetic = self.servers.threads[str(_THREAD_ID)]
+        # A message halfway through the history, so that pages on both sides
+        # of it are written.
+        index = next(
+            index
+            for index in range(self.thread.messages // 2, self.thread.messages)
+            if synthetic.message(index)["blob_attachments"]
+        )
+        (attachment,) = synthetic.message(index)["blob_attachments"]
+        timestamp = synthetic.timestamps[index]
+        self.servers.missing_files.add(f"attachment/{attachment['id']}.jpg")
+
+        await self.dump()
+        self.assertEqual(
+            self.query("SELECT COUNT(*) FROM messages"), [(self.thread.messages,)]
+        )
+        self.assertEqual(
+            self.query("SELECT id FROM attachments WHERE id = ?", attachment["id"]), []
+        )
+        ((oldest_timestamp, complete),) = self.query(
+            "SELECT oldest_timestamp, complete FROM checkpoints WHERE channel_id = ?",
+            _THREAD_ID,
+        )
+        self.assertGreater(oldest_timestamp, timestamp)
+        self.assertFalse(complete)
+
+        self.servers.missing_files.clear()
+        await self.dump()
+        self.assertEqual(
+            self.query("SELECT message_id FROM attachments WHERE id = ?", attachment["id"]),
+            [(synthetic.message_id(index),)],
+        )
+        self.assertEqual(
+            self.query("SELECT complete FROM checkpoints WHERE channel_id = ?", _THREAD_ID),
+            [(1,)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()